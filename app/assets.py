@@ -0,0 +1,84 @@
+from gzip import compress as gzip_compress
+from hashlib import blake2b
+from logging import getLogger
+from pathlib import Path
+
+from brotli import compress as brotli_compress
+from rjsmin import jsmin
+
+UI_DIRECTORY: Path = Path(__file__).parent / "ui"
+
+# The embed script, built once at startup: {"hash", "identity", "gzip", "br"}, the encodings hold the minified bytes
+SCRIPT: dict[str, str | bytes] = {}
+# The embed HTML split around the API URL, joined with the URL of every request
+EMBED_HTML_PARTS: list[str] = []
+
+# Preferred first, the encodings a client can receive the script in
+SCRIPT_ENCODINGS: tuple[str, ...] = ("br", "gzip")
+
+logger = getLogger(__name__)
+
+
+# === BUILD ===
+def build_assets() -> None:
+    """
+    Minify index.js into mini.js, precompress it and pre-render the embed HTML, run once at startup.
+    mini.js is written for reference only, the script is served from memory.
+    """
+    global SCRIPT, EMBED_HTML_PARTS
+
+    script = jsmin((UI_DIRECTORY / "index.js").read_text(encoding="utf-8")).encode("utf-8")
+    try:
+        (UI_DIRECTORY / "mini.js").write_bytes(script)
+    except OSError as e:
+        logger.error("Failed to write mini.js: %s", e)
+
+    SCRIPT = {
+        "hash": blake2b(script, digest_size=8).hexdigest(),
+        "identity": script,
+        "gzip": gzip_compress(script, compresslevel=9, mtime=0),
+        "br": brotli_compress(script, quality=11),
+    }
+
+    # The only part of the HTML that changes per request is the API URL, everything else is rendered here
+    template = (UI_DIRECTORY / "embed.html").read_text(encoding="utf-8").strip()
+    EMBED_HTML_PARTS = template.replace("{script}", get_script_path()).split("{url}")
+
+
+# === SERVING ===
+def get_script_path() -> str:
+    """
+    Get the content-hashed path of the embed script, relative to the API URL.
+
+    :return: The path, it changes whenever the script changes.
+    """
+    return f"js/{SCRIPT['hash']}.js"
+
+
+def render_embed(url: str) -> str:
+    """
+    Get the embed HTML for an API URL.
+
+    :param url: The API URL, ending with "/".
+    :return: The HTML.
+    """
+    return url.join(EMBED_HTML_PARTS)
+
+
+def get_script(accept_encoding: str | None) -> tuple[bytes, str | None]:
+    """
+    Get the embed script in the best encoding the client accepts.
+
+    :param accept_encoding: The Accept-Encoding header.
+    :return: A tuple of (body, Content-Encoding), the encoding is None for the uncompressed script.
+    """
+    accepted = set()
+    for coding in (accept_encoding or "").split(","):
+        name, _, parameters = coding.strip().partition(";")
+        if parameters.strip().replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            accepted.add(name.strip().lower())
+
+    for encoding in SCRIPT_ENCODINGS:
+        if encoding in accepted or "*" in accepted:
+            return SCRIPT[encoding], encoding
+    return SCRIPT["identity"], None
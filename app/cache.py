@@ -0,0 +1,297 @@
+from collections import OrderedDict
+from os import getenv
+
+COMMENT_CACHE_SIZE: int = 100  # Newest comments kept per location
+COMMENT_CACHE_MAX_BYTES: int = 32 * 1024 * 1024  # Memory budget of every buffer together (estimated)
+COMMENT_OVERHEAD_BYTES: int = 256  # Estimated size of a cached comment on top of its text fields
+REVISIONS_SIZE: int = 10000  # Locations whose latest revision seen by the hub is remembered
+
+# Ring buffers of the newest comments, least recently used first, location -> {
+#   "comments": newest first, None while the first read is filling it,
+#   "pending": comments posted while it is filling,
+#   "complete": True if the buffer holds every comment of the location,
+#   "max_comment_id", "revision": the version of the location the buffer holds, it never runs ahead of the comments,
+#   "bytes": estimated size of the buffer }
+BUFFERS: OrderedDict[str, dict] = OrderedDict()
+# Latest revision of every location the change stream delivered, least recently used first, location -> revision.
+# Profile changes come through the same stream before the revisions they bump, so a profile cached by a worker is
+# current for every revision up to this one.
+REVISIONS: OrderedDict[str, int] = OrderedDict()
+REVISIONS_FROM_HUB: bool = False  # True when a change stream delivers the revisions, False on a single process
+TOTAL_BYTES: int = 0
+STATS: dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+# === CONFIGURATION ===
+def configure_comment_cache() -> None:
+    """
+    Set up the comment cache using the environment variables.
+
+    variables:
+
+    - COMMENT_CACHE_SIZE: (optional) How many of the newest comments are kept per location, default is 100,
+      0 disables the cache.
+    - COMMENT_CACHE_MAX_BYTES: (optional) Memory budget of the cache, default is 32 MB.
+    """
+    global COMMENT_CACHE_SIZE, COMMENT_CACHE_MAX_BYTES
+
+    COMMENT_CACHE_SIZE = int(getenv("COMMENT_CACHE_SIZE", COMMENT_CACHE_SIZE))
+    COMMENT_CACHE_MAX_BYTES = int(getenv("COMMENT_CACHE_MAX_BYTES", COMMENT_CACHE_MAX_BYTES))
+
+
+# === BUFFERS ===
+def begin_fill(location: str) -> bool:
+    """
+    Reserve a buffer for a location that is about to be read from the database.
+    Comments posted while the read runs are collected, so they are not lost when the buffer is filled.
+
+    :param location: The location to cache.
+    :return: True if the caller should read the newest comments and call finish_fill.
+    """
+    if COMMENT_CACHE_SIZE <= 0 or location in BUFFERS:
+        return False
+
+    BUFFERS[location] = {"comments": None, "pending": [], "complete": False, "max_comment_id": -1, "revision": 0,
+                         "bytes": 0}
+    return True
+
+
+def finish_fill(location: str, comments: list[dict], max_id: int, revision: int) -> None:
+    """
+    Fill the buffer of a location with its newest comments.
+
+    :param location: The location to cache.
+    :param comments: Up to COMMENT_CACHE_SIZE of the newest comments, newest first.
+    :param max_id: The highest comment ID of the location, read before the comments.
+    :param revision: The revision of the location, read before the comments.
+    """
+    buffer = BUFFERS.get(location)
+    if buffer is None or buffer["comments"] is not None:
+        return
+
+    # Versions delivered while the read ran are kept, they come after comments that are pending
+    buffer["max_comment_id"] = max(buffer["max_comment_id"], max_id)
+    buffer["revision"] = max(buffer["revision"], revision)
+    buffer["comments"] = list(comments)
+    buffer["complete"] = len(comments) < COMMENT_CACHE_SIZE
+    buffer["bytes"] = sum(estimate_size(comment) for comment in comments)
+    add_bytes(buffer["bytes"])
+
+    for comment in buffer.pop("pending"):
+        add(location, comment)
+
+    evict()
+
+
+def add(location: str, comment: dict) -> None:
+    """
+    Put a new comment in the buffer of its location, if the location is cached.
+
+    :param location: The location of the comment.
+    :param comment: The comment, with only its public fields.
+    """
+    buffer = BUFFERS.get(location)
+    if buffer is None:
+        return
+    if buffer["comments"] is None:
+        buffer["pending"].append(comment)
+        return
+
+    comments = buffer["comments"]
+    if any(cached["id"] == comment["id"] for cached in comments):
+        return
+
+    # IDs can arrive out of order when workers reserve blocks of IDs, keep the buffer sorted newest first
+    index = 0
+    while index < len(comments) and comments[index]["id"] > comment["id"]:
+        index += 1
+    comments.insert(index, comment)
+    size = estimate_size(comment)
+
+    if len(comments) > COMMENT_CACHE_SIZE:
+        size -= estimate_size(comments.pop())
+        buffer["complete"] = False
+
+    buffer["bytes"] += size
+    add_bytes(size)
+    evict()
+
+
+def update(location: str, comment: dict) -> None:
+    """
+    Replace a cached comment with its edited or deleted version, if the location is cached.
+
+    :param location: The location of the comment.
+    :param comment: The comment, with only its public fields.
+    """
+    buffer = BUFFERS.get(location)
+    if buffer is None:
+        return
+    if buffer["comments"] is None:
+        # The read that is filling the buffer may or may not have seen the change, it is filled again on the next read
+        discard(location)
+        return
+
+    comments = buffer["comments"]
+    for index, cached in enumerate(comments):
+        if cached["id"] == comment["id"]:
+            size = estimate_size(comment) - estimate_size(cached)
+            comments[index] = comment
+            buffer["bytes"] += size
+            add_bytes(size)
+            evict()
+            return
+
+
+def set_version(location: str, max_id: int | None, revision: int) -> None:
+    """
+    Move the version of a location forward, called after the comments of that version reached the buffer.
+
+    :param location: The location.
+    :param max_id: The highest comment ID of the location, None if it did not change.
+    :param revision: The revision of the location.
+    """
+    REVISIONS[location] = max(REVISIONS.get(location, 0), revision)
+    REVISIONS.move_to_end(location)
+    while len(REVISIONS) > REVISIONS_SIZE:
+        REVISIONS.popitem(last=False)
+
+    buffer = BUFFERS.get(location)
+    if buffer is None:
+        return
+    if max_id is not None:
+        buffer["max_comment_id"] = max(buffer["max_comment_id"], max_id)
+    buffer["revision"] = max(buffer["revision"], revision)
+
+
+def get_version(location: str) -> tuple[int, int]:
+    """
+    Get the version of the comments a buffer holds, to tag a page served from it.
+
+    :param location: The location, its buffer must be filled.
+    :return: A tuple of (max_comment_id, revision).
+    """
+    buffer = BUFFERS[location]
+    return buffer["max_comment_id"], buffer["revision"]
+
+
+def is_profile_current(location: str, revision: int) -> bool:
+    """
+    Check if the profiles cached by this worker are current for a revision of a location. A revision this worker has
+    not seen on the change stream yet may come from a profile change whose update it has not seen either.
+
+    :param location: The location.
+    :param revision: The revision the page is tagged with.
+    :return: True if authors can be resolved from the profile cache, False if they have to be read.
+    """
+    return not REVISIONS_FROM_HUB or REVISIONS.get(location, -1) >= revision
+
+
+def get_page(location: str, comment_per_page: int, page: int, latest_first: bool,
+             before_id: int | None, after_id: int | None) -> tuple[list[dict], int | None] | None:
+    """
+    Get a page of comments from the buffer, only newest first pages that lie inside the buffer can be served.
+
+    :param location: The location to get the comments from.
+    :param comment_per_page: The number of comments per page.
+    :param page: The page number, ignored when before_id is given.
+    :param latest_first: True if the comments should be sorted from the latest.
+    :param before_id: Only get comments with an ID lower than this.
+    :param after_id: Only get comments with an ID higher than this.
+    :return: The same tuple as database.get_comments, or None if the page has to be read from the database.
+    """
+    buffer = BUFFERS.get(location)
+    if buffer is None or buffer["comments"] is None or not latest_first or after_id is not None:
+        STATS["misses"] += 1
+        return None
+
+    comments = buffer["comments"]
+    oldest_id = comments[-1]["id"] if comments else 0
+
+    if before_id is not None:
+        page_comments = [comment for comment in comments if comment["id"] < before_id][:comment_per_page]
+        if len(page_comments) < comment_per_page and not buffer["complete"]:
+            STATS["misses"] += 1
+            return None
+
+        next_cursor = page_comments[-1]["id"] if len(page_comments) == comment_per_page else None
+    else:
+        # Same ID range as the database read, counted back from the highest comment ID
+        max_id = comments[0]["id"] if comments else -1
+        from_id = max(max_id + 1 - (page * comment_per_page), 0)
+        to_id = max_id + 1 - ((page - 1) * comment_per_page)
+        if from_id < oldest_id and not buffer["complete"]:
+            STATS["misses"] += 1
+            return None
+
+        page_comments = [comment for comment in comments if from_id <= comment["id"] < to_id]
+        next_cursor = from_id if from_id > 0 else None
+
+    STATS["hits"] += 1
+    BUFFERS.move_to_end(location)
+    return page_comments, next_cursor
+
+
+def discard(location: str) -> None:
+    """
+    Drop the buffer of a location, used when filling it failed or may have missed a change.
+
+    :param location: The location to drop.
+    """
+    buffer = BUFFERS.pop(location, None)
+    if buffer is not None:
+        add_bytes(-buffer["bytes"])
+
+
+def clear() -> None:
+    """
+    Drop every buffer and seen revision, used when comments may have been missed (the change stream was reopened).
+    """
+    global TOTAL_BYTES
+
+    BUFFERS.clear()
+    REVISIONS.clear()
+    TOTAL_BYTES = 0
+
+
+def get_stats() -> dict[str, int | float]:
+    """
+    Get the counters of the comment cache.
+
+    :return: A dictionary containing the cached locations, estimated bytes, evictions, hits, misses and hit ratio.
+    """
+    lookups = STATS["hits"] + STATS["misses"]
+    return {"locations": len(BUFFERS), "bytes": TOTAL_BYTES, **STATS,
+            "hit_ratio": STATS["hits"] / lookups if lookups else 0.0}
+
+
+# === HELPERS ===
+def evict() -> None:
+    """
+    Drop the least recently used buffers until the cache fits its memory budget.
+    """
+    while TOTAL_BYTES > COMMENT_CACHE_MAX_BYTES and len(BUFFERS) > 1:
+        _, buffer = BUFFERS.popitem(last=False)
+        add_bytes(-buffer["bytes"])
+        STATS["evictions"] += 1
+
+
+def add_bytes(size: int) -> None:
+    """
+    Track the estimated size of the cache.
+
+    :param size: The bytes added, negative when removed.
+    """
+    global TOTAL_BYTES
+
+    TOTAL_BYTES += size
+
+
+def estimate_size(comment: dict) -> int:
+    """
+    Estimate the memory used by a cached comment.
+
+    :param comment: The comment.
+    :return: The estimated size in bytes.
+    """
+    return COMMENT_OVERHEAD_BYTES + sum(len(value) for value in comment.values() if isinstance(value, str))
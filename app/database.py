@@ -1,25 +1,160 @@
 import base64
-from asyncio import sleep, gather
-from datetime import datetime, timedelta
-from os import getenv
+from asyncio import sleep, gather, Lock, Future, QueueFull, create_task, get_running_loop
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+from hmac import new as new_hmac, compare_digest
+from json import dumps, loads
+from logging import getLogger
+from os import getenv, cpu_count
 from re import match
-from secrets import choice
+from secrets import choice, token_hex
+from time import monotonic, time
 from urllib.parse import quote_plus
 
 from dotenv import load_dotenv
 from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorClient
-from pymongo.errors import OperationFailure
-from requests import post
-from starlette.websockets import WebSocket
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel, UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure, DuplicateKeyError, BulkWriteError
+
+import app.cache as comment_cache
+import app.mailer as mailer
+import app.metrics as metrics
+import app.rendering as comment_renderer
+
+logger = getLogger(__name__)
 
 # Load the environment variables
 load_dotenv()
 
 # Global database variable
 DB: AsyncIOMotorDatabase
+MONGODB_BACKEND: str = "mongodb"  # "memory" runs on an in-memory stand-in, for benchmarks and local development
+MEMORY_DATABASE: AsyncIOMotorDatabase | None = None
 ACCESS_TOKEN_EXPIRATION_DAYS: int = 30
 VERIFICATION_CODE_EXPIRATION_MINUTES: int = 10
 CLEANUP_INTERVAL_SECONDS: int = 86400  # 1 day
+CLEANUP_BATCH_SIZE: int = 100  # Users cleaned per write
+CLEANUP_BATCH_PAUSE_SECONDS: float = 0.5  # Pause between two cleanup writes
+COMMENT_ID_BLOCK_SIZE: int = 1  # IDs reserved per counter round-trip, above 1 only for the worker holding a lease
+COMMENT_ID_LEASE_SECONDS: int = 30  # How long the lease for handing out ID blocks outlives a worker that stopped
+COMMENT_BATCH_WINDOW_MS: int = 0  # How long comments to one location are collected before they are written, 0 is off
+COMMENT_BATCH_MAX_SIZE: int = 100  # Comments that trigger a write before the window ends
+LOCATION_UPDATE_ATTEMPTS: int = 3  # Tries to move a location forward after its comments were written
+TOKEN_CACHE_SIZE: int = 10000  # Validated access tokens kept in memory
+TOKEN_CACHE_TTL_SECONDS: int = 300  # How long a validated access token is trusted before it is looked up again
+TOKEN_TOUCH_FLUSH_SECONDS: int = 60  # How often the "last used" timestamps of access tokens are written
+REVOCATION_REFRESH_SECONDS: int = 60  # How often the revoked access tokens are reloaded from the database
+LOCATION_SUMMARY_TTL_SECONDS: int = 10  # How long comment counts of a location are served from memory
+LOCATION_SUMMARY_CACHE_SIZE: int = 10000  # Location summaries kept in memory
+LOCATION_SUMMARY_MAX_LOCATIONS: int = 100  # Locations accepted in one summary request
+
+# Keys for signed access tokens, key ID -> secret, the first key signs new access tokens
+ACCESS_TOKEN_SIGNING_KEYS: dict[str, bytes] = {}
+ACCESS_TOKEN_SIGNING_KEY_ID: str | None = None
+SIGNED_ACCESS_TOKEN_PREFIX: str = "v2."
+# Revoked access tokens that may still be accepted somewhere, token ID (signed) or fingerprint (old format) -> expiration
+REVOKED_ACCESS_TOKENS: dict[str, datetime] = {}
+
+# Comment ID blocks reserved by this process, location -> [next ID, end ID (exclusive)]
+COMMENT_ID_BLOCKS: dict[str, list[int]] = {}
+COMMENT_ID_LOCKS: dict[str, Lock] = {}
+# Until when (monotonic) this process surely holds the lease for handing out comment ID blocks
+COMMENT_ID_LEASE_EXPIRES: float = 0.0
+
+# Called with (location, event, comment) for every comment this process creates, edits or deletes, only used when the
+# database has no change streams (the in-memory stand-in)
+COMMENT_LISTENERS: list[Callable[[str, str, dict], None]] = []
+# Called with (location, max_comment_id, revision) after this process changed the version of a location, used the same
+# way, after the comments of that version were handed to COMMENT_LISTENERS
+VERSION_LISTENERS: list[Callable[[str, int, int], None]] = []
+
+# Comments waiting to be written together, location -> [(comment without its ID, future of the caller)]
+COMMENT_BATCHES: dict[str, list[tuple[dict, Future]]] = {}
+
+# Validated access tokens, least recently used first, access token -> {"user", "last_used", "cached_at"}
+TOKEN_CACHE: OrderedDict[str, dict] = OrderedDict()
+TOKEN_CACHE_STATS: dict[str, int] = {"hits": 0, "misses": 0}
+# "Last used" timestamps waiting to be written in one bulk write, access token -> (email, timestamp)
+PENDING_TOKEN_TOUCHES: dict[str, tuple[str, datetime]] = {}
+# User profiles for signed access tokens and comment authors, least recently used first,
+# email -> {"profile", "cached_at"}
+PROFILE_CACHE: OrderedDict[str, dict] = OrderedDict()
+
+# Comment counts and latest comments of locations, least recently used first,
+# location -> {"summary", "with_latest", "cached_at"}
+LOCATION_SUMMARY_CACHE: OrderedDict[str, dict] = OrderedDict()
+
+# Identifies this worker for the leases of background jobs
+WORKER_ID: str = token_hex(8)
+# Counts and duration of the last cleanup run of this worker
+CLEANUP_STATS: dict[str, str | int | float] = {}
+
+# Version 1 embedded every comment of a location in one array, version 2 stores one document per comment
+COMMENT_LAYOUT_VERSION: int = 2
+# Fields that are stored on a comment document but never sent to the client, migrated marks the comments copied from
+# the legacy layout, so the change stream does not announce them as new
+COMMENT_PROJECTION: dict[str, int] = {"_id": 0, "location": 0, "migrated": 0}
+# Same, for clients that did not ask for the rendered HTML of the comments
+COMMENT_TEXT_PROJECTION: dict[str, int] = {**COMMENT_PROJECTION, "html": 0}
+# The public profile of a user, resolved into the comments that reference their author
+PROFILE_PROJECTION: dict[str, int] = {"_id": 0, "email": 1, "username": 1, "color": 1, "initial": 1}
+# Posted without an access token, these comments keep their author fields inline
+ANONYMOUS_EMAIL: str = "anonymous user"
+# Shown for comments whose author no longer exists
+MISSING_AUTHOR: dict[str, str] = {"username": "Deleted user", "color": "#1d3557", "initial": "/"}
+
+# Indexes every query of the app relies on, created at startup, collection -> indexes
+INDEXES: dict[str, list[IndexModel]] = {
+    "comments": [IndexModel([("location", ASCENDING)], unique=True)],
+    "comment_items": [
+        IndexModel([("location", ASCENDING), ("id", ASCENDING)], unique=True),
+        # Search within one location, words are matched as written (no stemming or stop words, comments are in any
+        # language), the same way as the in-process index of the in-memory stand-in
+        IndexModel([("location", ASCENDING), ("comment", TEXT)], default_language="none"),
+        # Locations an author commented on, their pages change with the author's profile
+        IndexModel([("author", ASCENDING), ("location", ASCENDING)]),
+    ],
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("access_tokens.accessToken", ASCENDING)]),
+        IndexModel([("access_tokens.timestamp", ASCENDING)]),
+    ],
+    "verification_queue": [
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),  # TTL, MongoDB deletes expired codes
+    ],
+    "revoked_tokens": [
+        IndexModel([("jti", ASCENDING)], unique=True),
+        IndexModel([("expires_at", ASCENDING)], expireAfterSeconds=0),  # TTL, MongoDB deletes expired revocations
+    ],
+}
+
+# Every query shape the app issues, with sample values, checked by "python -m app.manage audit-queries".
+# (collection, description, filter, sort)
+QUERY_SHAPES: list[tuple[str, str, dict, list[tuple[str, int]] | None]] = [
+    ("comments", "location version / ID counter", {"location": "audit"}, None),
+    ("comments", "location summaries", {"location": {"$in": ["audit", "audit/2"]}}, None),
+    ("comment_items", "page by ID range", {"location": "audit", "id": {"$gte": 0, "$lt": 30}}, [("id", DESCENDING)]),
+    ("comment_items", "page before cursor", {"location": "audit", "id": {"$lt": 30}}, [("id", DESCENDING)]),
+    ("comment_items", "page after cursor", {"location": "audit", "id": {"$gt": 30}}, [("id", ASCENDING)]),
+    ("comment_items", "newest comments (cache fill)", {"location": "audit"}, [("id", DESCENDING)]),
+    ("comment_items", "latest comment (summaries)", {"location": "audit", "deleted": {"$ne": True}},
+     [("id", DESCENDING)]),
+    ("comment_items", "search within a location", {"location": "audit", "$text": {"$search": "audit"}}, None),
+    ("comment_items", "comment of its author (edit, delete)",
+     {"location": "audit", "id": 0, "deleted": {"$ne": True}, "$or": [{"author": "audit"}, {"email": "audit"}]}, None),
+    ("comment_items", "locations of an author (profile change)", {"author": "audit@example.com"}, None),
+    ("users", "access token lookup", {"email": "audit@example.com", "access_tokens.accessToken": "audit"}, None),
+    ("users", "user by email", {"email": "audit@example.com"}, None),
+    ("users", "expired access tokens", {"access_tokens.timestamp": {"$lt": datetime(2000, 1, 1)}}, None),
+    ("verification_queue", "verification by email", {"email": "audit@example.com"}, None),
+    ("verification_queue", "codes without expiration",
+     {"expires_at": {"$exists": False}, "timestamp": {"$lt": datetime(2000, 1, 1)}}, None),
+    ("revoked_tokens", "active revocations", {"expires_at": {"$gt": datetime(2000, 1, 1)}}, None),
+]
 
 
 # === DATABASE ===
@@ -34,8 +169,67 @@ async def get_database() -> None:
     - MONGODB_DATABASE: The database name.
     - MONGODB_HOST: The host of the MongoDB database.
     - MONGODB_PORT: The port of the MongoDB database.
+    - MONGODB_BACKEND: (optional) "memory" to run on an in-memory stand-in instead of MongoDB (needs mongomock-motor,
+      data is lost on restart and there are no change streams, WebSockets only see comments posted to this process).
+      The MONGODB_* connection variables are not needed then, default is "mongodb".
+    - COMMENT_ID_BLOCK_SIZE: (optional) How many comment IDs a worker reserves at once, default is 1. Above 1 the
+      app should run as a single worker, only the worker holding a lease uses blocks, the others take IDs one at a time.
+    - COMMENT_ID_LEASE_SECONDS: (optional) How long a worker that stopped without releasing that lease keeps it,
+      default is 30.
+    - COMMENT_BATCH_WINDOW_MS: (optional) How long comments to one location are collected and written together,
+      default is 0 (every comment is written on its own).
+    - COMMENT_BATCH_MAX_SIZE: (optional) How many collected comments are written before the window ends, default is 100.
+    - TOKEN_CACHE_SIZE: (optional) How many validated access tokens are kept in memory, default is 10000.
+    - TOKEN_CACHE_TTL_SECONDS: (optional) How long a cached access token is trusted, default is 300.
+    - TOKEN_TOUCH_FLUSH_SECONDS: (optional) How often access token "last used" timestamps are written, default is 60.
+    - LOCATION_SUMMARY_TTL_SECONDS: (optional) How long comment counts of a location are cached, default is 10.
+    - LOCATION_SUMMARY_MAX_LOCATIONS: (optional) How many locations one summary request may ask for, default is 100.
+    - ACCESS_TOKEN_SIGNING_KEYS: (optional) Comma separated <key id>:<secret> pairs, enables signed access tokens.
+      The first key signs new access tokens, the others are only used to verify. Key IDs can not contain "." or ":".
     """
-    global DB
+    global DB, MONGODB_BACKEND, MEMORY_DATABASE, COMMENT_ID_BLOCK_SIZE, COMMENT_ID_LEASE_SECONDS, \
+        COMMENT_BATCH_WINDOW_MS, COMMENT_BATCH_MAX_SIZE, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL_SECONDS, \
+        TOKEN_TOUCH_FLUSH_SECONDS, LOCATION_SUMMARY_TTL_SECONDS, LOCATION_SUMMARY_MAX_LOCATIONS, \
+        ACCESS_TOKEN_SIGNING_KEYS, ACCESS_TOKEN_SIGNING_KEY_ID
+
+    MONGODB_BACKEND = getenv("MONGODB_BACKEND", MONGODB_BACKEND)
+    COMMENT_ID_BLOCK_SIZE = max(1, int(getenv("COMMENT_ID_BLOCK_SIZE", COMMENT_ID_BLOCK_SIZE)))
+    COMMENT_ID_LEASE_SECONDS = int(getenv("COMMENT_ID_LEASE_SECONDS", COMMENT_ID_LEASE_SECONDS))
+    COMMENT_BATCH_WINDOW_MS = int(getenv("COMMENT_BATCH_WINDOW_MS", COMMENT_BATCH_WINDOW_MS))
+    COMMENT_BATCH_MAX_SIZE = max(1, int(getenv("COMMENT_BATCH_MAX_SIZE", COMMENT_BATCH_MAX_SIZE)))
+    TOKEN_CACHE_SIZE = int(getenv("TOKEN_CACHE_SIZE", TOKEN_CACHE_SIZE))
+    TOKEN_CACHE_TTL_SECONDS = int(getenv("TOKEN_CACHE_TTL_SECONDS", TOKEN_CACHE_TTL_SECONDS))
+    TOKEN_TOUCH_FLUSH_SECONDS = int(getenv("TOKEN_TOUCH_FLUSH_SECONDS", TOKEN_TOUCH_FLUSH_SECONDS))
+    LOCATION_SUMMARY_TTL_SECONDS = int(getenv("LOCATION_SUMMARY_TTL_SECONDS", LOCATION_SUMMARY_TTL_SECONDS))
+    LOCATION_SUMMARY_MAX_LOCATIONS = max(1, int(getenv("LOCATION_SUMMARY_MAX_LOCATIONS",
+                                                       LOCATION_SUMMARY_MAX_LOCATIONS)))
+
+    signing_keys = {}
+    for key in getenv("ACCESS_TOKEN_SIGNING_KEYS", "").split(","):
+        if not key.strip():
+            continue
+        key_id, _, secret = (part.strip() for part in key.partition(":"))
+        # The key id is a part of the dot separated access token
+        if not key_id or not secret or "." in key_id:
+            raise ValueError("ACCESS_TOKEN_SIGNING_KEYS must be comma separated <key id>:<secret> pairs, the key id "
+                             "without dots")
+        signing_keys[key_id] = secret.encode("utf-8")
+    ACCESS_TOKEN_SIGNING_KEYS = signing_keys
+    ACCESS_TOKEN_SIGNING_KEY_ID = next(iter(ACCESS_TOKEN_SIGNING_KEYS), None)
+
+    comment_cache.configure_comment_cache()
+
+    if MONGODB_BACKEND == "memory":
+        # The stand-in is created once, so data seeded before startup survives the call from the lifespan
+        if MEMORY_DATABASE is None:
+            try:
+                from mongomock_motor import AsyncMongoMockClient
+            except ImportError:
+                raise RuntimeError("MONGODB_BACKEND=memory needs mongomock-motor (pip install mongomock-motor)")
+            MEMORY_DATABASE = AsyncMongoMockClient()["comment_section"]
+
+        DB = MEMORY_DATABASE
+        return
 
     # Create connection string from environment variables
     username = quote_plus(getenv("MONGODB_USERNAME"))
@@ -51,46 +245,367 @@ async def get_database() -> None:
     DB = client[database]
 
 
+async def ensure_indexes() -> None:
+    """
+    Create the indexes in INDEXES, existing indexes with the same definition are left as they are.
+    Fails when an index can not be built (e.g. duplicate emails for a unique index), so a bad deploy stops at startup.
+    The in-memory stand-in scans every document anyway, and checking unique indexes makes each insert scan too.
+    """
+    if MONGODB_BACKEND == "memory":
+        return
+
+    try:
+        for collection, indexes in INDEXES.items():
+            await DB[collection].create_indexes(indexes)
+    except OperationFailure as e:
+        raise RuntimeError(f"Creating indexes failed: {str(e)}")
+
+
+async def audit_queries() -> list[tuple[str, str, str]]:
+    """
+    Explain every query shape in QUERY_SHAPES and report the ones that scan a whole collection.
+
+    :return: A list of (collection, description, "ok" or "COLLSCAN") for every query shape.
+    """
+    results = []
+
+    try:
+        for collection, description, query, sort in QUERY_SHAPES:
+            cursor = DB[collection].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+
+            plan = (await cursor.limit(30).explain())["queryPlanner"]["winningPlan"]
+            results.append((collection, description, "COLLSCAN" if "COLLSCAN" in str(plan) else "ok"))
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+    return results
+
+
+@metrics.timed
+async def migrate_location(location: str) -> int:
+    """
+    Move the comments of a location from the legacy embedded array into the comment_items collection.
+    This is idempotent and safe to run while the app is serving, comments are upserted by (location, id) and the
+    legacy array is only removed once every comment in it is found in comment_items and nothing was added to it since.
+
+    :param location: The location to migrate.
+    :return: The number of comments copied.
+    """
+    try:
+        while True:
+            location_data = await DB.comments.find_one({"location": location}, {"comments": 1})
+            if not location_data or "comments" not in location_data:
+                return 0
+
+            comments = location_data["comments"]
+            if await renumber_duplicate_comments(location, comments):
+                continue  # Read the array again with the new IDs
+
+            if comments:
+                await DB.comment_items.bulk_write([
+                    UpdateOne({"location": location, "id": comment["id"]},
+                              {"$setOnInsert": {**comment, "location": location, "migrated": True}}, upsert=True)
+                    for comment in comments
+                ], ordered=False)
+
+                # Every ID is unique now, so each comment of the array has to be found under its own ID
+                copied = await DB.comment_items.count_documents(
+                    {"location": location, "id": {"$in": [comment["id"] for comment in comments]}})
+                if copied != len(comments):
+                    raise RuntimeError(f"Only {copied} of {len(comments)} comments of {location} were copied")
+
+            # Drop the legacy array, keep the highest comment ID so new comments continue the sequence.
+            # A comment pushed by an older worker in the meantime keeps the array, it is copied on the next pass.
+            max_id = max([comment["id"] for comment in comments], default=-1)
+            result = await DB.comments.update_one(
+                {"location": location, "comments": {"$size": len(comments)}},
+                {"$unset": {"comments": ""}, "$max": {"max_comment_id": max_id}, "$inc": {"revision": 1},
+                 "$set": {"layout": COMMENT_LAYOUT_VERSION}}
+            )
+            if result.matched_count:
+                return len(comments)
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+
+async def renumber_duplicate_comments(location: str, comments: list[dict]) -> bool:
+    """
+    Give new IDs to the comments of a legacy array that share their ID with an earlier comment (two legacy posts that
+    raced read the same max_comment_id). The new IDs are reserved from the counter, so they come after every existing
+    comment, and are written into the array before anything is copied, so a second run copies them the same way.
+
+    :param location: The location of the array.
+    :param comments: The legacy array.
+    :return: True if comments were renumbered, the array has to be read again.
+    """
+    seen = set()
+    duplicates = []
+    for index, comment in enumerate(comments):
+        if comment["id"] in seen:
+            duplicates.append(index)
+        seen.add(comment["id"])
+
+    if not duplicates:
+        return False
+
+    first_id = await reserve_comment_ids(location, len(duplicates))
+    # Only applied if the array still holds the same IDs, a concurrent migration may have renumbered them already
+    await DB.comments.update_one(
+        {"location": location, **{f"comments.{index}.id": comments[index]["id"] for index in duplicates}},
+        {"$set": {f"comments.{index}.id": first_id + offset for offset, index in enumerate(duplicates)}}
+    )
+    logger.warning("Renumbered %d comments of %s that shared their ID", len(duplicates), location,
+                   extra={"location": location})
+    return True
+
+
+async def migrate_comments() -> tuple[int, int]:
+    """
+    Migrate every location that still stores its comments in the legacy embedded array.
+
+    :return: A tuple of (migrated locations, copied comments).
+    """
+    locations = 0
+    comments = 0
+
+    try:
+        async for location_data in DB.comments.find({"comments": {"$exists": True}}, {"location": 1}):
+            comments += await migrate_location(location_data["location"])
+            locations += 1
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+    return locations, comments
+
+
+async def backfill_comment_html(batch_size: int = 500, processes: int | None = None) -> int:
+    """
+    Render and store the HTML of every comment that was written before the HTML was stored with the comment.
+    Rendering runs in a process pool, so large backfills neither block the event loop nor wait on a single core.
+    Safe to run while the app is serving, comments that got their HTML in the meantime are not overwritten.
+
+    :param batch_size: How many comments are rendered and written at once.
+    :param processes: How many worker processes render, default is the number of CPUs.
+    :return: The number of comments that got their HTML.
+    """
+    loop = get_running_loop()
+    written = 0
+
+    async def render_and_write(batch: list[dict]) -> int:
+        html = await loop.run_in_executor(pool, comment_renderer.render_comments,
+                                          [comment["comment"] for comment in batch])
+        result = await DB.comment_items.bulk_write([
+            UpdateOne({"_id": comment["_id"], "html": {"$exists": False}}, {"$set": {"html": comment_html}})
+            for comment, comment_html in zip(batch, html)
+        ], ordered=False)
+        return result.modified_count
+
+    try:
+        with ProcessPoolExecutor(processes) as pool:
+            # Keep every process busy, a group of batches is rendered in parallel before the next is read
+            parallel = processes or cpu_count() or 1
+            batches = []
+            batch = []
+
+            async for comment in DB.comment_items.find({"html": {"$exists": False}}, {"comment": 1}) \
+                    .batch_size(batch_size):
+                batch.append(comment)
+                if len(batch) >= batch_size:
+                    batches.append(batch)
+                    batch = []
+                if len(batches) >= parallel:
+                    written += sum(await gather(*(render_and_write(pending) for pending in batches)))
+                    batches = []
+
+            if batch:
+                batches.append(batch)
+            written += sum(await gather(*(render_and_write(pending) for pending in batches)))
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+    return written
+
+
+async def link_comment_authors(batch_size: int = 1000) -> int:
+    """
+    Replace the author fields copied into comments of signed in users with a reference to the user, in one pass over
+    the comments written before authors were referenced. Comments whose email has no user stay as they are.
+    Safe to run while the app is serving, comments are read the same way in both shapes.
+
+    :param batch_size: How many comments are checked and written at once.
+    :return: The number of comments that now reference their author.
+    """
+    linked = 0
+    users = {}  # email -> True if the user exists
+
+    async def link(batch: list[dict]) -> int:
+        unknown = list({comment["email"] for comment in batch} - users.keys())
+        if unknown:
+            existing = {user["email"] async for user in DB.users.find({"email": {"$in": unknown}}, {"email": 1})}
+            users.update({email: email in existing for email in unknown})
+
+        updates = [
+            UpdateOne({"_id": comment["_id"], "author": {"$exists": False}},
+                      {"$set": {"author": comment["email"]},
+                       "$unset": {"email": "", "username": "", "color": "", "initial": ""}})
+            for comment in batch if users[comment["email"]]
+        ]
+        if not updates:
+            return 0
+        return (await DB.comment_items.bulk_write(updates, ordered=False)).modified_count
+
+    try:
+        batch = []
+        async for comment in DB.comment_items.find(
+                {"author": {"$exists": False}, "email": {"$nin": [ANONYMOUS_EMAIL, ""]}}, {"email": 1}) \
+                .batch_size(batch_size):
+            batch.append(comment)
+            if len(batch) >= batch_size:
+                linked += await link(batch)
+                batch = []
+        if batch:
+            linked += await link(batch)
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+    return linked
+
+
 async def clean_database() -> None:
     """
-    Clean the database by removing expired access tokens and verification codes.
+    Clean the database by sweeping expired access tokens of the old format off the users, in small batches with a
+    pause in between so the cleanup never hits the users collection with one big write. Verification codes and
+    revocations expire on their own through TTL indexes, codes written before they had an expiration are deleted here
+    too. Only the worker holding the cleanup lease runs the sweep.
     """
-    global ACCESS_TOKEN_EXPIRATION_DAYS, VERIFICATION_CODE_EXPIRATION_MINUTES, CLEANUP_INTERVAL_SECONDS
+    global ACCESS_TOKEN_EXPIRATION_DAYS, VERIFICATION_CODE_EXPIRATION_MINUTES, CLEANUP_INTERVAL_SECONDS, \
+        CLEANUP_BATCH_SIZE, CLEANUP_BATCH_PAUSE_SECONDS
 
     # Get expiration from environment variables
     ACCESS_TOKEN_EXPIRATION_DAYS = int(getenv("ACCESS_TOKEN_EXPIRATION_DAYS"))
     VERIFICATION_CODE_EXPIRATION_MINUTES = int(getenv("VERIFICATION_CODE_EXPIRATION_MINUTES"))
     CLEANUP_INTERVAL_SECONDS = int(getenv("CLEANUP_INTERVAL_SECONDS"))
+    CLEANUP_BATCH_SIZE = int(getenv("CLEANUP_BATCH_SIZE", CLEANUP_BATCH_SIZE))
+    CLEANUP_BATCH_PAUSE_SECONDS = float(getenv("CLEANUP_BATCH_PAUSE_SECONDS", CLEANUP_BATCH_PAUSE_SECONDS))
 
     while True:
-        print(f"INF0:     {datetime.now()} - Running database cleanup")
-
-        # Calculate the expiration threshold
-        access_token_expiration_threshold = datetime.now() - timedelta(days=ACCESS_TOKEN_EXPIRATION_DAYS)
-        verification_code_expiration_threshold = datetime.now() - timedelta(
-            minutes=VERIFICATION_CODE_EXPIRATION_MINUTES)
-
         try:
-            # Remove expired tokens and code from the database, runs simultaneously
-            token_result = await DB.users.update_many(
-                {"access_tokens.timestamp": {"$lt": access_token_expiration_threshold}},
-                {"$pull": {"access_tokens": {"timestamp": {"$lt": access_token_expiration_threshold}}}}
-            )
-            code_result = await DB.verification_queue.delete_many(
-                {"timestamp": {"$lt": verification_code_expiration_threshold}}
-            )
-            print(f"INFO:     {datetime.now()} - Deleted {token_result.modified_count} expired tokens")
-            print(f"INFO:     {datetime.now()} - Deleted {code_result.deleted_count} expired codes")
+            # The lease outlives the interval, so the holder keeps it and the others take over if it stops
+            if await acquire_lease("cleanup", CLEANUP_INTERVAL_SECONDS * 2):
+                logger.info("Running database cleanup")
+                started = monotonic()
+
+                tokens, batches = await sweep_expired_access_tokens()
+                codes = await delete_legacy_verification_codes()
+
+                CLEANUP_STATS.update({"last_run": datetime.now().isoformat(), "deleted_tokens": tokens,
+                                      "batches": batches, "deleted_codes": codes,
+                                      "duration_seconds": round(monotonic() - started, 3)})
+                logger.info("Deleted %d expired tokens in %d batches", tokens, batches,
+                            extra={"duration_ms": round(CLEANUP_STATS["duration_seconds"] * 1000, 3)})
         except Exception as e:
-            print(f"ERROR:    {datetime.now()} - Cleanup failed: {str(e)}")
-        finally:
-            print(f"INFO:     {datetime.now()} - Database cleanup completed")
+            logger.exception("Cleanup failed: %s", e)
 
         # Sleep for the interval, prevent the cleanup from running too often and causing performance issues
         await sleep(CLEANUP_INTERVAL_SECONDS)  # Default is 1 day
 
 
+@metrics.timed
+async def sweep_expired_access_tokens() -> tuple[int, int]:
+    """
+    Remove the expired access tokens from the users, CLEANUP_BATCH_SIZE users at a time.
+
+    :return: A tuple of (users with removed access tokens, batches).
+    """
+    threshold = datetime.now() - timedelta(days=ACCESS_TOKEN_EXPIRATION_DAYS)
+    swept = 0
+    batches = 0
+    user_ids = []
+
+    async def pull_expired() -> None:
+        nonlocal swept, batches
+
+        result = await DB.users.update_many(
+            {"_id": {"$in": user_ids}},
+            {"$pull": {"access_tokens": {"timestamp": {"$lt": threshold}}}}
+        )
+        swept += result.modified_count
+        batches += 1
+        user_ids.clear()
+
+        await sleep(CLEANUP_BATCH_PAUSE_SECONDS)
+
+    try:
+        async for user in DB.users.find({"access_tokens.timestamp": {"$lt": threshold}}, {"_id": 1}) \
+                .batch_size(CLEANUP_BATCH_SIZE):
+            user_ids.append(user["_id"])
+            if len(user_ids) >= CLEANUP_BATCH_SIZE:
+                await pull_expired()
+
+        if user_ids:
+            await pull_expired()
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+    return swept, batches
+
+
+@metrics.timed
+async def delete_legacy_verification_codes() -> int:
+    """
+    Delete the expired verification codes that were written before codes had an expires_at, the TTL index never
+    removes them. Codes without expires_at that have not expired yet are deleted by a later run.
+
+    :return: The number of deleted codes.
+    """
+    threshold = datetime.now() - timedelta(minutes=VERIFICATION_CODE_EXPIRATION_MINUTES)
+
+    try:
+        result = await DB.verification_queue.delete_many({"expires_at": {"$exists": False},
+                                                          "timestamp": {"$lt": threshold}})
+        return result.deleted_count
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+
+async def acquire_lease(name: str, seconds: int) -> bool:
+    """
+    Take or renew a named lease shared by every worker, so only one of them runs a background job.
+
+    :param name: The name of the lease.
+    :param seconds: How long the lease is held without being renewed.
+    :return: True if this worker holds the lease.
+    """
+    now = datetime.now(timezone.utc)
+
+    try:
+        # Matches a free or expired lease, or one this worker already holds, otherwise the upsert collides on _id
+        await DB.leases.update_one(
+            {"_id": name, "$or": [{"expires_at": {"$lt": now}}, {"owner": WORKER_ID}]},
+            {"$set": {"owner": WORKER_ID, "expires_at": now + timedelta(seconds=seconds)}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+async def release_lease(name: str) -> None:
+    """
+    Give up a lease this worker holds, so another worker can take it right away instead of waiting for it to expire.
+
+    :param name: The name of the lease.
+    """
+    try:
+        await DB.leases.delete_one({"_id": name, "owner": WORKER_ID})
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+
 # === MAIN FLOW ===
+@metrics.timed
 async def email_verification_queue(email: str) -> None:
     """
     Add the user into a email verification queue and sends a verification code to the user's email,
@@ -104,18 +619,30 @@ async def email_verification_queue(email: str) -> None:
     verification_code = generate_numerical_verification_code()
 
     try:
-        await DB.verification_queue.replace_one(
+        previous = await DB.verification_queue.find_one_and_replace(
             {"email": email},
-            {"email": email, "verification_code": verification_code, "timestamp": datetime.now()},
+            {"email": email, "verification_code": verification_code, "timestamp": datetime.now(),
+             "expires_at": datetime.now(timezone.utc) + timedelta(minutes=VERIFICATION_CODE_EXPIRATION_MINUTES)},
             upsert=True
         )
 
-        # Send the verification email
-        send_verification_email(email, verification_code)
+        # Queue the verification email, it is sent in the background
+        try:
+            mailer.enqueue_email(build_verification_email(email, verification_code))
+        except QueueFull:
+            # The new code is never sent, so the code the user already got keeps working (unless a newer request
+            # replaced it meanwhile)
+            current = {"email": email, "verification_code": verification_code}
+            if previous:
+                await DB.verification_queue.replace_one(current, previous)
+            else:
+                await DB.verification_queue.delete_one(current)
+            raise
     except OperationFailure as e:
         raise RuntimeError(str(e))
 
 
+@metrics.timed
 async def verify_email(email: str, verification_code: str) -> str:
     """
     Verify the user using the email and verification code.
@@ -139,21 +666,26 @@ async def verify_email(email: str, verification_code: str) -> str:
         if timestamp < datetime.now() - timedelta(minutes=VERIFICATION_CODE_EXPIRATION_MINUTES):
             raise ValueError("Verification code expired")
 
-        # Update or insert the user into the users collection
-        access_token = generate_access_token(email)
+        # Update or insert the user into the users collection.
+        # Signed access tokens are verified without the database, so only the old format is stored.
+        if ACCESS_TOKEN_SIGNING_KEY_ID:
+            access_token = generate_signed_access_token(email)
+            access_tokens = []
+        else:
+            access_token = generate_access_token(email)
+            access_tokens = [{"accessToken": access_token, "timestamp": datetime.now()}]
 
         # Check if the user exists in the users collection
         existing_user = await DB.users.find_one({"email": email})
         if existing_user:
             # If the user is already existed, add the access accessToken to the user's access_token list
             # Why using list? Because this will allow the user to log in from multiple devices.
-            await DB.users.update_one({"email": email}, {
-                "$push": {"access_tokens": {"accessToken": access_token, "timestamp": datetime.now()}}})
+            if access_tokens:
+                await DB.users.update_one({"email": email}, {"$push": {"access_tokens": access_tokens[0]}})
         else:
             # If the user does not exist, insert the user into the users collection while adding the access accessToken
             username = email.split("@")[0]  # Default username is the email without the domain
-            await DB.users.insert_one({"email": email, "username": username,
-                                       "access_tokens": [{"accessToken": access_token, "timestamp": datetime.now()}],
+            await DB.users.insert_one({"email": email, "username": username, "access_tokens": access_tokens,
                                        "color": pick_random_color(), "initial": make_initials(username)})
 
         # Delete the user from the verification queue
@@ -164,14 +696,28 @@ async def verify_email(email: str, verification_code: str) -> str:
         raise RuntimeError(str(e))
 
 
+@metrics.timed
 async def validate_access_token(access_token: str) -> dict[str, str]:
     """
     Validate the access accessToken by checking if the access accessToken is in the user's access_token list.
+    Recently validated access tokens are served from memory, and their "last used" timestamp is written later in bulk.
+    Signed access tokens are verified by their signature instead, only the user profile is looked up (and cached).
 
     :param access_token: The access accessToken to validate.
     :return: A dictionary containing the email, username, color, and initial of the user.
     """
-    if not access_token or not is_access_token_valid(access_token):
+    if not access_token:
+        raise ValueError("Invalid access accessToken")
+
+    if access_token.startswith(SIGNED_ACCESS_TOKEN_PREFIX):
+        claims = verify_signed_access_token(access_token)
+        return await get_user_profile(claims["email"])
+
+    user = get_cached_access_token(access_token)
+    if user:
+        return user
+
+    if not is_access_token_valid(access_token):
         raise ValueError("Invalid access accessToken")
 
     # Split the access accessToken to get the email
@@ -187,21 +733,27 @@ async def validate_access_token(access_token: str) -> dict[str, str]:
 
         token_info = user["access_tokens"][0]
 
-        # Check if the access accessToken is expired (30 days from last usage)
+        # Check if the access accessToken is expired (30 days from last usage), a pending touch is newer than the DB
+        last_used = max(token_info["timestamp"], PENDING_TOKEN_TOUCHES.get(access_token, (email, datetime.min))[1])
         expiration_threshold = datetime.now() - timedelta(days=ACCESS_TOKEN_EXPIRATION_DAYS)
-        if token_info["timestamp"] < expiration_threshold:
+        if last_used < expiration_threshold:
             raise ValueError("Access accessToken expired")
 
-        # Update the timestamp of the access accessToken
-        await DB.users.update_one({"email": email, "access_tokens.accessToken": access_token},
-                                  {"$set": {"access_tokens.$.timestamp": datetime.now()}}, upsert=True)
+        user_data = {"email": user["email"], "username": user["username"], "color": user["color"],
+                     "initial": user["initial"]}
 
-        return {"email": user["email"], "username": user["username"], "color": user["color"],
-                "initial": user["initial"]}
+        # Update the timestamp of the access accessToken, written with the next flush
+        touch_access_token(access_token, email)
+        TOKEN_CACHE[access_token] = {"user": user_data, "last_used": datetime.now(), "cached_at": monotonic()}
+        while len(TOKEN_CACHE) > TOKEN_CACHE_SIZE:
+            TOKEN_CACHE.popitem(last=False)
+
+        return dict(user_data)
     except OperationFailure as e:
         raise RuntimeError(str(e))
 
 
+@metrics.timed
 async def change_username(email: str, new_username: str) -> None:
     """
     Change the username of the user.
@@ -215,13 +767,90 @@ async def change_username(email: str, new_username: str) -> None:
     try:
         await DB.users.update_one({"email": email},
                                   {"$set": {"username": new_username, "initial": make_initials(new_username)}})
+        # The other workers drop theirs when the comment hub sees the update
+        invalidate_cached_user(email)
+
+        # Pages resolve their authors on read, so every location the user commented on has new pages now
+        locations = await DB.comment_items.distinct("location", {"author": email})
+        if locations:
+            await DB.comments.update_many({"location": {"$in": locations}}, {"$inc": {"revision": 1}})
+            if VERSION_LISTENERS:
+                async for location_data in DB.comments.find({"location": {"$in": locations}},
+                                                            {"location": 1, "max_comment_id": 1, "revision": 1}):
+                    for listener in VERSION_LISTENERS:
+                        listener(location_data["location"], location_data.get("max_comment_id", -1),
+                                 location_data.get("revision", 0))
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+
+@metrics.timed
+async def revoke_access_token(access_token: str) -> None:
+    """
+    Revoke an access token (sign out). Signed access tokens are added to the denylist until they expire. Old access
+    tokens are removed from the user, and added to the denylist for as long as other workers may have them cached.
+
+    :param access_token: The access token to revoke.
+    """
+    if not access_token:
+        raise ValueError("Invalid access accessToken")
+
+    try:
+        if access_token.startswith(SIGNED_ACCESS_TOKEN_PREFIX):
+            claims = verify_signed_access_token(access_token)
+            # TTL indexes compare against UTC, so the expiration is stored as UTC
+            expires_at = datetime.fromtimestamp(claims["iat"], timezone.utc) + timedelta(
+                days=ACCESS_TOKEN_EXPIRATION_DAYS)
+
+            await DB.revoked_tokens.update_one({"jti": claims["jti"]},
+                                               {"$set": {"jti": claims["jti"], "expires_at": expires_at}}, upsert=True)
+            REVOKED_ACCESS_TOKENS[claims["jti"]] = expires_at
+            return
+
+        if not is_access_token_valid(access_token):
+            raise ValueError("Invalid access accessToken")
+
+        email = decode_access_token(access_token).split("_")[1]
+        await DB.users.update_one({"email": email}, {"$pull": {"access_tokens": {"accessToken": access_token}}})
+        TOKEN_CACHE.pop(access_token, None)
+        PENDING_TOKEN_TOUCHES.pop(access_token, None)
+
+        # The other workers check the denylist on every cache hit, once their cache expires the lookup fails anyway
+        fingerprint = get_access_token_fingerprint(access_token)
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=TOKEN_CACHE_TTL_SECONDS)
+        await DB.revoked_tokens.update_one({"jti": fingerprint},
+                                           {"$set": {"jti": fingerprint, "expires_at": expires_at}}, upsert=True)
+        REVOKED_ACCESS_TOKENS[fingerprint] = expires_at
     except OperationFailure as e:
         raise RuntimeError(str(e))
 
 
+async def refresh_revoked_access_tokens() -> None:
+    """
+    Periodically reload the denylist of access tokens, so revocations made by other workers are picked up within
+    REVOCATION_REFRESH_SECONDS.
+    """
+    global REVOKED_ACCESS_TOKENS
+
+    while True:
+        try:
+            revoked = {}
+            async for token in DB.revoked_tokens.find({"expires_at": {"$gt": datetime.now(timezone.utc)}},
+                                                      {"_id": 0, "jti": 1, "expires_at": 1}):
+                revoked[token["jti"]] = token["expires_at"]
+            REVOKED_ACCESS_TOKENS = revoked
+        except Exception as e:
+            logger.exception("Loading revoked access tokens failed: %s", e)
+
+        await sleep(REVOCATION_REFRESH_SECONDS)
+
+
+@metrics.timed
 async def post_comment(email: str, username: str, color: str, initial: str, location: str, comment: str) -> None:
     """
     Post a comment to the database.
+    Comments of signed in users store a reference to their author, the profile is resolved when they are read, so a
+    new username shows on every comment. Anonymous comments store the author fields inline.
 
     :param email: The email of the user.
     :param username: The username of the user.
@@ -230,109 +859,920 @@ async def post_comment(email: str, username: str, color: str, initial: str, loca
     :param location: The location of the user.
     :param comment: The comment to post.
     """
+    if email == ANONYMOUS_EMAIL:
+        author = {"email": email, "username": username, "color": color, "initial": initial}
+    else:
+        author = {"author": email}
+        # The comment is resolved right away by the live updates of this worker
+        cache_profile({"email": email, "username": username, "color": color, "initial": initial})
+
+    comment_data = {
+        **author,
+        "comment": comment,
+        "html": comment_renderer.render_comment(comment),
+        "date": datetime.now().strftime("%Y-%m-%d"),
+        "time": datetime.now().strftime("%H:%M:%S")
+    }
+
+    if COMMENT_BATCH_WINDOW_MS > 0:
+        await queue_comment(location, comment_data)
+        return
+
+    try:
+        comment_id = (await next_comment_ids(location, 1))[0]
+        comment_data = {"id": comment_id, **comment_data}
+
+        # Store the comment as its own document, then move the location's highest comment ID forward.
+        # The revision changes on every write, so it also catches comments that land below max_comment_id.
+        await DB.comment_items.insert_one({**comment_data, "location": location})
+        comment_cache.add(location, comment_data)
+        for listener in COMMENT_LISTENERS:
+            listener(location, "created", comment_data)
+        LOCATION_SUMMARY_CACHE.pop(location, None)
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+    await update_location_after_write(location, [comment_data])
+
+
+async def queue_comment(location: str, comment_data: dict) -> None:
+    """
+    Add a comment to the batch of its location and wait until the batch is written.
+    A batch is written COMMENT_BATCH_WINDOW_MS after its first comment, or as soon as it holds COMMENT_BATCH_MAX_SIZE.
+
+    :param location: The location of the comment.
+    :param comment_data: The comment without its ID.
+    """
+    future = get_running_loop().create_future()
+
+    batch = COMMENT_BATCHES.get(location)
+    if batch is None:
+        batch = COMMENT_BATCHES[location] = []
+        create_task(write_comment_batch_later(location, batch))
+
+    batch.append((comment_data, future))
+    if len(batch) >= COMMENT_BATCH_MAX_SIZE:
+        del COMMENT_BATCHES[location]
+        create_task(write_comment_batch(location, batch))
+
+    await future
+
+
+async def write_comment_batch_later(location: str, batch: list[tuple[dict, Future]]) -> None:
+    """
+    Write a batch once its window ends, unless it was already written because it filled up.
+
+    :param location: The location of the batch.
+    :param batch: The batch to write.
+    """
+    await sleep(COMMENT_BATCH_WINDOW_MS / 1000)
+    if COMMENT_BATCHES.get(location) is batch:
+        del COMMENT_BATCHES[location]
+        await write_comment_batch(location, batch)
+
+
+@metrics.timed
+async def write_comment_batch(location: str, batch: list[tuple[dict, Future]]) -> None:
+    """
+    Write a batch of comments to one location with one ID reservation, one insert and one location update.
+    Every caller gets the result of its own comment, a comment that fails does not fail the rest of the batch.
+
+    :param location: The location of the batch.
+    :param batch: The comments and the futures of their callers.
+    """
     try:
-        # Retrieve the current highest comment ID for the location
-        location_data = await DB.comments.find_one({"location": location}, {"max_comment_id": 1})
-        if location_data and "max_comment_id" in location_data:
-            max_id = location_data["max_comment_id"]
+        ids = await next_comment_ids(location, len(batch))
+        comments = [{"id": comment_id, **comment_data} for comment_id, (comment_data, _) in zip(ids, batch)]
+
+        errors = {}
+        try:
+            await DB.comment_items.insert_many([{**comment, "location": location} for comment in comments],
+                                               ordered=False)
+        except BulkWriteError as e:
+            errors = {error["index"]: error["errmsg"] for error in e.details.get("writeErrors", [])}
+            if not errors:
+                raise
+    except Exception as e:  # Any failure has to reach the callers, or they would wait forever
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(RuntimeError(str(e)))
+        return
+
+    written = [comment for index, comment in enumerate(comments) if index not in errors]
+    for comment in written:
+        comment_cache.add(location, comment)
+        for listener in COMMENT_LISTENERS:
+            listener(location, "created", comment)
+    LOCATION_SUMMARY_CACHE.pop(location, None)
+
+    if written:
+        await update_location_after_write(location, written)
+
+    for index, (_, future) in enumerate(batch):
+        if future.done():
+            continue
+        if index in errors:
+            future.set_exception(RuntimeError(errors[index]))
         else:
-            max_id = -1
-
-        comment_data = {
-            "id": max_id + 1,
-            "email": email,
-            "username": username,
-            "color": color,
-            "initial": initial,
-            "comment": comment,
-            "date": datetime.now().strftime("%Y-%m-%d"),
-            "time": datetime.now().strftime("%H:%M:%S")
-        }
-
-        # Update the location document with the new comment and increment the max_comment_id
-        await DB.comments.update_one(
-            {"location": location},
-            {
-                "$push": {"comments": comment_data},
-                "$set": {"max_comment_id": max_id + 1}
-            },
-            upsert=True
+            future.set_result(None)
+
+
+@metrics.timed
+async def edit_comment(email: str, location: str, comment_id: int, comment: str) -> dict | None:
+    """
+    Change the text of a comment, only its author can.
+
+    :param email: The email of the user.
+    :param location: The location of the comment.
+    :param comment_id: The ID of the comment.
+    :param comment: The new text.
+    :return: The edited comment with its author resolved, None if the user has no such comment (or it was deleted).
+    """
+    if not comment.strip():
+        raise ValueError("Comment can not be empty")
+
+    return await change_comment(email, location, comment_id, "edited", {
+        "comment": comment,
+        "html": comment_renderer.render_comment(comment),
+    })
+
+
+@metrics.timed
+async def delete_comment(email: str, location: str, comment_id: int) -> dict | None:
+    """
+    Delete a comment, only its author can. The comment is kept without its text, so the IDs of a location stay dense
+    and the pages built from them keep their size.
+
+    :param email: The email of the user.
+    :param location: The location of the comment.
+    :param comment_id: The ID of the comment.
+    :return: The deleted comment with its author resolved, None if the user has no such comment (or it was deleted).
+    """
+    return await change_comment(email, location, comment_id, "deleted", {"comment": "", "html": "", "deleted": True})
+
+
+async def change_comment(email: str, location: str, comment_id: int, event: str, changes: dict) -> dict | None:
+    """
+    Apply an edit or a delete to a comment of its author, and pass the new version to the caches and live updates.
+
+    :param email: The email of the user.
+    :param location: The location of the comment.
+    :param comment_id: The ID of the comment.
+    :param event: "edited" or "deleted".
+    :param changes: The fields to set.
+    :return: The changed comment with its author resolved, None if the user has no such comment.
+    """
+    if email == ANONYMOUS_EMAIL:
+        return None
+
+    try:
+        location_data = await DB.comments.find_one({"location": location}, {"layout": 1})
+        if not location_data:
+            return None
+        if location_data.get("layout") != COMMENT_LAYOUT_VERSION:
+            await migrate_location(location)
+
+        # edited_at changes on every edit, the change stream tells edits apart from other updates by it
+        changes = {**changes, "edited_at": datetime.now().isoformat()}
+        comment_data = await DB.comment_items.find_one_and_update(
+            {"location": location, "id": comment_id, "deleted": {"$ne": True},
+             "$or": [{"author": email}, {"email": email}]},
+            {"$set": changes},
+            projection=COMMENT_PROJECTION
         )
+        if comment_data is None:
+            return None
+        comment_data.update(changes)
+
+        # The buffer gets the change before the revision that tags it
+        comment_cache.update(location, comment_data)
+        for listener in COMMENT_LISTENERS:
+            listener(location, event, comment_data)
+        LOCATION_SUMMARY_CACHE.pop(location, None)
+
+        await update_location_version(location, {"$inc": {"revision": 1}})
+        if event == "deleted":
+            # A location without a counter yet counts its deleted comments when the counter is seeded
+            await DB.comments.update_one({"location": location, "comment_count": {"$exists": True}},
+                                         {"$inc": {"comment_count": -1}})
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+    return (await resolve_authors([comment_data]))[0]
+
+
+async def update_location_after_write(location: str, comments: list[dict]) -> None:
+    """
+    Move the highest comment ID, comment count and revision of a location forward after its comments were written.
+    The comments are stored already, so a failure is retried and then only logged: failing their callers would make
+    them post the same comments again. The next write to the location moves the highest comment ID forward anyway.
+
+    :param location: The location.
+    :param comments: The comments that were written, in increasing ID order.
+    """
+    for attempt in range(1, LOCATION_UPDATE_ATTEMPTS + 1):
+        try:
+            await update_location_version(location, {
+                "$max": {"max_comment_id": comments[-1]["id"]},
+                "$inc": {"comment_count": len(comments), "revision": 1},
+                "$setOnInsert": {"layout": COMMENT_LAYOUT_VERSION}
+            })
+            return
+        except Exception as e:
+            if attempt == LOCATION_UPDATE_ATTEMPTS:
+                logger.error("Moving location %s forward after writing %d comments failed: %s", location,
+                             len(comments), e)
+                return
+            await sleep(0.1 * attempt)
+
+
+async def update_location_version(location: str, update: dict) -> None:
+    """
+    Apply an update that moves the version (max_comment_id, revision) of a location forward, upserting the location.
+    Without change streams the new version is handed to VERSION_LISTENERS, with them the comment hub delivers it in
+    order with the comments.
+
+    :param location: The location.
+    :param update: The update, it has to $inc the revision.
+    """
+    if not VERSION_LISTENERS:
+        await DB.comments.update_one({"location": location}, update, upsert=True)
+        return
+
+    location_data = await DB.comments.find_one_and_update({"location": location}, update,
+                                                           {"max_comment_id": 1, "revision": 1}, upsert=True,
+                                                           return_document=ReturnDocument.AFTER)
+    for listener in VERSION_LISTENERS:
+        listener(location, location_data.get("max_comment_id", -1), location_data.get("revision", 0))
+
+
+async def next_comment_ids(location: str, count: int) -> list[int]:
+    """
+    Get the next comment IDs for a location, in increasing order.
+    With COMMENT_ID_BLOCK_SIZE above 1 they are handed out from a block reserved by this worker, a new block is only
+    reserved when the current one runs out. IDs left in a block when the worker stops are never used (gaps), and a
+    second worker with its own block would hand out IDs below ones already posted, which replays and pages that read
+    by ID would miss. So only the worker holding the comment ID lease hands out blocks, the others get their IDs one at
+    a time from the counter, as with a COMMENT_ID_BLOCK_SIZE of 1.
+
+    :param location: The location of the comments.
+    :param count: How many IDs to get.
+    :return: IDs that are unique within the location, higher than every ID handed out before.
+    """
+    if COMMENT_ID_BLOCK_SIZE == 1 or monotonic() >= COMMENT_ID_LEASE_EXPIRES:
+        first_id = await reserve_comment_ids(location, count)
+        return list(range(first_id, first_id + count))
+
+    lock = COMMENT_ID_LOCKS.setdefault(location, Lock())
+    async with lock:
+        ids = []
+        while len(ids) < count:
+            block = COMMENT_ID_BLOCKS.get(location)
+            if not block or block[0] >= block[1]:
+                size = max(COMMENT_ID_BLOCK_SIZE, count - len(ids))
+                start = await reserve_comment_ids(location, size)
+                block = COMMENT_ID_BLOCKS[location] = [start, start + size]
+
+            taken = min(block[1] - block[0], count - len(ids))
+            ids.extend(range(block[0], block[0] + taken))
+            block[0] += taken
+        return ids
+
+
+async def hold_comment_id_lease() -> None:
+    """
+    Take the lease for handing out comment ID blocks, needed when COMMENT_ID_BLOCK_SIZE is above 1, and keep renewing
+    it in the background. A lease left by a worker that stopped without releasing it is waited for until it expires.
+    If another worker still holds it, this worker posts without blocks and keeps trying to take it over.
+    """
+    if COMMENT_ID_BLOCK_SIZE == 1:
+        return
+
+    deadline = monotonic() + COMMENT_ID_LEASE_SECONDS
+    while not await renew_comment_id_lease():
+        if monotonic() >= deadline:
+            logger.warning("Another worker hands out comment ID blocks, this worker takes comment IDs one at a time, "
+                           "COMMENT_ID_BLOCK_SIZE above 1 is meant for a single worker")
+            break
+        await sleep(1)
+
+    create_task(keep_comment_id_lease())
+
+
+async def keep_comment_id_lease() -> None:
+    """
+    Renew the comment ID lease a few times per lease period, or try to take it over when another worker holds it.
+    When it could not be renewed in time, IDs are taken one at a time until it is taken back, and the blocks of this
+    worker are dropped then, another worker may have posted in between.
+    """
+    while True:
+        await sleep(COMMENT_ID_LEASE_SECONDS / 3)
+        held = monotonic() < COMMENT_ID_LEASE_EXPIRES
+        try:
+            if not await renew_comment_id_lease() and held:
+                logger.warning("Another worker took the comment ID lease, this worker takes comment IDs one at a time")
+        except Exception as e:
+            logger.exception("Renewing the comment ID lease failed: %s", e)
+
+
+async def renew_comment_id_lease() -> bool:
+    """
+    Take or renew the comment ID lease once.
+
+    :return: True if this worker holds the lease.
+    """
+    global COMMENT_ID_LEASE_EXPIRES
+
+    started = monotonic()
+    if not await acquire_lease("comment_ids", COMMENT_ID_LEASE_SECONDS):
+        return False
+
+    if started >= COMMENT_ID_LEASE_EXPIRES:
+        COMMENT_ID_BLOCKS.clear()
+    COMMENT_ID_LEASE_EXPIRES = started + COMMENT_ID_LEASE_SECONDS
+    return True
+
+
+async def release_comment_id_lease() -> None:
+    """
+    Give up the comment ID lease when the worker stops, so a restarted worker does not have to wait for it.
+    """
+    global COMMENT_ID_LEASE_EXPIRES
+
+    if COMMENT_ID_LEASE_EXPIRES:
+        COMMENT_ID_LEASE_EXPIRES = 0.0
+        await release_lease("comment_ids")
+
+
+@metrics.timed
+async def reserve_comment_ids(location: str, count: int) -> int:
+    """
+    Atomically reserve a block of comment IDs for a location using the next_comment_id counter.
+
+    :param location: The location of the comment.
+    :param count: How many IDs to reserve.
+    :return: The first reserved ID, the block is [first, first + count).
+    """
+    try:
+        while True:
+            location_data = await DB.comments.find_one_and_update(
+                {"location": location, "next_comment_id": {"$exists": True}, "comment_count": {"$exists": True}},
+                {"$inc": {"next_comment_id": count}},
+                {"next_comment_id": 1},
+                return_document=ReturnDocument.AFTER
+            )
+            if location_data:
+                return location_data["next_comment_id"] - count
+
+            # First reservation for this location, seed the counter from the highest comment ID written so far.
+            # The seed is conditional, so when two workers race only one of them sets it and both retry the $inc.
+            location_data = await DB.comments.find_one_and_update(
+                {"location": location},
+                {"$setOnInsert": {"layout": COMMENT_LAYOUT_VERSION}},
+                {"max_comment_id": 1, "comment_count": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            await DB.comments.update_one(
+                {"location": location, "next_comment_id": {"$exists": False}},
+                {"$set": {"next_comment_id": location_data.get("max_comment_id", -1) + 1}}
+            )
+            if "comment_count" not in location_data:
+                await seed_comment_count(location)
     except OperationFailure as e:
         raise RuntimeError(str(e))
 
 
-async def get_comments(location: str, comment_per_page: int, page: int, latest_first: bool) -> list[dict]:
+async def seed_comment_count(location: str) -> int:
+    """
+    Set the comment counter of a location that has none yet, from the comments it already has.
+    No comment is counted twice: posts only get an ID, and count themselves, once the counter exists.
+
+    :param location: The location to count.
+    :return: The number of comments of the location that are not deleted.
+    """
+    try:
+        count = await DB.comment_items.count_documents({"location": location, "deleted": {"$ne": True}})
+
+        # Comments still in the legacy array are counted too, unless a migration already copied them
+        location_data = await DB.comments.find_one({"location": location}, {"comments.id": 1})
+        legacy_ids = [comment["id"] for comment in (location_data or {}).get("comments", [])]
+        if legacy_ids:
+            count += len(legacy_ids) - await DB.comment_items.count_documents(
+                {"location": location, "id": {"$in": legacy_ids}})
+
+        await DB.comments.update_one({"location": location, "comment_count": {"$exists": False}},
+                                     {"$set": {"comment_count": count}})
+        location_data = await DB.comments.find_one({"location": location}, {"comment_count": 1})
+        return location_data.get("comment_count", count) if location_data else count
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+
+@metrics.timed
+async def get_location_version(location: str) -> tuple[int, int]:
+    """
+    Get the version of a location's comments, a cheap lookup that changes whenever a comment of the location is
+    posted, edited or deleted, or one of its authors changes their profile.
+
+    :param location: The location to get the version of.
+    :return: A tuple of (max_comment_id, revision), (-1, 0) if the location has no comments.
+    """
+    try:
+        location_data = await DB.comments.find_one({"location": location},
+                                                   {"_id": 0, "max_comment_id": 1, "revision": 1})
+        if not location_data:
+            return -1, 0
+
+        return location_data.get("max_comment_id", -1), location_data.get("revision", 0)
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+
+@metrics.timed
+async def get_comments(location: str, comment_per_page: int, page: int, latest_first: bool,
+                       before_id: int | None = None, after_id: int | None = None, render_html: bool = False,
+                       cached_profiles: bool = True) -> tuple[list[dict], int | None]:
     """
     Get the comments for a location with a range of IDs.
+    When a cursor (before_id or after_id) is given the page is taken right next to it and the page number is ignored,
+    so the cost of a page does not depend on how deep it is and new comments do not shift it.
 
     :param location: The location to get the comments from.
     :param comment_per_page: The number of comments per page.
     :param page: The page number.
     :param latest_first: True if the comments should be sorted from the latest, False otherwise. (highest ID first)
-    :return: A list of comments.
+    :param before_id: Only get comments with an ID lower than this, walking towards older comments.
+    :param after_id: Only get comments with an ID higher than this, walking towards newer comments.
+    :param render_html: True to include the rendered HTML of every comment.
+    :param cached_profiles: False to read the profiles of the authors instead of taking them from the profile cache.
+    :return: A tuple of the list of comments and the cursor for the next page (None if there are no more comments).
     """
     try:
         # Get the current highest comment ID for the location
-        location_data = await DB.comments.find_one({"location": location}, {"max_comment_id": 1})
-        if not location_data or "max_comment_id" not in location_data:
-            return []
+        location_data = await DB.comments.find_one({"location": location},
+                                                   {"max_comment_id": 1, "layout": 1})
+        if not location_data:
+            return [], None
+
+        # Locations that were not migrated yet are converted on their first read, by page or by cursor
+        if location_data.get("layout") != COMMENT_LAYOUT_VERSION:
+            await migrate_location(location)
+
+        if before_id is not None or after_id is not None:
+            return await get_comments_by_cursor(location, comment_per_page, latest_first, before_id, after_id,
+                                                render_html, cached_profiles)
+
+        if "max_comment_id" not in location_data:
+            return [], None
+
+        # The first newest first read of a location fills its buffer, the following reads are served from memory
+        if latest_first and comment_cache.begin_fill(location):
+            await fill_comment_cache(location)
 
         max_id = location_data["max_comment_id"]
 
-        # Calculate the range of IDs to get
+        # Calculate the range of IDs to get, and the cursor that continues right after it
         if latest_first:
             # For latest first, start from max_id and go backwards
             from_id = max_id + 1 - (page * comment_per_page)
             to_id = from_id + comment_per_page
             if from_id < 0:
                 from_id = 0
+            next_cursor = from_id if from_id > 0 else None  # Continue with before_id
         else:
             # For oldest first, start from 0 and go forwards
             from_id = (page - 1) * comment_per_page
             to_id = from_id + comment_per_page
             if to_id > max_id + 1:
                 to_id = max_id + 1
+            next_cursor = to_id - 1 if to_id <= max_id else None  # Continue with after_id
+
+        cursor = DB.comment_items.find(
+            {"location": location, "id": {"$gte": from_id, "$lt": to_id}},
+            COMMENT_PROJECTION if render_html else COMMENT_TEXT_PROJECTION
+        ).sort("id", -1 if latest_first else 1)
+        comments = await resolve_authors(await cursor.to_list(length=None), cached_profiles)
+        if render_html:
+            comments = [comment_renderer.present_comment(comment, True) for comment in comments]
+        return comments, next_cursor
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+
+@metrics.timed
+async def fill_comment_cache(location: str) -> None:
+    """
+    Read the newest comments of a location into the comment cache.
+
+    :param location: The location to cache.
+    """
+    try:
+        # The version is read first, so the buffer never claims a version its comments do not have yet
+        max_id, revision = await get_location_version(location)
+        cursor = DB.comment_items.find({"location": location}, COMMENT_PROJECTION) \
+            .sort("id", -1).limit(comment_cache.COMMENT_CACHE_SIZE)
+        comments = await cursor.to_list(length=None)
+        if comment_cache.REVISIONS_FROM_HUB:
+            # The profiles cached for these authors may miss a change the change stream has not brought yet, they are
+            # read again so pages served from the buffer can take them from the profile cache
+            await resolve_authors(comments, cached_profiles=False)
+        comment_cache.finish_fill(location, comments, max_id, revision)
+    except Exception:
+        comment_cache.discard(location)
+        raise
+
+
+async def get_comments_by_cursor(location: str, comment_per_page: int, latest_first: bool, before_id: int | None,
+                                 after_id: int | None, render_html: bool = False,
+                                 cached_profiles: bool = True) -> tuple[list[dict], int | None]:
+    """
+    Get the page of comments next to a cursor with a single index range query on (location, id).
+    The location has to be migrated already, get_comments takes care of that.
+
+    :param location: The location to get the comments from.
+    :param comment_per_page: The number of comments per page.
+    :param latest_first: True if the comments should be sorted from the latest, False otherwise. (highest ID first)
+    :param before_id: Only get comments with an ID lower than this, walking towards older comments.
+    :param after_id: Only get comments with an ID higher than this, walking towards newer comments.
+    :param render_html: True to include the rendered HTML of every comment.
+    :param cached_profiles: False to read the profiles of the authors instead of taking them from the profile cache.
+    :return: A tuple of the list of comments and the cursor for the next page (None if there are no more comments).
+    """
+    id_range = {}
+    if before_id is not None:
+        id_range["$lt"] = before_id
+    if after_id is not None:
+        id_range["$gt"] = after_id
+
+    # Walk away from the cursor so the page holds the comments closest to it
+    descending = before_id is not None
+
+    cursor = DB.comment_items.find(
+        {"location": location, "id": id_range},
+        COMMENT_PROJECTION if render_html else COMMENT_TEXT_PROJECTION
+    ).sort("id", -1 if descending else 1).limit(comment_per_page)
+    comments = await resolve_authors(await cursor.to_list(length=None), cached_profiles)
+    if render_html:
+        comments = [comment_renderer.present_comment(comment, True) for comment in comments]
+
+    # A short page means the end of the thread was reached
+    next_cursor = comments[-1]["id"] if len(comments) == comment_per_page else None
+
+    if descending != latest_first:
+        comments.reverse()
 
+    return comments, next_cursor
+
+
+@metrics.timed
+async def search_comments(location: str, query: str, limit: int, order: str, after_score: float | None,
+                          after_id: int | None, render_html: bool = False) -> tuple[list[dict], float | None]:
+    """
+    Search the comments of a location with the text index on (location, comment).
+    Results continue after a cursor (the score and ID of the last result of the previous page), so every page is
+    one query no matter how deep it is.
+
+    :param location: The location to search in.
+    :param query: The words to search for, a comment matches if it contains any of them.
+    :param limit: The number of comments per page.
+    :param order: "relevance" for the best matches first, "recent" for the newest first.
+    :param after_score: The score of the last result of the previous page, only with order "relevance".
+    :param after_id: The ID of the last result of the previous page, None for the first page.
+    :param render_html: True to include the rendered HTML of every comment.
+    :return: A tuple of the comments and the score of the last one (None with order "recent"), a page shorter than
+             the limit is the last one.
+    """
+    pipeline = [{"$match": {"location": location, "$text": {"$search": query}}}]
+
+    if order == "relevance":
+        pipeline.append({"$addFields": {"score": {"$meta": "textScore"}}})
+        if after_id is not None:
+            pipeline.append({"$match": {"$or": [{"score": {"$lt": after_score}},
+                                                {"score": after_score, "id": {"$lt": after_id}}]}})
+        pipeline.append({"$sort": {"score": -1, "id": -1}})
+    else:
+        if after_id is not None:
+            pipeline.append({"$match": {"id": {"$lt": after_id}}})
+        pipeline.append({"$sort": {"id": -1}})
+
+    pipeline += [{"$limit": limit}, {"$project": COMMENT_PROJECTION if render_html else COMMENT_TEXT_PROJECTION}]
+
+    try:
+        comments = await DB.comment_items.aggregate(pipeline).to_list(length=None)
+    except OperationFailure as e:
+        raise RuntimeError(str(e))
+
+    last_score = comments[-1].get("score") if comments else None
+    for comment in comments:
+        comment.pop("score", None)
+
+    comments = await resolve_authors(comments)
+    if render_html:
+        comments = [comment_renderer.present_comment(comment, True) for comment in comments]
+    return comments, last_score
+
+
+@metrics.timed
+async def get_location_summaries(locations: list[str], include_latest: bool) -> dict[str, dict]:
+    """
+    Get the comment count, and optionally the latest comment, of many locations at once.
+    Locations read in the last LOCATION_SUMMARY_TTL_SECONDS are served from memory, the others are read with a
+    single aggregation that joins the newest comment of each location through the (location, id) index.
+
+    :param locations: The locations to summarize, at most LOCATION_SUMMARY_MAX_LOCATIONS.
+    :param include_latest: True to include the latest comment of every location.
+    :return: A dictionary of location -> {"max_comment_id", "count"[, "latest"]}, count leaves out deleted comments.
+             Locations without comments have max_comment_id -1, count 0 and latest None.
+    """
+    locations = list(dict.fromkeys(locations))
+    if len(locations) > LOCATION_SUMMARY_MAX_LOCATIONS:
+        raise ValueError(f"At most {LOCATION_SUMMARY_MAX_LOCATIONS} locations can be summarized at once")
+
+    summaries = {}
+    missing = []
+    for location in locations:
+        cached = LOCATION_SUMMARY_CACHE.get(location)
+        if cached and (cached["with_latest"] or not include_latest) and \
+                monotonic() - cached["cached_at"] <= LOCATION_SUMMARY_TTL_SECONDS:
+            LOCATION_SUMMARY_CACHE.move_to_end(location)
+            summaries[location] = cached["summary"]
+        else:
+            missing.append(location)
+
+    if missing:
         pipeline = [
-            {"$match": {"location": location}},
-            {"$unwind": "$comments"},
-            {"$match": {"comments.id": {"$gte": from_id, "$lt": to_id}}},
-            {"$sort": {"comments.id": -1 if latest_first else 1}},
-            {"$replaceRoot": {"newRoot": "$comments"}}
+            {"$match": {"location": {"$in": missing}}},
+            {"$project": {"_id": 0, "location": 1, "max_comment_id": 1, "comment_count": 1, "layout": 1}},
         ]
+        # The in-memory stand-in can not join with a pipeline, its latest comments are read one location at a time
+        if include_latest and MONGODB_BACKEND != "memory":
+            pipeline.append({"$lookup": {
+                "from": "comment_items",
+                "let": {"location": "$location"},
+                "pipeline": [{"$match": {"$expr": {"$eq": ["$location", "$$location"]}, "deleted": {"$ne": True}}},
+                             {"$sort": {"id": -1}}, {"$limit": 1}, {"$project": COMMENT_TEXT_PROJECTION}],
+                "as": "latest"
+            }})
 
-        cursor = DB.comments.aggregate(pipeline)
-        comments = await cursor.to_list(length=None)
-        return comments
+        try:
+            found = {location_data["location"]: location_data
+                     async for location_data in DB.comments.aggregate(pipeline)}
+
+            for location in missing:
+                location_data = found.get(location, {})
+                max_id = location_data.get("max_comment_id", -1)
+                # Deleted comments and unused IDs leave gaps, so the count is kept apart from the highest ID
+                count = location_data.get("comment_count")
+                if count is None:
+                    count = await seed_comment_count(location) if location_data else 0
+                summary = {"max_comment_id": max_id, "count": count}
+
+                if include_latest:
+                    latest = location_data.get("latest")
+                    # Locations that were not migrated yet have no comment documents to join
+                    if max_id >= 0 and location_data.get("layout") != COMMENT_LAYOUT_VERSION:
+                        await migrate_location(location)
+                        latest = None
+                    if max_id >= 0 and latest is None:
+                        latest = await DB.comment_items.find({"location": location, "deleted": {"$ne": True}},
+                                                             COMMENT_TEXT_PROJECTION) \
+                            .sort("id", -1).limit(1).to_list(length=None)
+                    summary["latest"] = latest[0] if latest else None
+
+                summaries[location] = summary
+                LOCATION_SUMMARY_CACHE[location] = {"summary": summary, "with_latest": include_latest,
+                                                    "cached_at": monotonic()}
+        except OperationFailure as e:
+            raise RuntimeError(str(e))
+
+        while len(LOCATION_SUMMARY_CACHE) > LOCATION_SUMMARY_CACHE_SIZE:
+            LOCATION_SUMMARY_CACHE.popitem(last=False)
+
+    if not include_latest:
+        # Callers that did not ask for the latest comment do not get one from a cached summary either
+        return {location: {key: value for key, value in summaries[location].items() if key != "latest"}
+                for location in locations}
+
+    # Summaries are cached with the author references, so a new username shows up right away
+    latest = [summaries[location]["latest"] for location in locations]
+    resolved = iter(await resolve_authors([comment for comment in latest if comment]))
+    return {location: {**summaries[location], "latest": next(resolved) if comment else None}
+            for location, comment in zip(locations, latest)}
+
+
+# === ACCESS TOKEN CACHE ===
+def get_cached_access_token(access_token: str) -> dict[str, str] | None:
+    """
+    Get the user of an access token that was validated recently, and mark the access token as used.
+
+    :param access_token: The access token to look up.
+    :return: The user data, or None if the access token has to be validated against the database.
+    """
+    cached = TOKEN_CACHE.get(access_token)
+    if not cached or monotonic() - cached["cached_at"] > TOKEN_CACHE_TTL_SECONDS:
+        TOKEN_CACHE_STATS["misses"] += 1
+        return None
+
+    # Signed out on another worker
+    if REVOKED_ACCESS_TOKENS and get_access_token_fingerprint(access_token) in REVOKED_ACCESS_TOKENS:
+        del TOKEN_CACHE[access_token]
+        TOKEN_CACHE_STATS["misses"] += 1
+        return None
+
+    # Expired while cached, let the database lookup decide
+    if cached["last_used"] < datetime.now() - timedelta(days=ACCESS_TOKEN_EXPIRATION_DAYS):
+        del TOKEN_CACHE[access_token]
+        TOKEN_CACHE_STATS["misses"] += 1
+        return None
+
+    TOKEN_CACHE_STATS["hits"] += 1
+    TOKEN_CACHE.move_to_end(access_token)
+    cached["last_used"] = datetime.now()
+    touch_access_token(access_token, cached["user"]["email"])
+
+    return dict(cached["user"])
+
+
+def invalidate_cached_user(email: str) -> None:
+    """
+    Drop the cached access tokens and profile of a user whose profile changed.
+
+    :param email: The email of the user.
+    """
+    invalidate_cached_access_tokens(email)
+    PROFILE_CACHE.pop(email, None)
+
+
+def clear_cached_users() -> None:
+    """
+    Drop every cached access token and profile, for when profile changes of other workers may have been missed.
+    """
+    TOKEN_CACHE.clear()
+    PROFILE_CACHE.clear()
+
+
+def invalidate_cached_access_tokens(email: str) -> None:
+    """
+    Drop every cached access token of a user, so the next request reads the changed user data.
+
+    :param email: The email of the user.
+    """
+    for access_token in [token for token, cached in TOKEN_CACHE.items() if cached["user"]["email"] == email]:
+        del TOKEN_CACHE[access_token]
+
+
+def touch_access_token(access_token: str, email: str) -> None:
+    """
+    Remember that an access token was used now, the timestamp is written by the next flush.
+
+    :param access_token: The access token that was used.
+    :param email: The email of the owner of the access token.
+    """
+    PENDING_TOKEN_TOUCHES[access_token] = (email, datetime.now())
+
+
+async def flush_access_token_touches() -> None:
+    """
+    Periodically write the pending "last used" timestamps of access tokens.
+    """
+    while True:
+        await sleep(TOKEN_TOUCH_FLUSH_SECONDS)
+        await write_access_token_touches()
+
+
+@metrics.timed
+async def write_access_token_touches() -> int:
+    """
+    Write every pending "last used" timestamp in one unordered bulk write.
+
+    :return: The number of access tokens written.
+    """
+    global PENDING_TOKEN_TOUCHES
+
+    if not PENDING_TOKEN_TOUCHES:
+        return 0
+
+    # Swap the pending touches first, so the ones made during the write wait for the next flush
+    touches, PENDING_TOKEN_TOUCHES = PENDING_TOKEN_TOUCHES, {}
+
+    try:
+        await DB.users.bulk_write([
+            UpdateOne({"email": email, "access_tokens.accessToken": access_token},
+                      {"$max": {"access_tokens.$.timestamp": timestamp}})
+            for access_token, (email, timestamp) in touches.items()
+        ], ordered=False)
+        return len(touches)
+    except Exception as e:
+        logger.exception("Writing access token timestamps failed: %s", e)
+
+        # Keep them for the next flush, without overwriting newer touches
+        for access_token, touch in touches.items():
+            PENDING_TOKEN_TOUCHES.setdefault(access_token, touch)
+        return 0
+
+
+@metrics.timed
+async def get_user_profile(email: str) -> dict[str, str]:
+    """
+    Get the public profile of a user, served from memory when it was read recently.
+
+    :param email: The email of the user.
+    :return: A dictionary containing the email, username, color, and initial of the user.
+    """
+    profile = get_cached_profile(email)
+    if profile:
+        return dict(profile)
+
+    try:
+        profile = await DB.users.find_one({"email": email}, PROFILE_PROJECTION)
     except OperationFailure as e:
         raise RuntimeError(str(e))
+    if not profile:
+        raise ValueError("User not found")
 
+    cache_profile(profile)
+    return dict(profile)
 
-async def get_latest_comments_ws(location: str, websocket: WebSocket) -> None:
+
+@metrics.timed
+async def resolve_authors(comments: list[dict], cached_profiles: bool = True) -> list[dict]:
     """
-    Get the latest comments for a location and send it to the WebSocket. (for real-time updates)
+    Replace the author reference of comments with the current profile of their author.
+    Profiles come from the profile cache, the ones missing from it are read with a single $in query.
 
-    :param location: The location to get the comments from.
-    :param websocket: The WebSocket to send the comments to.
-    """
-    pipeline = [
-        {"$match": {
-            "operationType": {"$in": ["update", "insert"]},
-            "ns.coll": "comments",
-            "fullDocument.location": location
-        }}
-    ]
+    :param comments: The comments as stored, they are not modified.
+    :param cached_profiles: False to read every profile, when the cached ones may miss a change of another worker.
+    :return: The comments with the email, username, color and initial of their author, in the same order.
+    """
+    profiles = {}
+    missing = set()
+    for comment in comments:
+        email = comment.get("author")
+        if email is None or email in profiles:
+            continue
+
+        profile = get_cached_profile(email) if cached_profiles else None
+        if profile:
+            profiles[email] = profile
+        else:
+            missing.add(email)
+
+    if missing:
+        try:
+            async for profile in DB.users.find({"email": {"$in": list(missing)}}, PROFILE_PROJECTION):
+                profiles[profile["email"]] = profile
+                cache_profile(profile)
+        except OperationFailure as e:
+            raise RuntimeError(str(e))
+
+    resolved = []
+    for comment in comments:
+        email = comment.get("author")
+        if email is None:  # Anonymous, and comments written before authors were referenced
+            resolved.append(comment)
+            continue
+
+        profile = profiles.get(email) or {"email": email, **MISSING_AUTHOR}
+        resolved.append({"id": comment["id"], **profile,
+                         **{key: value for key, value in comment.items() if key not in ("id", "author")}})
+    return resolved
+
+
+def get_cached_profile(email: str) -> dict[str, str] | None:
+    """
+    Get a profile from the profile cache, if it was read in the last TOKEN_CACHE_TTL_SECONDS.
 
-    async with DB.comments.watch(pipeline, full_document='updateLookup') as stream:
-        async for change in stream:
-            # Check if we have a full document and if it contains comments
-            if "fullDocument" in change and "comments" in change["fullDocument"]:
-                comments = change["fullDocument"]["comments"]
-                if comments:
-                    # Get and send only the most recently added comment
-                    latest_comment = comments[-1]
-                    await websocket.send_json(latest_comment)
+    :param email: The email of the user.
+    :return: The profile, None if it is not cached. It must not be modified.
+    """
+    cached = PROFILE_CACHE.get(email)
+    if not cached or monotonic() - cached["cached_at"] > TOKEN_CACHE_TTL_SECONDS:
+        return None
+
+    PROFILE_CACHE.move_to_end(email)
+    return cached["profile"]
+
+
+def cache_profile(profile: dict[str, str]) -> None:
+    """
+    Put a profile in the profile cache, dropping the least recently used ones past TOKEN_CACHE_SIZE.
+
+    :param profile: The email, username, color and initial of the user.
+    """
+    PROFILE_CACHE[profile["email"]] = {"profile": profile, "cached_at": monotonic()}
+    PROFILE_CACHE.move_to_end(profile["email"])
+    while len(PROFILE_CACHE) > TOKEN_CACHE_SIZE:
+        PROFILE_CACHE.popitem(last=False)
+
+
+def get_access_token_cache_stats() -> dict[str, int]:
+    """
+    Get the counters of the access token cache.
+
+    :return: A dictionary containing the hits, misses, size and pending timestamp writes of the cache.
+    """
+    return {**TOKEN_CACHE_STATS, "size": len(TOKEN_CACHE), "pending_touches": len(PENDING_TOKEN_TOUCHES)}
 
 
 # === HELPERS ===
@@ -358,17 +1798,16 @@ def generate_numerical_verification_code(length: int = 6) -> str:
     return ''.join(choice("0123456789") for _ in range(length))
 
 
-def send_verification_email(email: str, verification_code: str) -> None:
+def build_verification_email(email: str, verification_code: str) -> dict[str, str]:
     """
-    Function to send a verification email to the user.
-    INFO: This function should be modified to use your own email service.
+    Build the verification email for the user, it is sent by the email workers in app/mailer.py.
+    INFO: This function should be modified to match your own email service.
 
     :param email: The email to send the verification email to.
     :param verification_code: The verification code to include in the email.
+    :return: The email as {"recipient", "subject", "plain", "html"}.
     """
-    # INFO: This is my own internal service, so the URL is hardcoded
-    url = "http://192.168.1.99:29998/email"
-    data = {
+    return {
         "recipient": email,
         "subject": "Rei's Comment Section - Verify your email",
         "plain": "Your Verification Code is: " + verification_code,
@@ -376,11 +1815,6 @@ def send_verification_email(email: str, verification_code: str) -> None:
             VERIFICATION_CODE_EXPIRATION_MINUTES) + " minutes.</p> <p style=\"color: #777;\">If you didn\'t request this code, please ignore this email.</p> </td> </tr> <tr> <td align=\"center\" style=\"padding-top: 20px; border-top: 1px solid #ddd;\"> <p style=\"font-size: 12px; color: #777;\"> Need help? Contact me at <a href=\"mailto:akbar@reishandy.my.id\" style=\"color: #007bff; text-decoration: none;\">akbar@reishandy.my.id</a> </p> <p style=\"font-size: 12px; color: #888;\"> <em>Legal Disclaimer:</em> This email may contain confidential information. If you are not the intended recipient, please delete it immediately. </p> </td> </tr></table>"
     }
 
-    # Send the data using a requests's POST
-    response = post(url, json=data)
-    if response.status_code != 201:
-        raise RuntimeError("Failed to send verification email")
-
 
 def generate_access_token(email: str) -> str:
     """
@@ -393,6 +1827,81 @@ def generate_access_token(email: str) -> str:
     return base64.urlsafe_b64encode(token.encode("utf-8")).decode("utf-8")
 
 
+def generate_signed_access_token(email: str) -> str:
+    """
+    Generate a signed access token, "v2.<key id>.<payload>.<signature>", with the email, issue time and a random token
+    ID as the payload. It can be verified with the signing key alone, without a database lookup.
+
+    :param email: The email of the user.
+    :return: A signed access token as a string.
+    """
+    payload = encode_base64url(dumps({"email": email, "iat": int(time()), "jti": token_hex(16)}).encode("utf-8"))
+    signing_input = f"{SIGNED_ACCESS_TOKEN_PREFIX}{ACCESS_TOKEN_SIGNING_KEY_ID}.{payload}"
+    signature = new_hmac(ACCESS_TOKEN_SIGNING_KEYS[ACCESS_TOKEN_SIGNING_KEY_ID], signing_input.encode("utf-8"), sha256)
+    return f"{signing_input}.{encode_base64url(signature.digest())}"
+
+
+def verify_signed_access_token(access_token: str) -> dict:
+    """
+    Verify the signature, expiration and revocation of a signed access token.
+
+    :param access_token: The signed access token to verify.
+    :return: The payload of the access token.
+    """
+    try:
+        _, key_id, payload, signature = access_token.split(".")
+    except ValueError:
+        raise ValueError("Invalid access accessToken")
+
+    key = ACCESS_TOKEN_SIGNING_KEYS.get(key_id)
+    if not key:
+        raise ValueError("Invalid access accessToken")
+
+    signing_input = f"{SIGNED_ACCESS_TOKEN_PREFIX}{key_id}.{payload}"
+    expected_signature = new_hmac(key, signing_input.encode("utf-8"), sha256).digest()
+    # Compared as bytes, compare_digest refuses strings with characters outside ASCII
+    if not compare_digest(signature.encode("utf-8"), encode_base64url(expected_signature).encode("utf-8")):
+        raise ValueError("Invalid access accessToken")
+
+    claims = loads(decode_base64url(payload))
+    if claims["iat"] < time() - ACCESS_TOKEN_EXPIRATION_DAYS * 86400:
+        raise ValueError("Access accessToken expired")
+    if claims["jti"] in REVOKED_ACCESS_TOKENS:
+        raise ValueError("Access accessToken revoked")
+
+    return claims
+
+
+def get_access_token_fingerprint(access_token: str) -> str:
+    """
+    Get the key of an old format access token in the denylist, so the access token itself is not stored there.
+
+    :param access_token: The access token.
+    :return: The SHA-256 hex digest of the access token.
+    """
+    return sha256(access_token.encode("utf-8")).hexdigest()
+
+
+def encode_base64url(data: bytes) -> str:
+    """
+    Encode bytes as unpadded URL safe base64.
+
+    :param data: The bytes to encode.
+    :return: The encoded string.
+    """
+    return base64.urlsafe_b64encode(data).decode("utf-8").rstrip("=")
+
+
+def decode_base64url(data: str) -> bytes:
+    """
+    Decode unpadded URL safe base64.
+
+    :param data: The string to decode.
+    :return: The decoded bytes.
+    """
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
 def decode_access_token(access_token: str) -> str:
     """
     Decode the access accessToken to get the email.
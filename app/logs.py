@@ -0,0 +1,193 @@
+from contextvars import ContextVar
+from datetime import datetime
+from logging import INFO, WARNING, Formatter, LogRecord, StreamHandler, getLogger, getLevelName
+from logging.handlers import QueueHandler, QueueListener
+from os import getenv
+from queue import Full, Queue
+from sys import stdout
+from time import perf_counter
+from uuid import uuid4
+
+from orjson import dumps
+
+import app.metrics as metrics
+
+LOG_LEVEL: str = "INFO"  # Level of every logger without its own level in LOG_LEVELS
+LOG_LEVELS: str = ""  # Per-module levels, comma separated <logger>=<level>, for example app.database=DEBUG
+LOG_QUEUE_SIZE: int = 10000  # Records waiting for the writer thread, records that do not fit are dropped
+
+# Attributes copied from a record into its JSON line when they are set, passed with extra={...} or by the request
+LOG_FIELDS: tuple[str, ...] = ("request_id", "method", "route", "location", "status", "duration_ms")
+
+# The request handled by the current task, {"request_id", "scope"}, set by RequestLoggingMiddleware
+REQUEST_CONTEXT: ContextVar[dict | None] = ContextVar("request_context", default=None)
+
+LISTENER: QueueListener | None = None
+STATS: dict[str, int] = {"dropped": 0}
+
+access_logger = getLogger("app.access")
+
+
+# === CONFIGURATION ===
+def configure_logging() -> None:
+    """
+    Send the records of every logger through a queue to a writer thread that prints them as JSON lines to stdout.
+    Does nothing if logging is already configured.
+
+    variables:
+
+    - LOG_LEVEL: (optional) The default level, default is INFO.
+    - LOG_LEVELS: (optional) Comma separated <logger>=<level> pairs, for example app.access=WARNING,app.database=DEBUG.
+    - LOG_QUEUE_SIZE: (optional) How many records may wait for the writer, default is 10000.
+    """
+    global LISTENER, LOG_LEVEL, LOG_LEVELS, LOG_QUEUE_SIZE
+
+    if LISTENER is not None:
+        return
+
+    LOG_LEVEL = getenv("LOG_LEVEL", LOG_LEVEL).upper()
+    LOG_LEVELS = getenv("LOG_LEVELS", LOG_LEVELS)
+    LOG_QUEUE_SIZE = int(getenv("LOG_QUEUE_SIZE", LOG_QUEUE_SIZE))
+
+    writer = StreamHandler(stdout)
+    writer.setFormatter(JsonFormatter())
+
+    queue = Queue(LOG_QUEUE_SIZE)
+    root = getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(DroppingQueueHandler(queue))
+
+    # Uvicorn prints its own lines, they go through the queue as well, and app.access replaces its access log
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        getLogger(name).handlers.clear()
+        getLogger(name).propagate = True
+    getLogger("uvicorn.access").setLevel(WARNING)
+
+    for pair in filter(None, (pair.strip() for pair in LOG_LEVELS.split(","))):
+        name, _, level = pair.partition("=")
+        getLogger(name.strip()).setLevel(level.strip().upper())
+
+    LISTENER = QueueListener(queue, writer)
+    LISTENER.start()
+
+
+def stop_logging() -> None:
+    """
+    Write the records left in the queue and stop the writer thread.
+    """
+    global LISTENER
+
+    if LISTENER is None:
+        return
+
+    LISTENER.stop()
+    LISTENER = None
+
+
+# === HANDLERS ===
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler that never waits: a record that does not fit in the queue is counted and dropped.
+    Only the message and the request fields are resolved on the calling thread, the writer thread does the formatting.
+    """
+
+    def enqueue(self, record: LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            STATS["dropped"] += 1
+            metrics.increment("log_records_dropped_total")
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        # Arguments may be changed by the caller once it continues, so the message is resolved here
+        record.msg = record.getMessage()
+        record.args = None
+
+        context = REQUEST_CONTEXT.get()
+        if context is not None:
+            scope = context["scope"]
+            route = scope.get("route")
+            for name, value in (("request_id", context["request_id"]), ("method", scope.get("method")),
+                                ("route", route.path if route else None),
+                                ("location", scope.get("path_params", {}).get("location"))):
+                if value is not None and not hasattr(record, name):
+                    setattr(record, name, value)
+        return record
+
+
+class JsonFormatter(Formatter):
+    """
+    Format a record as a JSON line with its time, level, logger, message, the fields in LOG_FIELDS that are set and
+    the traceback of its exception.
+    """
+
+    def format(self, record: LogRecord) -> str:
+        line = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name in LOG_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                line[name] = value
+
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return dumps(line).decode("utf-8")
+
+
+def get_stats() -> dict[str, int | str]:
+    """
+    Get the counters of the log queue.
+
+    :return: A dictionary containing the dropped records, the records waiting and the default level.
+    """
+    queued = LISTENER.queue.qsize() if LISTENER else 0
+    return {**STATS, "queued": queued, "level": getLevelName(getLogger().level)}
+
+
+# === REQUESTS ===
+class RequestLoggingMiddleware:
+    """
+    ASGI middleware that gives every HTTP request and WebSocket connection an ID, makes it available to the records
+    logged while it is handled, returns it in the X-Request-ID header and logs one app.access record when it ends.
+    An X-Request-ID sent by a reverse proxy is kept, so its logs and ours can be joined.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid4().hex
+
+        start = perf_counter()
+        status_code = 500 if scope["type"] == "http" else None
+        token = REQUEST_CONTEXT.set({"request_id": request_id, "scope": scope})
+
+        async def send_with_request_id(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            if access_logger.isEnabledFor(INFO):
+                access_logger.info(f"{scope.get('method', 'WEBSOCKET')} {scope['path']}",
+                                   extra={"status": status_code,
+                                          "duration_ms": round((perf_counter() - start) * 1000, 3)})
+            REQUEST_CONTEXT.reset(token)
+
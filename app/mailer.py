@@ -0,0 +1,165 @@
+from asyncio import Queue, QueueFull, Task, create_task, sleep, wait_for
+from collections.abc import Awaitable, Callable
+from logging import getLogger
+from os import getenv
+
+from httpx import AsyncClient, Limits
+
+import app.metrics as metrics
+
+logger = getLogger(__name__)
+
+# INFO: This is my own internal service, so the default URL points to it, set EMAIL_SERVICE_URL to use your own
+EMAIL_SERVICE_URL: str = "http://192.168.1.99:29998/email"
+EMAIL_QUEUE_SIZE: int = 1000  # Emails waiting to be sent, /token answers 503 when it is full
+EMAIL_QUEUE_RETRY_AFTER_SECONDS: int = 30  # Retry-After sent with that 503
+EMAIL_WORKERS: int = 4  # Emails sent at the same time
+EMAIL_MAX_ATTEMPTS: int = 5
+EMAIL_RETRY_BASE_SECONDS: float = 1.0  # Delay before the first retry, doubled on every following retry
+EMAIL_SHUTDOWN_TIMEOUT_SECONDS: float = 5.0  # How long queued emails are given to go out on shutdown
+
+EmailTransport = Callable[[dict], Awaitable[None]]
+
+QUEUE: Queue | None = None
+CLIENT: AsyncClient | None = None
+TRANSPORT: EmailTransport | None = None
+WORKERS: list[Task] = []
+SENDING: int = 0  # Emails taken from the queue by a worker and not done yet, including ones waiting for a retry
+
+
+# === WORKERS ===
+async def start_email_workers(transport: EmailTransport | None = None) -> None:
+    """
+    Start the email delivery workers using the environment variables.
+
+    variables:
+
+    - EMAIL_SERVICE_URL: (optional) The URL of the email relay used by the default HTTP transport.
+    - EMAIL_QUEUE_SIZE: (optional) How many emails can wait to be sent, default is 1000.
+    - EMAIL_WORKERS: (optional) How many emails are sent at the same time, default is 4.
+    - EMAIL_MAX_ATTEMPTS: (optional) How many times an email is tried before it is dropped, default is 5.
+
+    :param transport: The function that delivers one email, default is a POST to the email relay.
+    """
+    global EMAIL_SERVICE_URL, EMAIL_QUEUE_SIZE, EMAIL_WORKERS, EMAIL_MAX_ATTEMPTS, QUEUE, CLIENT, TRANSPORT
+
+    EMAIL_SERVICE_URL = getenv("EMAIL_SERVICE_URL", EMAIL_SERVICE_URL)
+    EMAIL_QUEUE_SIZE = int(getenv("EMAIL_QUEUE_SIZE", EMAIL_QUEUE_SIZE))
+    EMAIL_WORKERS = int(getenv("EMAIL_WORKERS", EMAIL_WORKERS))
+    EMAIL_MAX_ATTEMPTS = int(getenv("EMAIL_MAX_ATTEMPTS", EMAIL_MAX_ATTEMPTS))
+
+    QUEUE = Queue(maxsize=EMAIL_QUEUE_SIZE)
+    if transport:
+        TRANSPORT = transport
+    else:
+        # One pooled client for every worker, connections to the relay are reused
+        CLIENT = AsyncClient(timeout=10, limits=Limits(max_connections=EMAIL_WORKERS))
+        TRANSPORT = send_email_over_http
+
+    WORKERS.extend(create_task(email_worker()) for _ in range(EMAIL_WORKERS))
+
+
+async def stop_email_workers() -> None:
+    """
+    Give the queued emails a moment to go out, then stop the workers and close the HTTP client.
+    """
+    global CLIENT
+
+    if QUEUE is not None:
+        try:
+            await wait_for(QUEUE.join(), EMAIL_SHUTDOWN_TIMEOUT_SECONDS)
+        except TimeoutError:
+            # Emails in a retry backoff already left the queue, they are lost as well
+            logger.error("%d emails were not sent before shutdown, %d queued and %d being sent or retried",
+                         QUEUE.qsize() + SENDING, QUEUE.qsize(), SENDING)
+
+    for worker in WORKERS:
+        worker.cancel()
+    WORKERS.clear()
+
+    if CLIENT is not None:
+        await CLIENT.aclose()
+        CLIENT = None
+
+
+def enqueue_email(message: dict) -> None:
+    """
+    Queue an email for delivery, returns immediately.
+
+    :param message: The email to send, {"recipient", "subject", "plain", "html"}.
+    :raises QueueFull: If EMAIL_QUEUE_SIZE emails are already waiting, the relay can not keep up.
+    """
+    if QUEUE is None:
+        raise RuntimeError("Email delivery is not running")
+
+    try:
+        QUEUE.put_nowait(message)
+    except QueueFull:
+        raise QueueFull("Too many pending emails, please try again later")
+
+
+async def email_worker() -> None:
+    """
+    Deliver queued emails, retrying failed ones with an exponential backoff.
+    Emails that still fail after the last attempt are logged as dead letters.
+    """
+    global SENDING
+
+    while True:
+        message = await QUEUE.get()
+        SENDING += 1
+
+        try:
+            for attempt in range(1, EMAIL_MAX_ATTEMPTS + 1):
+                try:
+                    await TRANSPORT(message)
+                    metrics.increment("emails_total", (("outcome", "sent"),))
+                    break
+                except Exception as e:
+                    if attempt == EMAIL_MAX_ATTEMPTS:
+                        metrics.increment("emails_total", (("outcome", "dead_letter"),))
+                        logger.error("Dead letter, email to %s failed after %d attempts: %s",
+                                     mask_email(message["recipient"]), attempt, e)
+                        break
+
+                    metrics.increment("emails_total", (("outcome", "retried"),))
+                    await sleep(EMAIL_RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+        finally:
+            SENDING -= 1
+            QUEUE.task_done()
+
+
+def mask_email(email: str) -> str:
+    """
+    Hide most of an email address, so logs do not hold the addresses of users.
+
+    :param email: The email address.
+    :return: The first character of the local part and the domain, e.g. "j***@example.com".
+    """
+    local, _, domain = email.partition("@")
+    return f"{local[:1]}***@{domain}"
+
+
+def count_queued_emails() -> dict[tuple[tuple[str, str], ...], float]:
+    """
+    Count the emails waiting to be sent, read when the metrics are scraped.
+
+    :return: The queue size.
+    """
+    return {(): QUEUE.qsize() if QUEUE is not None else 0}
+
+
+metrics.register_gauge("email_queue_size", count_queued_emails)
+
+
+# === TRANSPORTS ===
+async def send_email_over_http(message: dict) -> None:
+    """
+    Send an email through the email relay.
+    INFO: Pass your own transport to start_email_workers to use another email service.
+
+    :param message: The email to send.
+    """
+    response = await CLIENT.post(EMAIL_SERVICE_URL, json=message)
+    if response.status_code != 201:
+        raise RuntimeError(f"Failed to send verification email, relay answered {response.status_code}")
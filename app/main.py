@@ -1,16 +1,36 @@
-from asyncio import create_task
+from asyncio import create_task, QueueFull
 from contextlib import asynccontextmanager
+from hashlib import blake2b
+from math import ceil
+from os import getenv
 from typing import Annotated
-from datetime import datetime
+from logging import getLogger
 
-from fastapi import FastAPI, status, HTTPException, Body, Header
+from fastapi import FastAPI, status, HTTPException, Body, Header, Query
 from fastapi.params import Depends
 from pydantic import BaseModel, Field
 from starlette.requests import Request
-from starlette.responses import JSONResponse, FileResponse, HTMLResponse
+from fastapi.responses import ORJSONResponse
+from starlette.responses import JSONResponse, HTMLResponse, PlainTextResponse, Response
 from starlette.websockets import WebSocket
 
+import app.assets as assets
+import app.cache as comment_cache
 import app.database as db_handler
+import app.logs as logs
+import app.mailer as mailer
+import app.metrics as metrics
+import app.ratelimit as rate_limiter
+import app.realtime as realtime_hub
+import app.search as comment_search
+import app.rendering as comment_renderer
+
+# How long shared caches (CDN) may keep older comment pages, edits and deletes on them show up this much later
+COMMENT_CACHE_MAX_AGE_SECONDS: int = int(getenv("COMMENT_CACHE_MAX_AGE_SECONDS", 30))
+# Reverse proxies in front of the app that append to X-Forwarded-For, 0 (no proxy) ignores the header
+TRUSTED_PROXY_COUNT: int = int(getenv("TRUSTED_PROXY_COUNT", 0))
+
+logger = getLogger(__name__)
 
 
 # === MODELS ===
@@ -26,31 +46,141 @@ class Comment(BaseModel):
     comment: str = Field(..., description="The comment", examples=["This is a comment"])
 
 
+class CommentData(BaseModel):
+    id: int = Field(..., description="The comment id, unique within the location", examples=[1])
+    email: str = Field(..., description="The email of the author", examples=["john.doe@acme.com"])
+    username: str = Field(..., description="The username of the author", examples=["John"])
+    color: str = Field(..., description="The color of the author's initial", examples=["#1d3557"])
+    initial: str = Field(..., description="The initial of the author", examples=["J"])
+    comment: str = Field(..., description="The comment", examples=["This is a comment"])
+    html: str | None = Field(None, description="The comment rendered from markdown, only with render_html=true",
+                             examples=["<p>This is a comment</p><br>"])
+    date: str = Field(..., description="The date the comment was posted", examples=["1980-01-31"])
+    time: str = Field(..., description="The time the comment was posted", examples=["01:23:45"])
+    edited_at: str | None = Field(None, description="When the comment was last edited or deleted, if it was",
+                                  examples=["1980-01-31T02:00:00"])
+    deleted: bool | None = Field(None, description="True if the author deleted the comment, its text is empty",
+                                 examples=[True])
+
+
+class CommentPage(BaseModel):
+    message: str = Field(..., description="The status message", examples=["ok"])
+    comments: list[CommentData] | str = Field(
+        ..., description="A JSON array of comments with format=json, otherwise the legacy string representation")
+    next_cursor: int | None = Field(..., description="The cursor for the next page, null if there are no more comments",
+                                    examples=[1])
+
+
+class SearchPage(BaseModel):
+    message: str = Field(..., description="The status message", examples=["ok"])
+    comments: list[CommentData] = Field(..., description="The matching comments")
+    next_cursor: str | None = Field(..., description="The cursor for the next page, null if there are no more results",
+                                    examples=["1.1:42"])
+
+
+class LocationSummaryQuery(BaseModel):
+    locations: list[str] = Field(..., description="The locations to summarize, at most 100 by default",
+                                 examples=[["blog/first-post", "blog/second-post"]])
+    include_latest: bool = Field(False, description="Include the latest comment of every location")
+
+
 # === FASTAPI ===
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # INFO: Needs to set up environment variables before running the app, refer to README.md
+    # Write logs from a background thread, so a burst of errors never blocks the event loop
+    logs.configure_logging()
+
+    # Build the embed script and HTML
+    assets.build_assets()
+
     # Get the database connection
     await db_handler.get_database()
+    await db_handler.ensure_indexes()
+
+    # With blocks of comment IDs only one worker hands them out, the others take their IDs one at a time
+    await db_handler.hold_comment_id_lease()
 
     # Start the database cleaner
     create_task(db_handler.clean_database())
 
+    # Start the change stream that feeds every WebSocket connection
+    create_task(realtime_hub.run_comment_hub())
+
+    # Start writing the "last used" timestamps of cached access tokens
+    create_task(db_handler.flush_access_token_touches())
+
+    # Keep the denylist of access tokens in sync with the other workers
+    create_task(db_handler.refresh_revoked_access_tokens())
+
+    # Keep the search index up to date when the database has no text index
+    comment_search.configure_search()
+
+    # Start dropping the rate limit buckets of clients that went quiet
+    rate_limiter.configure_rate_limits()
+    create_task(rate_limiter.evict_rate_limit_buckets())
+
+    # Start the email delivery workers
+    await mailer.start_email_workers()
+
     yield
 
+    await mailer.stop_email_workers()
+
+    await db_handler.write_access_token_touches()
+
+    await db_handler.release_comment_id_lease()
+
+    logs.stop_logging()
+
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(logs.RequestLoggingMiddleware)
 
 
 # Custom exception handler to change {detail} to {message} for more unified response
 @app.exception_handler(HTTPException)
 async def custom_http_exception_handler(request: Request, exc: HTTPException):
+    if exc.status_code >= 500:
+        logger.error("%s", exc.detail, exc_info=exc.__context__)
+
     return JSONResponse(
         status_code=exc.status_code,
         content={"message": exc.detail},
+        headers=exc.headers,
     )
 
 
+def limit_request(limits: dict[str, str]) -> None:
+    """
+    Take one request from every rate limit bucket, raise 429 Too Many Requests if one of them is empty.
+
+    :param limits: The limits to apply, name in rate_limiter.RATE_LIMITS -> key (IP address, email or location)
+    """
+    for name, key in limits.items():
+        retry_after = rate_limiter.acquire(name, key)
+        if retry_after > 0:
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                                detail=f"Too many requests, retry in {ceil(retry_after)} seconds",
+                                headers={"Retry-After": str(ceil(retry_after))})
+
+
+def get_client_ip(request: Request) -> str:
+    """
+    Get the IP address of the client. Behind reverse proxies it is the address the outermost trusted proxy appended to
+    X-Forwarded-For, the addresses before it are sent by the client and can be anything.
+
+    :param request: The request
+    :return: The IP address
+    """
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for and TRUSTED_PROXY_COUNT > 0:
+        addresses = [address.strip() for address in forwarded_for.split(",")]
+        return addresses[max(len(addresses) - TRUSTED_PROXY_COUNT, 0)]
+    return request.client.host if request.client else "unknown"
+
+
 # === AUTHENTICATION ENDPOINT ===
 @app.get(
     "/",
@@ -73,27 +203,75 @@ async def root(request: Request) -> HTMLResponse:
     forwarded_proto = request.headers.get("X-Forwarded-Proto", "http")
     url = request.url._url.replace("http://", f"{forwarded_proto}://")
 
-    comment_section_html = f"""<div style="width:100%;height:100%;background-color:#f0f0f0;display:flex;flex-direction:column;border-radius:8px;box-shadow:0 2px 5px rgba(0,0,0,.1);position:relative"id=comment-section><span id=api-url style=visibility:hidden;height:0>{url}</span><div style="position:absolute;top:0;left:0;width:100%;height:100%;background-color:rgba(0,0,0,.5);justify-content:center;align-items:center;z-index:1000;display:none;opacity:0;transition:opacity .3s ease"id=overlay><div style="width:80%;max-width:500px;background-color:#fff;border-radius:8px;box-shadow:0 2px 5px rgba(0,0,0,.1);display:flex;flex-direction:column"><div style="display:flex;justify-content:space-between;align-items:center;padding:10px 20px;background-color:#457b9d;color:#fff;border-top-left-radius:8px;border-top-right-radius:8px"><div style=font-size:1.5em;font-weight:700 id=overlay-title>Overlay</div><span id=overlay-close-button style="cursor:pointer;transition:all .3s ease"class=span-button>✖</span></div><div style=padding:20px;text-align:center><div style="display:none;flex-direction:column;align-items:stretch;margin-bottom:10px;opacity:0;transform:translateY(0);transition:opacity .5s ease,transform .5s ease;width:100%"id=email-container><input id=email-input placeholder="Enter your email"style="width:100%;padding:10px;border:1px solid #ccc;border-radius:4px;margin-bottom:10px;box-sizing:border-box"type=email> <button id=send-email-button style=width:100%;padding:10px;background-color:#457b9d;color:#fff;border:none;border-radius:4px;box-sizing:border-box>Send</button></div><div style="display:none;flex-direction:column;align-items:stretch;margin-bottom:10px;opacity:0;transform:translateY(-20px);transition:opacity .5s ease,transform .5s ease;width:100%"id=verification-container><input id=verification-code-input placeholder="Enter verification code"style="width:100%;padding:10px;border:1px solid #ccc;border-radius:4px;margin-bottom:10px;box-sizing:border-box"> <button id=verify-code-button style=width:100%;padding:10px;background-color:#457b9d;color:#fff;border:none;border-radius:4px;box-sizing:border-box>Verify</button></div><div style="display:none;flex-direction:column;align-items:stretch;margin-bottom:10px;opacity:0;transform:translateY(-20px);transition:opacity .5s ease,transform .5s ease;width:100%"id=new-username-container><input id=new-username-input placeholder="Enter new username"style="width:100%;padding:10px;border:1px solid #ccc;border-radius:4px;margin-bottom:10px;box-sizing:border-box"> <button id=change-username-button style=width:100%;padding:10px;background-color:#457b9d;color:#fff;border:none;border-radius:4px;box-sizing:border-box>Change</button></div><div style=display:none;padding:10px;background-color:#fcc;color:#c00;border-radius:4px;justify-content:center id=error-container><p id=error-text style=margin:0>Error here</div></div></div></div><div style="display:flex;justify-content:space-between;align-items:center;padding:10px 20px;background-color:#457b9d;color:#fff;border-top-left-radius:8px;border-top-right-radius:8px"id=title-bar><div style=display:flex;align-items:center><span id=about style="margin-right:10px;cursor:pointer;display:flex;align-items:center;transition:all .3s ease"class=span-button>🛈</span><div style=font-size:1.5em;font-weight:700>Comment Section</div></div><div style=display:flex><div style=display:flex;flex-direction:column;align-items:flex-end><div style=display:flex;flex-direction:row><span id=username-edit-button style=margin-right:5px;cursor:pointer class=span-button>✎</span> <span id=username style="transition:opacity .3s ease">Anonymous</span></div><span id=email style="font-size:.8em;color:#ccc;transition:opacity .3s ease">anonymous user</span></div><div style="margin-left:10px;width:40px;height:40px;background-color:#1d3557;color:#fff;display:flex;justify-content:center;align-items:center;border-radius:8px;transition:opacity .3s ease"id=initial>/</div><button id=sign-in-button style="margin-left:10px;padding:5px 10px;background-color:#fff;color:#457b9d;display:block;border:none;border-radius:4px;cursor:pointer;opacity:0;transition:background .3s,opacity .3s ease">Sign In</button> <button id=sign-out-button style="margin-left:10px;padding:5px 10px;background-color:#ff4d4d;color:#fff;display:none;border:none;border-radius:4px;cursor:pointer;opacity:0;transition:background .3s,opacity .3s ease">Sign Out</button></div></div><div style=flex:4;padding:20px;overflow-y:auto;background-color:#fff id=comment-window><div style=text-align:center;color:#888;padding:20px id=empty-comment>No comments yet. Be the first to comment!</div><div style="text-align:center;padding:15px;background-color:#f8f9fa;max-width:fit-content;display:none;border-radius:8px;box-shadow:0 1px 3px rgba(0,0,0,.1);cursor:pointer;transition:all .3s ease"id=load-more-container><div style="font-size:1.5em;color:#457b9d;transition:transform .6s ease"id=load-more-icon>↻</div><a href=# id=load-more-button style="display:inline-block;color:#457b9d;text-decoration:none;cursor:pointer;margin-top:10px;font-weight:700;padding:8px 16px;border-radius:4px;transition:all .3s ease">Load More</a></div><div style=text-align:center;color:#888;padding:20px;display:none id=no-more-comment>That is it, no more comments available.</div></div><div style="display:flex;justify-content:space-around;align-items:center;padding:10px 20px;background-color:#f0f0f0;border-bottom-left-radius:8px;border-bottom-right-radius:8px"id=comment-compose><textarea id=comment-textarea placeholder="Type your comment..."rows=1 style="flex:9;padding:10px;border:1px solid #ccc;border-radius:4px;resize:none;max-height:200px;overflow-y:auto"></textarea> <button id=comment-button style="flex:1;margin-left:10px;padding:10px;background-color:#457b9d;color:#fff;border:none;border-radius:4px;cursor:pointer;transition:background-color .3s,transform .1s">➤</button></div><script src=https://cdn.jsdelivr.net/npm/markdown-it@10.0.0/dist/markdown-it.min.js></script><script src={url}js></script></div>"""
-    return HTMLResponse(content=comment_section_html, status_code=status.HTTP_200_OK)
+    return HTMLResponse(content=assets.render_embed(url), status_code=status.HTTP_200_OK)
 
 
 @app.get(
     "/js",
     status_code=status.HTTP_200_OK,
-    response_class=FileResponse,
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Successful response",
+            "content": {"text/javascript": {"example": "mini.js"}},
+        },
+        status.HTTP_304_NOT_MODIFIED: {
+            "description": "Not modified, the script did not change since the ETag in If-None-Match",
+        }}
+)
+async def javascript(request: Request) -> Response:
+    """
+    Returns the minified script for the comment section, for embeds that were rendered before the script URL was
+    content-hashed. It has to be revalidated on every load, new embeds use /js/<hash>.js instead.
+
+    :return: mini.js file
+    """
+    etag = f'"{assets.SCRIPT["hash"]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    return script_response(request, headers)
+
+
+@app.get(
+    "/js/{script_name}",
+    status_code=status.HTTP_200_OK,
     responses={
         status.HTTP_200_OK: {
             "description": "Successful response",
             "content": {"text/javascript": {"example": "mini.js"}},
         }}
 )
-async def javascript() -> FileResponse:
+async def hashed_javascript(script_name: str, request: Request) -> Response:
     """
-    Returns the mini.js file for the comment section
+    Returns the minified script for the comment section under its content-hashed name, so it can be cached forever.
+    A name from another build (a client that loaded the embed from a different deployment) gets the current script,
+    but without being cached.
 
+    :param script_name: <hash>.js
     :return: mini.js file
     """
-    return FileResponse('app/ui/mini.js', media_type='text/javascript')
+    if script_name == f"{assets.SCRIPT['hash']}.js":
+        cache_control = "public, max-age=31536000, immutable"
+    else:
+        cache_control = "no-cache"
+
+    return script_response(request, {"Cache-Control": cache_control, "Vary": "Accept-Encoding"})
+
+
+def script_response(request: Request, headers: dict[str, str]) -> Response:
+    """
+    Build the response for the comment section script, precompressed in the best encoding the client accepts.
+
+    :param request: The request, used to read Accept-Encoding
+    :param headers: The caching headers of the response
+    :return: The script response
+    """
+    body, encoding = assets.get_script(request.headers.get("Accept-Encoding"))
+    if encoding:
+        headers = {**headers, "Content-Encoding": encoding}
+
+    return Response(content=body, media_type="text/javascript", headers=headers)
 
 
 @app.post(
@@ -108,11 +286,20 @@ async def javascript() -> FileResponse:
             "description": "Bad request",
             "content": {"application/json": {"example": {"message": "<error message>"}}},
         },
+        status.HTTP_429_TOO_MANY_REQUESTS: {
+            "description": "Too many requests, retry after the number of seconds in the Retry-After header",
+            "content": {"application/json": {"example": {"message": "Too many requests, retry in 60 seconds"}}},
+        },
         status.HTTP_500_INTERNAL_SERVER_ERROR: {
             "description": "Internal server error",
             "content": {"application/json": {"example": {"message": "Internal server error: <error message>"}}},
+        },
+        status.HTTP_503_SERVICE_UNAVAILABLE: {
+            "description": "Too many emails are waiting to be sent, retry after the seconds in the Retry-After header",
+            "content": {"application/json": {"example": {"message": "Too many pending emails, please try again later"}}},
         }})
 async def login(
+        request: Request,
         user_data: Annotated[User, Body(
             title="User login details",
             description="Endpoint to login the user. Requires email."
@@ -121,14 +308,21 @@ async def login(
     Logs in the user using the email, this allows the user to get an access accessToken to post comments as non-anonymous.
     Needs to be followed by the verify endpoint to verify the user.
 
+    :param request: The request, used to rate limit the client
     :param user_data:  User login data
     :return: {"message": "ok"} means the user has been placed in the verification queue
     """
+    limit_request({"token_per_ip": get_client_ip(request), "token_per_email": user_data.email.strip().lower()})
+
     try:
         await db_handler.email_verification_queue(**user_data.model_dump())
         return {"message": "ok"}
     except ValueError as e:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except QueueFull as e:
+        # The email relay is behind, not broken, the client should come back later
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(e),
+                            headers={"Retry-After": str(mailer.EMAIL_QUEUE_RETRY_AFTER_SECONDS)})
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail=f"Internal server error: {str(e)}")
@@ -146,11 +340,16 @@ async def login(
             "description": "Bad request",
             "content": {"application/json": {"example": {"message": "<error message>"}}},
         },
+        status.HTTP_429_TOO_MANY_REQUESTS: {
+            "description": "Too many requests, retry after the number of seconds in the Retry-After header",
+            "content": {"application/json": {"example": {"message": "Too many requests, retry in 60 seconds"}}},
+        },
         status.HTTP_500_INTERNAL_SERVER_ERROR: {
             "description": "Internal server error",
             "content": {"application/json": {"example": {"message": "Internal server error: <error message>"}}},
         }})
 async def verify_email(
+        request: Request,
         verification_data: Annotated[Verification, Body(
             title="User Verification details",
             description="Endpoint to verify the user. Requires email and verification code."
@@ -161,8 +360,12 @@ async def verify_email(
     Such as if from register endpoint, it will create a new user and return an access accessToken. If from login endpoint, it will
     return a new access accessToken.
 
+    :param request: The request, used to rate limit the client
+    :param verification_data: The email and the verification code
     :return: {"message": "ok", "access_token": "access accessToken"}
     """
+    limit_request({"verify_per_ip": get_client_ip(request),
+                   "verify_per_email": verification_data.email.strip().lower()})
 
     try:
         access_token = await db_handler.verify_email(**verification_data.model_dump())
@@ -174,6 +377,39 @@ async def verify_email(
                             detail=f"Internal server error: {str(e)}")
 
 
+@app.delete(
+    "/token",
+    status_code=status.HTTP_200_OK,
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Successful response",
+            "content": {"application/json": {"example": {"message": "ok"}}},
+        },
+        status.HTTP_400_BAD_REQUEST: {
+            "description": "Bad request",
+            "content": {"application/json": {"example": {"message": "<error message>"}}},
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "description": "Internal server error",
+            "content": {"application/json": {"example": {"message": "Internal server error: <error message>"}}},
+        }})
+async def logout(Bearer: str | None = Header(None)) -> dict[str, str]:
+    """
+    Revoke the access accessToken (sign out), it can not be used anymore afterward.
+
+    :param Bearer: The access accessToken to revoke
+    :return: {"message": "ok"} if the access accessToken is revoked
+    """
+    try:
+        await db_handler.revoke_access_token(Bearer)
+        return {"message": "ok"}
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail=f"Internal server error: {str(e)}")
+
+
 async def validate_token(Bearer: str | None = Header(None)) -> dict[str, str]:
     """
     Validate the access accessToken and return the user information.
@@ -261,12 +497,17 @@ async def change_username(new_username: str = "", user: dict[str, str] = Depends
             "description": "Data created",
             "content": {"application/json": {"example": {"message": "ok"}}},
         },
+        status.HTTP_429_TOO_MANY_REQUESTS: {
+            "description": "Too many requests, retry after the number of seconds in the Retry-After header",
+            "content": {"application/json": {"example": {"message": "Too many requests, retry in 60 seconds"}}},
+        },
         status.HTTP_500_INTERNAL_SERVER_ERROR: {
             "description": "Internal server error",
             "content": {"application/json": {"example": {"message": "Internal server error: <error message>"}}},
         }})
 async def comment(
         location,
+        request: Request,
         comment_data: Annotated[Comment, Body(
             title="Comment data",
             description="Endpoint to post a comment. Requires comment body."
@@ -277,10 +518,13 @@ async def comment(
     If the access accessToken is provided and valid, the comment will be posted with the user information, otherwise, it will be posted as anonymous.
 
     :param location: The location of the comment
+    :param request: The request, used to rate limit the client
     :param comment_data: Comment data containing the comment to be posted
     :param user: The user data from the access accessToken, anonymous if accessToken is invalid or not provided
     :return: {"message": "ok"} if the comment is successfully posted
     """
+    limit_request({"comment_per_ip": get_client_ip(request), "comment_per_location": location})
+
     # Cut the text if it's too long
     comment_data.comment = comment_data.comment[:5000]
 
@@ -292,17 +536,191 @@ async def comment(
                             detail=f"Internal server error: {str(e)}")
 
 
+@app.put(
+    "/comment/{location:path}/{comment_id:int}",
+    status_code=status.HTTP_200_OK,
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Successful response",
+            "content": {"application/json": {"example": {
+                "message": "ok",
+                "comment": {"id": 1, "email": "john.doe@example.com", "username": "John", "color": "#1d3557",
+                            "initial": "JD", "comment": "Edited comment", "html": "<p>Edited comment</p><br>",
+                            "date": "1980-01-31", "time": "01:23:45", "edited_at": "1980-01-31T02:00:00"}}}},
+        },
+        status.HTTP_400_BAD_REQUEST: {
+            "description": "Bad request",
+            "content": {"application/json": {"example": {"message": "Please provide a valid access accessToken"}}},
+        },
+        status.HTTP_404_NOT_FOUND: {
+            "description": "The user has no such comment, or it was deleted",
+            "content": {"application/json": {"example": {"message": "Comment not found"}}},
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "description": "Internal server error",
+            "content": {"application/json": {"example": {"message": "Internal server error: <error message>"}}},
+        }})
+async def edit_comment(
+        location,
+        comment_id: int,
+        request: Request,
+        comment_data: Annotated[Comment, Body(
+            title="Comment data",
+            description="Endpoint to edit a comment. Requires the new comment body."
+        )],
+        user: dict[str, str] = Depends(validate_token)) -> dict[str, str | dict]:
+    """
+    Edit a comment of the logged-in user. Connected clients receive the new version as an "edited" message.
+
+    :param location: The location of the comment
+    :param comment_id: The id of the comment
+    :param request: The request, used to rate limit the client
+    :param comment_data: Comment data containing the new comment
+    :param user: The user data from the access accessToken
+    :return: {"message": "ok", "comment": {<the edited comment, with html>}} if the comment is successfully edited
+    """
+    if user["email"] == db_handler.ANONYMOUS_EMAIL:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Please provide a valid access accessToken")
+
+    limit_request({"comment_per_ip": get_client_ip(request)})
+
+    try:
+        edited = await db_handler.edit_comment(user["email"], location, comment_id, comment_data.comment[:5000])
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail=f"Internal server error: {str(e)}")
+
+    if edited is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found")
+    return {"message": "ok", "comment": edited}
+
+
+@app.delete(
+    "/comment/{location:path}/{comment_id:int}",
+    status_code=status.HTTP_200_OK,
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Successful response",
+            "content": {"application/json": {"example": {"message": "ok"}}},
+        },
+        status.HTTP_400_BAD_REQUEST: {
+            "description": "Bad request",
+            "content": {"application/json": {"example": {"message": "Please provide a valid access accessToken"}}},
+        },
+        status.HTTP_404_NOT_FOUND: {
+            "description": "The user has no such comment, or it was already deleted",
+            "content": {"application/json": {"example": {"message": "Comment not found"}}},
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "description": "Internal server error",
+            "content": {"application/json": {"example": {"message": "Internal server error: <error message>"}}},
+        }})
+async def delete_comment(
+        location,
+        comment_id: int,
+        request: Request,
+        user: dict[str, str] = Depends(validate_token)) -> dict[str, str]:
+    """
+    Delete a comment of the logged-in user. The comment stays in the thread without its text and with "deleted": true,
+    connected clients receive it as a "deleted" message.
+
+    :param location: The location of the comment
+    :param comment_id: The id of the comment
+    :param request: The request, used to rate limit the client
+    :param user: The user data from the access accessToken
+    :return: {"message": "ok"} if the comment is successfully deleted
+    """
+    if user["email"] == db_handler.ANONYMOUS_EMAIL:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Please provide a valid access accessToken")
+
+    limit_request({"comment_per_ip": get_client_ip(request)})
+
+    try:
+        deleted = await db_handler.delete_comment(user["email"], location, comment_id)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail=f"Internal server error: {str(e)}")
+
+    if deleted is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Comment not found")
+    return {"message": "ok"}
+
+
+# Under its own prefix, a location may end with any segment, search included
+@app.get(
+    "/search/comment/{location:path}",
+    status_code=status.HTTP_200_OK,
+    response_model=SearchPage,
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Successful response",
+            "content": {"application/json": {"example": {
+                "message": "ok",
+                "comments": [{"id": 42, "email": "john.doe@example.com", "username": "John", "color": "#1d3557",
+                              "initial": "JD", "comment": "The search found this comment", "date": "1980-01-31",
+                              "time": "01:23:45"}],
+                "next_cursor": None}}},
+        },
+        status.HTTP_400_BAD_REQUEST: {
+            "description": "Bad request",
+            "content": {"application/json": {"example": {"message": "The search query must be 1 to 200 characters"}}},
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "description": "Internal server error",
+            "content": {"application/json": {"example": {"message": "Internal server error: <error message>"}}},
+        }})
+async def search_comments(
+        location,
+        q: str,
+        order: str = "relevance",
+        comment_per_page: int = 30,
+        cursor: str | None = None,
+        render_html: bool = False) -> ORJSONResponse:
+    """
+    Search the comments of the location for any of the words in q, with the best matches (or the newest) first.
+    Pass the returned next_cursor back as cursor, with the same q and order, to get the next page.
+
+    :param location: The location of the comments
+    :param q: The words to search for
+    :param order: "relevance" for the best matches first, "recent" for the newest first
+    :param comment_per_page: The number of comments per page, at most 100
+    :param cursor: The next_cursor of the previous page
+    :param render_html: Include the comment rendered from markdown as sanitized HTML in the html field
+    :return: {"message": "ok", "comments": [{<comment>}], "next_cursor": <cursor or null>}
+    """
+    if comment_per_page < 1 or comment_per_page > 100:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid comment per page")
+
+    try:
+        comments, next_cursor = await comment_search.search_comments(location, q, comment_per_page, order, cursor,
+                                                                     render_html)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail=f"Internal server error: {str(e)}")
+
+    return ORJSONResponse({"message": "ok", "comments": comments, "next_cursor": next_cursor})
+
+
 @app.get(
     "/comment/{location:path}",
     status_code=status.HTTP_200_OK,
+    response_model=CommentPage,
     responses={
         status.HTTP_200_OK: {
             "description": "Successful response",
             "content": {
                 "application/json": {"example": {"message": "ok",
-                                                 "comments": "[{'id': 2, 'email': '', 'username': 'Anonymous', 'color': '#1d3557', 'initial': '/', 'comment': 'Comment', 'date': '1980-01-31', 'time': '01:23:45'}, {'id': 1, 'email': 'john.doe@example.com', 'username': 'John', 'color': '#1d3557', 'initial': 'JD', 'comment': 'Comment', 'date': '1980-01-31', 'time': '01:23:45'}}]"}}
+                                                 "comments": "[{'id': 2, 'email': '', 'username': 'Anonymous', 'color': '#1d3557', 'initial': '/', 'comment': 'Comment', 'date': '1980-01-31', 'time': '01:23:45'}, {'id': 1, 'email': 'john.doe@example.com', 'username': 'John', 'color': '#1d3557', 'initial': 'JD', 'comment': 'Comment', 'date': '1980-01-31', 'time': '01:23:45'}}]",
+                                                 "next_cursor": 1}}
             },
         },
+        status.HTTP_304_NOT_MODIFIED: {
+            "description": "Not modified, the comments did not change since the ETag in If-None-Match",
+        },
         status.HTTP_400_BAD_REQUEST: {
             "description": "Bad request",
             "content": {"application/json": {"example": {"message": "Invalid comment per page or page number"}}},
@@ -313,45 +731,208 @@ async def comment(
         }})
 async def get_comments(
         location,
+        request: Request,
         comment_per_page: int = 30,
         page: int = 1,
-        latest_first: bool = True) -> dict[str, str]:
+        latest_first: bool = True,
+        before_id: int | None = None,
+        after_id: int | None = None,
+        render_html: bool = False,
+        response_format: str = Query("legacy", alias="format")) -> Response:
     """
     Get comments on the location. The comments will be returned based on the location and the page number.
     The comments will be sorted by the latest comment first.
+    Instead of a page number, a cursor can be used. Pass the returned next_cursor as before_id (latest first) or
+    after_id (oldest first) to get the next page, this keeps pages stable while new comments are posted.
+    Responses carry an ETag, sending it back in If-None-Match returns 304 Not Modified when the page did not change.
 
     :param location: The location of the comment
+    :param request: The request, used to read If-None-Match
     :param comment_per_page: The number of comments per page
-    :param page: The page number
+    :param page: The page number, ignored when before_id or after_id is given
     :param latest_first: Sort the comments by the latest comment first (highest id first)
-    :return: {"message": "ok", "comments": "[{'id': 1, '<email>': 'email', 'username': '<username>', 'color': '<color>', 'initial': '<initial>', 'comment': '<Comment>', 'date': '<date>', 'time': '<time>'}]"}
+    :param before_id: Get the comments older than this comment id
+    :param after_id: Get the comments newer than this comment id
+    :param render_html: Include the comment rendered from markdown as sanitized HTML in the html field
+    :param response_format: "json" to get the comments as a JSON array, otherwise they are returned as a string for older embeds
+    :return: {"message": "ok", "comments": "[{'id': 1, '<email>': 'email', 'username': '<username>', 'color': '<color>', 'initial': '<initial>', 'comment': '<Comment>', 'date': '<date>', 'time': '<time>'}]", "next_cursor": <id or null>}
     """
     # Check if comment per page and page number is valid
     if comment_per_page < 1 or page < 1:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid comment per page or page number")
 
     try:
-        comments = await db_handler.get_comments(location=location, comment_per_page=comment_per_page, page=page,
-                                                 latest_first=latest_first)
-        return {"message": "ok", "comments": str(comments)}
+        # Answer repeated reads from the location version alone, before reading any comments. The version changes with
+        # every post, edit, delete and author profile change.
+        # A page served from the buffer is tagged with the version the buffer holds, so the tag never runs ahead of
+        # the comments. Other pages are tagged with the version in the database, read before the comments.
+        cached = comment_cache.get_page(location, comment_per_page, page, latest_first, before_id, after_id)
+        if cached is not None:
+            max_id, revision = comment_cache.get_version(location)
+        else:
+            max_id, revision = await db_handler.get_location_version(location)
+        query_key = f"{comment_per_page}:{page}:{latest_first}:{before_id}:{after_id}:{render_html}:" \
+                    f"{response_format}"
+        etag = f'W/"{max_id}.{revision}.{blake2b(query_key.encode("utf-8"), digest_size=8).hexdigest()}"'
+
+        # Older pages get no new comments, only edits and deletes, so shared caches may keep them for a short while.
+        # The newest pages must be revalidated.
+        if before_id is not None or (after_id is None and not latest_first and page * comment_per_page <= max_id):
+            cache_control = f"public, max-age={COMMENT_CACHE_MAX_AGE_SECONDS}"
+        else:
+            cache_control = "no-cache"
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        # Pages of busy locations are served from memory, the others are read from the database. A revision this
+        # worker has not seen on the change stream yet may come from a profile change it has not seen either, then
+        # the authors are read instead of taken from the profile cache. The buffer read its authors when it was filled.
+        if cached is not None:
+            comments, next_cursor = cached
+            comments = [comment_renderer.present_comment(comment, render_html)
+                        for comment in await db_handler.resolve_authors(comments)]
+        else:
+            comments, next_cursor = await db_handler.get_comments(
+                location=location, comment_per_page=comment_per_page, page=page, latest_first=latest_first,
+                before_id=before_id, after_id=after_id, render_html=render_html,
+                cached_profiles=comment_cache.is_profile_current(location, revision))
+
+        if response_format == "json":
+            # Comments come out of the database with only the public fields, so they are serialized as is
+            return ORJSONResponse({"message": "ok", "comments": comments, "next_cursor": next_cursor},
+                                  headers=headers)
+        return JSONResponse({"message": "ok", "comments": str(comments), "next_cursor": next_cursor},
+                            headers=headers)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail=f"Internal server error: {str(e)}")
 
 
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """
+    Check if the If-None-Match header matches the ETag, weak comparison as described in RFC 9110.
+
+    :param if_none_match: The If-None-Match header value
+    :param etag: The current ETag
+    :return: True if the client already has the current representation
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+
+    opaque_tag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque_tag for tag in if_none_match.split(","))
+
+
 @app.websocket("/comment/{location:path}")
-async def ws_latest_comment(location, websocket: WebSocket):
+async def ws_latest_comment(location, websocket: WebSocket, last_id: int | None = None, render_html: bool = False):
     """
     Websocket endpoint to get the latest comments on the location.
     The comments will be sent to the client in real-time.
+    When reconnecting, pass the highest comment id already received as last_id to get the missed comments first.
+    Only comments posted after last_id are replayed, edits and deletes made in the meantime are not.
 
     :param location: The location of the comment
     :param websocket: The websocket connection
+    :param last_id: The highest comment id the client already has
+    :param render_html: Include the comment rendered from markdown as sanitized HTML in the html field
     """
     await websocket.accept()
 
     try:
-        await db_handler.get_latest_comments_ws(location, websocket)
+        await realtime_hub.get_latest_comments_ws(location, websocket, last_id, render_html)
     except Exception as e:
-        print(f"ERROR:    {datetime.now()} - Websocket error: {str(e)}")
+        logger.exception("Websocket error: %s", e)
         await websocket.close()
+
+
+@app.post(
+    "/comments/summary",
+    status_code=status.HTTP_200_OK,
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Successful response",
+            "content": {"application/json": {"example": {"message": "ok", "locations": {
+                "blog/first-post": {"max_comment_id": 1, "count": 2, "latest": {
+                    "id": 1, "email": "john.doe@example.com", "username": "John", "color": "#1d3557",
+                    "initial": "JD", "comment": "Comment", "date": "1980-01-31", "time": "01:23:45"}},
+                "blog/second-post": {"max_comment_id": -1, "count": 0, "latest": None}}}}},
+        },
+        status.HTTP_400_BAD_REQUEST: {
+            "description": "Bad request",
+            "content": {"application/json": {"example": {"message": "At most 100 locations can be summarized at once"}}},
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR: {
+            "description": "Internal server error",
+            "content": {"application/json": {"example": {"message": "Internal server error: <error message>"}}},
+        }})
+async def get_location_summaries(
+        query: Annotated[LocationSummaryQuery, Body(
+            title="Locations",
+            description="Endpoint to get the comment count of many locations. Requires the list of locations."
+        )]) -> Response:
+    """
+    Get the comment count and optionally the latest comment of many locations with one request, for index pages that
+    show "N comments" next to every post. Counts may be up to a few seconds old.
+
+    :param query: The locations and whether to include their latest comment
+    :return: {"message": "ok", "locations": {"<location>": {"max_comment_id": <id>, "count": <count>, "latest": <comment or null>}}}
+    """
+    try:
+        summaries = await db_handler.get_location_summaries(query.locations, query.include_latest)
+        return ORJSONResponse({"message": "ok", "locations": summaries})
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                            detail=f"Internal server error: {str(e)}")
+
+
+# === STATS ENDPOINT ===
+@app.get(
+    "/stats",
+    status_code=status.HTTP_200_OK,
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Successful response",
+            "content": {"application/json": {"example": {
+                "message": "ok",
+                "token_cache": {"hits": 10, "misses": 2, "size": 2, "pending_touches": 1},
+                "comment_cache": {"locations": 1, "bytes": 2048, "hits": 9, "misses": 1, "evictions": 0,
+                                  "hit_ratio": 0.9},
+                "cleanup": {"last_run": "1980-01-31T01:23:45", "deleted_tokens": 3, "batches": 1,
+                            "deleted_codes": 0, "duration_seconds": 0.512},
+                "rate_limits": {"allowed": 120, "limited": 4, "evictions": 10, "keys": 25},
+                "logs": {"dropped": 0, "queued": 0, "level": "INFO"}}}},
+        }})
+async def stats() -> dict[str, str | dict[str, str | int | float]]:
+    """
+    Get the counters of the in-memory caches of this worker.
+
+    :return: {"message": "ok", "token_cache": {"hits": <hits>, "misses": <misses>, "size": <size>, "pending_touches": <pending>}, "comment_cache": {"locations": <locations>, "bytes": <bytes>, "hits": <hits>, "misses": <misses>, "evictions": <evictions>, "hit_ratio": <ratio>}, "cleanup": {"last_run": <time>, "deleted_tokens": <count>, "batches": <count>, "deleted_codes": <count>, "duration_seconds": <seconds>}, "rate_limits": {"allowed": <count>, "limited": <count>, "evictions": <count>, "keys": <count>}, "logs": {"dropped": <count>, "queued": <count>, "level": <level>}}
+    """
+    return {"message": "ok", "token_cache": db_handler.get_access_token_cache_stats(),
+            "comment_cache": comment_cache.get_stats(), "cleanup": db_handler.CLEANUP_STATS,
+            "rate_limits": rate_limiter.get_stats(), "logs": logs.get_stats()}
+
+
+@app.get(
+    "/metrics",
+    status_code=status.HTTP_200_OK,
+    response_class=PlainTextResponse,
+    responses={
+        status.HTTP_200_OK: {
+            "description": "Successful response",
+            "content": {"text/plain": {"example": "# HELP http_request_duration_seconds Time to answer an HTTP request, by route template\n# TYPE http_request_duration_seconds histogram\nhttp_request_duration_seconds_bucket{method=\"GET\",route=\"/comment/{location:path}\",status=\"200\",le=\"0.005\"} 42"}},
+        }})
+async def get_metrics() -> PlainTextResponse:
+    """
+    Get the metrics of this worker in the Prometheus text format: request latency per route, time spent in every
+    database function, WebSocket connections per location, change stream lag and email delivery outcomes.
+
+    :return: The metrics page
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
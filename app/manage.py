@@ -0,0 +1,96 @@
+from argparse import ArgumentParser
+from asyncio import run
+from logging import getLogger
+from sys import exit
+
+import app.database as db_handler
+import app.logs as logs
+
+logger = getLogger(__name__)
+
+
+# === COMMANDS ===
+async def migrate() -> None:
+    """
+    Convert every legacy location document (comments embedded in one array) into one document per comment.
+    Can be run while the app is serving, locations that are read before they are migrated are converted on the fly.
+    """
+    await db_handler.get_database()
+    await db_handler.ensure_indexes()
+
+    logger.info("Migrating comments")
+    locations, comments = await db_handler.migrate_comments()
+    logger.info("Migrated %d comments from %d locations", comments, locations)
+
+
+async def backfill_html() -> None:
+    """
+    Render and store the HTML of every comment written before comments were rendered on the server.
+    Can be run while the app is serving, comments without stored HTML are rendered on the fly until then.
+    """
+    await db_handler.get_database()
+
+    logger.info("Rendering comments")
+    comments = await db_handler.backfill_comment_html()
+    logger.info("Rendered %d comments", comments)
+
+
+async def link_authors() -> None:
+    """
+    Make the comments of signed in users reference their author instead of a copy of the name, color and initial.
+    Can be run while the app is serving, until then those comments keep showing the name they were posted with.
+    """
+    await db_handler.get_database()
+
+    logger.info("Linking comment authors")
+    comments = await db_handler.link_comment_authors()
+    logger.info("Linked %d comments to their author", comments)
+
+
+async def audit_queries() -> None:
+    """
+    Create the indexes, then explain every query shape the app issues and flag the ones that scan a whole collection.
+    Exits with status 1 when a collection scan is found, so it can guard a deploy.
+    """
+    await db_handler.get_database()
+    await db_handler.ensure_indexes()
+
+    results = await db_handler.audit_queries()
+    for collection, description, plan in results:
+        print(f"{plan:<10} {collection:<20} {description}")
+
+    if any(plan != "ok" for _, _, plan in results):
+        logger.error("Some queries scan a whole collection")
+        exit(1)
+
+
+COMMANDS = {
+    "migrate": migrate,
+    "backfill-html": backfill_html,
+    "link-authors": link_authors,
+    "audit-queries": audit_queries,
+}
+
+
+def main() -> None:
+    """
+    Entry point for the maintenance commands, needs the same environment variables as the app (refer to README.md)
+
+    Usage:
+    ```bash
+    python -m app.manage <command>
+    ```
+    """
+    parser = ArgumentParser(description="Rei's Comment Section maintenance commands")
+    parser.add_argument("command", choices=COMMANDS.keys())
+    args = parser.parse_args()
+
+    logs.configure_logging()
+    try:
+        run(COMMANDS[args.command]())
+    finally:
+        logs.stop_logging()
+
+
+if __name__ == "__main__":
+    main()
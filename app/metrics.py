@@ -0,0 +1,198 @@
+from bisect import bisect_left
+from collections.abc import Awaitable, Callable
+from functools import wraps
+from time import perf_counter
+
+# Upper bounds of the latency histogram buckets in seconds, +Inf is added when rendering
+LATENCY_BUCKETS: tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Help text and type of every metric, name -> (type, help)
+METRICS: dict[str, tuple[str, str]] = {
+    "http_request_duration_seconds": ("histogram", "Time to answer an HTTP request, by route template"),
+    "db_operation_duration_seconds": ("histogram", "Time spent in a database function, by function and outcome"),
+    "comment_hub_fanout_duration_seconds": ("histogram", "Time to hand a new comment to every WebSocket queue"),
+    "comment_hub_events_total": ("counter", "New comments received from the change stream"),
+    "comment_hub_lag_seconds": ("gauge", "Age of the last change stream event when it was received"),
+    "websocket_connections": ("gauge", "Open WebSocket connections, by location"),
+    "websocket_closed_total": ("counter", "WebSocket connections closed by the server, by reason (resync, idle, "
+                                          "send_timeout)"),
+    "emails_total": ("counter", "Email delivery attempts, by outcome (sent, retried, dead_letter)"),
+    "email_queue_size": ("gauge", "Emails waiting to be sent"),
+    "log_records_dropped_total": ("counter", "Log records dropped because the log queue was full"),
+}
+
+# Labels are kept as a tuple of (name, value) pairs, so recording a point is a dictionary lookup and a few additions
+Labels = tuple[tuple[str, str], ...]
+
+# name -> labels -> [count per bucket (not cumulative, the last one is +Inf), sum, count]
+HISTOGRAMS: dict[str, dict[Labels, list]] = {}
+# name -> labels -> value
+COUNTERS: dict[str, dict[Labels, float]] = {}
+GAUGES: dict[str, dict[Labels, float]] = {}
+# Gauges read when the metrics are scraped, name -> function returning labels -> value
+GAUGE_CALLBACKS: dict[str, Callable[[], dict[Labels, float]]] = {}
+
+
+# === RECORDING ===
+def observe(name: str, labels: Labels, value: float) -> None:
+    """
+    Record a value in a histogram.
+
+    :param name: The name of the histogram in METRICS.
+    :param labels: The labels of the series.
+    :param value: The value, in seconds for the latency histograms.
+    """
+    series = HISTOGRAMS.setdefault(name, {}).get(labels)
+    if series is None:
+        series = HISTOGRAMS[name][labels] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+
+    series[0][bisect_left(LATENCY_BUCKETS, value)] += 1
+    series[1] += value
+    series[2] += 1
+
+
+def increment(name: str, labels: Labels = (), amount: float = 1) -> None:
+    """
+    Increment a counter.
+
+    :param name: The name of the counter in METRICS.
+    :param labels: The labels of the series.
+    :param amount: How much to add.
+    """
+    series = COUNTERS.setdefault(name, {})
+    series[labels] = series.get(labels, 0) + amount
+
+
+def set_gauge(name: str, labels: Labels, value: float | None) -> None:
+    """
+    Set a gauge.
+
+    :param name: The name of the gauge in METRICS.
+    :param labels: The labels of the series.
+    :param value: The value, None removes the series.
+    """
+    series = GAUGES.setdefault(name, {})
+    if value is None:
+        series.pop(labels, None)
+    else:
+        series[labels] = value
+
+
+def register_gauge(name: str, callback: Callable[[], dict[Labels, float]]) -> None:
+    """
+    Register a gauge that is read when the metrics are scraped, for values that are cheaper to read than to track.
+
+    :param name: The name of the gauge in METRICS.
+    :param callback: Returns the value of every series.
+    """
+    GAUGE_CALLBACKS[name] = callback
+
+
+def timed(function: Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+    """
+    Decorator that records the duration of an async database function in db_operation_duration_seconds.
+
+    :param function: The function to time.
+    :return: The timed function.
+    """
+    labels = (("function", function.__name__),)
+    invalid_labels = labels + (("outcome", "invalid"),)  # ValueError, the input was rejected
+    error_labels = labels + (("outcome", "error"),)
+    labels += (("outcome", "ok"),)
+
+    @wraps(function)
+    async def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            result = await function(*args, **kwargs)
+        except ValueError:
+            observe("db_operation_duration_seconds", invalid_labels, perf_counter() - start)
+            raise
+        except BaseException:
+            observe("db_operation_duration_seconds", error_labels, perf_counter() - start)
+            raise
+
+        observe("db_operation_duration_seconds", labels, perf_counter() - start)
+        return result
+
+    return wrapper
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that records the latency of every HTTP request by method, route template and status code.
+    Route templates are used instead of paths, so the number of series does not grow with the locations.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            observe("http_request_duration_seconds",
+                    (("method", scope["method"]), ("route", route.path if route else "unmatched"),
+                     ("status", str(status_code))),
+                    perf_counter() - start)
+
+
+# === EXPOSITION ===
+def render() -> str:
+    """
+    Render every metric in the Prometheus text exposition format.
+
+    :return: The metrics page.
+    """
+    lines = []
+    gauges = {name: dict(series) for name, series in GAUGES.items()}
+    for name, callback in GAUGE_CALLBACKS.items():
+        gauges.setdefault(name, {}).update(callback())
+
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+        if metric_type == "histogram":
+            for labels, (buckets, total, count) in HISTOGRAMS.get(name, {}).items():
+                cumulative = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        else:
+            series = COUNTERS.get(name, {}) if metric_type == "counter" else gauges.get(name, {})
+            for labels, value in series.items():
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+    """
+    Format the labels of a series, escaping the values as the exposition format requires.
+
+    :param labels: The labels.
+    :return: {name="value",...}, or an empty string without labels.
+    """
+    if not labels:
+        return ""
+
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
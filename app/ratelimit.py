@@ -0,0 +1,115 @@
+from asyncio import sleep
+from collections import OrderedDict
+from os import getenv
+from time import monotonic
+
+RATE_LIMIT_MAX_KEYS: int = 100000  # Buckets kept in memory, the least recently used are dropped first
+RATE_LIMIT_EVICT_SECONDS: int = 60  # How often buckets that have refilled are dropped
+
+# Limits per endpoint and key, name -> (requests, seconds), a client can burst the requests and then gets one more
+# every seconds / requests, (0, 0) disables the limit
+RATE_LIMITS: dict[str, tuple[int, int]] = {
+    "token_per_ip": (10, 600),
+    "token_per_email": (3, 600),  # Every accepted request sends an email
+    "verify_per_ip": (30, 600),
+    "verify_per_email": (5, 600),  # Guessing a 6 digit code at this rate takes months
+    "comment_per_ip": (20, 60),
+    # Two comments a second to one thread per worker, raise it together with COMMENT_BATCH_WINDOW_MS for live events
+    "comment_per_location": (120, 60),
+}
+
+# Token buckets, least recently used first, "<limit name>:<key>" -> [tokens left, monotonic time of the last update]
+BUCKETS: OrderedDict[str, list[float]] = OrderedDict()
+STATS: dict[str, int] = {"allowed": 0, "limited": 0, "evictions": 0}
+
+
+# === CONFIGURATION ===
+def configure_rate_limits() -> None:
+    """
+    Set up the rate limits using the environment variables.
+
+    variables:
+
+    - RATE_LIMIT_<NAME>: (optional) <requests>/<seconds> for every limit in RATE_LIMITS, for example
+      RATE_LIMIT_TOKEN_PER_EMAIL=3/600. 0 disables the limit, the seconds default to 1 and must be above 0.
+    - RATE_LIMIT_MAX_KEYS: (optional) How many clients, emails and locations are tracked at once, default is 100000.
+    """
+    global RATE_LIMIT_MAX_KEYS
+
+    for name in RATE_LIMITS:
+        value = getenv(f"RATE_LIMIT_{name.upper()}")
+        if value is None:
+            continue
+
+        requests, _, seconds = value.partition("/")
+        requests, seconds = int(requests), int(seconds or 1)
+        if requests > 0 and seconds <= 0:
+            raise ValueError(f"RATE_LIMIT_{name.upper()} must be <requests>/<seconds> with seconds above 0")
+        RATE_LIMITS[name] = (requests, seconds) if requests > 0 else (0, 0)
+
+    RATE_LIMIT_MAX_KEYS = int(getenv("RATE_LIMIT_MAX_KEYS", RATE_LIMIT_MAX_KEYS))
+
+
+# === LIMITING ===
+def acquire(name: str, key: str) -> float:
+    """
+    Take one request from the bucket of a key, in constant time.
+
+    :param name: The name of the limit in RATE_LIMITS.
+    :param key: What is limited, an IP address, an email or a location.
+    :return: 0 if the request is allowed, otherwise the seconds until the next request is allowed.
+    """
+    requests, seconds = RATE_LIMITS[name]
+    if requests <= 0:
+        return 0
+
+    rate = requests / seconds
+    now = monotonic()
+    bucket_key = f"{name}:{key}"
+
+    bucket = BUCKETS.get(bucket_key)
+    if bucket is None:
+        bucket = BUCKETS[bucket_key] = [requests, now]
+        if len(BUCKETS) > RATE_LIMIT_MAX_KEYS:
+            BUCKETS.popitem(last=False)
+            STATS["evictions"] += 1
+    else:
+        bucket[0] = min(requests, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        BUCKETS.move_to_end(bucket_key)
+
+    if bucket[0] < 1:
+        STATS["limited"] += 1
+        return (1 - bucket[0]) / rate
+
+    bucket[0] -= 1
+    STATS["allowed"] += 1
+    return 0
+
+
+async def evict_rate_limit_buckets() -> None:
+    """
+    Periodically drop the buckets that have refilled, they behave the same as a missing bucket.
+    Buckets are ordered by their last use, so only the idle front of the registry is visited.
+    """
+    while True:
+        await sleep(RATE_LIMIT_EVICT_SECONDS)
+
+        now = monotonic()
+        while BUCKETS:
+            bucket_key, (tokens, updated) = next(iter(BUCKETS.items()))
+            requests, seconds = RATE_LIMITS[bucket_key.split(":", 1)[0]]
+            if requests > 0 and tokens + (now - updated) * requests / seconds < requests:
+                break
+
+            del BUCKETS[bucket_key]
+            STATS["evictions"] += 1
+
+
+def get_stats() -> dict[str, int]:
+    """
+    Get the counters of the rate limiter.
+
+    :return: A dictionary containing the allowed and limited requests, evicted buckets and tracked keys.
+    """
+    return {**STATS, "keys": len(BUCKETS)}
@@ -0,0 +1,388 @@
+from asyncio import Queue, QueueEmpty, sleep, create_task, wait, wait_for, FIRST_COMPLETED
+from datetime import timezone
+from logging import getLogger
+from os import getenv
+from time import monotonic, perf_counter, time
+
+from orjson import dumps
+from pymongo.errors import OperationFailure
+from starlette.websockets import WebSocket
+
+import app.cache as comment_cache
+import app.database as db_handler
+import app.metrics as metrics
+import app.rendering as comment_renderer
+
+logger = getLogger(__name__)
+
+# Seconds to wait before reopening the change stream after it failed
+HUB_RETRY_SECONDS: int = 5
+# Errors of a resume token the stream can not continue from (InvalidResumeToken, ChangeStreamFatalError,
+# ChangeStreamHistoryLost when the oplog rolled over), the stream is reopened from now instead
+UNRESUMABLE_ERROR_CODES: frozenset[int] = frozenset({260, 280, 286})
+# Comments read per query when replaying the comments a reconnecting client missed
+REPLAY_PAGE_SIZE: int = 100
+
+WS_QUEUE_SIZE: int = 256  # Events waiting for a connection, a connection that falls further behind is resynced
+WS_BATCH_SIZE: int = 50  # Events waiting for a connection are sent together, up to this many per frame
+WS_SEND_TIMEOUT_SECONDS: int = 10  # A client that does not take a frame in time is disconnected
+WS_PING_INTERVAL_SECONDS: int = 30  # How often a ping is sent, the client answers with a pong
+WS_IDLE_TIMEOUT_SECONDS: int = 75  # A client that sent nothing (not even a pong) for this long is disconnected
+
+# Put in the queue of a connection that fell behind, in place of the events it can no longer get in time
+RESYNC = {"type": "resync"}
+
+# Registry of the WebSocket connections per location, location -> the queues of its connections,
+# a queue holds {"type": "created" | "edited" | "deleted", "comment"} events
+SUBSCRIBERS: dict[str, set[Queue]] = {}
+
+
+# === HUB ===
+async def run_comment_hub() -> None:
+    """
+    Run the single change stream of this process and fan every new, edited and deleted comment out to the connections
+    of its location. The same stream moves the version of the comment cache buffers forward, after the comments of
+    that version, so a page served from a buffer is never tagged with a version it does not hold yet. Profile changes
+    made on any worker come through it too, before the revisions they bump, and drop the cached access tokens and
+    profile of the user. If the stream can not resume, every cached user is dropped as well.
+    The number of change streams does not grow with the number of connections, and when the stream fails it is
+    reopened from the last seen event so no comment is skipped. If that event can not be resumed from anymore, the
+    stream starts over from now, the comments written in between are only missed by the live updates.
+
+    variables:
+
+    - WS_QUEUE_SIZE: (optional) Events that may wait for one connection, default is 256.
+    - WS_BATCH_SIZE: (optional) Most events sent in one frame, default is 50.
+    - WS_SEND_TIMEOUT_SECONDS: (optional) How long a frame may take to send, default is 10.
+    - WS_PING_INTERVAL_SECONDS: (optional) How often connections are pinged, default is 30.
+    - WS_IDLE_TIMEOUT_SECONDS: (optional) How long a connection may stay silent, default is 75.
+    """
+    global WS_QUEUE_SIZE, WS_BATCH_SIZE, WS_SEND_TIMEOUT_SECONDS, WS_PING_INTERVAL_SECONDS, WS_IDLE_TIMEOUT_SECONDS
+
+    WS_QUEUE_SIZE = int(getenv("WS_QUEUE_SIZE", WS_QUEUE_SIZE))
+    WS_BATCH_SIZE = int(getenv("WS_BATCH_SIZE", WS_BATCH_SIZE))
+    WS_SEND_TIMEOUT_SECONDS = int(getenv("WS_SEND_TIMEOUT_SECONDS", WS_SEND_TIMEOUT_SECONDS))
+    WS_PING_INTERVAL_SECONDS = int(getenv("WS_PING_INTERVAL_SECONDS", WS_PING_INTERVAL_SECONDS))
+    WS_IDLE_TIMEOUT_SECONDS = int(getenv("WS_IDLE_TIMEOUT_SECONDS", WS_IDLE_TIMEOUT_SECONDS))
+
+    if db_handler.MONGODB_BACKEND == "memory":
+        # The in-memory stand-in has no change streams, the write path of this process hands the comments over instead
+        db_handler.COMMENT_LISTENERS.append(
+            lambda location, event, comment: create_task(publish_comment(location, comment, event)))
+        db_handler.VERSION_LISTENERS.append(comment_cache.set_version)
+        return
+
+    comment_cache.REVISIONS_FROM_HUB = True
+
+    # Comments copied by a migration are marked, they were posted long ago and are not sent as new. Edits and deletes
+    # set edited_at, other updates (backfills, author links) do not reach the clients either. Locations are watched
+    # for the revision every change of their pages bumps, their legacy comments array is left out. Users are watched
+    # for profile changes, without their access tokens.
+    pipeline = [
+        {"$match": {"$or": [
+            {"ns.coll": "comment_items", "operationType": "insert", "fullDocument.migrated": {"$ne": True}},
+            {"ns.coll": "comment_items", "operationType": "update",
+             "updateDescription.updatedFields.edited_at": {"$exists": True}},
+            {"ns.coll": "comments", "operationType": "insert"},
+            {"ns.coll": "comments", "operationType": "update",
+             "updateDescription.updatedFields.revision": {"$exists": True}},
+            {"ns.coll": "users", "operationType": "update", "$or": [
+                {"updateDescription.updatedFields.username": {"$exists": True}},
+                {"updateDescription.updatedFields.color": {"$exists": True}},
+                {"updateDescription.updatedFields.initial": {"$exists": True}},
+            ]},
+        ]}},
+        {"$project": {"fullDocument._id": 0, "fullDocument.migrated": 0, "fullDocument.comments": 0,
+                      "fullDocument.access_tokens": 0}}
+    ]
+    resume_token = None
+
+    while True:
+        try:
+            # One stream over the database keeps the comments and the versions of their locations in order
+            async with db_handler.DB.watch(pipeline, full_document="updateLookup",
+                                           resume_after=resume_token) as stream:
+                # Comments written while the stream was closed never reached the cache, start it over
+                comment_cache.clear()
+
+                async for change in stream:
+                    resume_token = stream.resume_token
+
+                    record_lag(change)
+
+                    document = change.get("fullDocument")
+                    if document is None:  # Removed before the update was looked up
+                        continue
+                    if change["ns"]["coll"] == "users":
+                        db_handler.invalidate_cached_user(document["email"])
+                        continue
+                    location = document.pop("location")
+
+                    if change["ns"]["coll"] == "comments":
+                        # The looked up location may be newer than this event, the version is taken from the event
+                        version = change.get("updateDescription", {}).get("updatedFields", document)
+                        comment_cache.set_version(location, version.get("max_comment_id"), version.get("revision", 0))
+                        continue
+
+                    comment = document
+                    if change["operationType"] == "insert":
+                        comment_cache.add(location, comment)
+                        await publish_comment(location, comment, "created")
+                    else:
+                        comment_cache.update(location, comment)
+                        await publish_comment(location, comment, "deleted" if comment.get("deleted") else "edited")
+        except OperationFailure as e:
+            if resume_token is not None and e.code in UNRESUMABLE_ERROR_CODES:
+                logger.warning("Comment hub can not resume its stream, starting from now: %s", e)
+                resume_token = None
+                db_handler.clear_cached_users()
+            else:
+                logger.exception("Comment hub stream failed: %s", e)
+        except Exception as e:
+            logger.exception("Comment hub stream failed: %s", e)
+
+        await sleep(HUB_RETRY_SECONDS)
+
+
+async def publish_comment(location: str, comment: dict, event: str) -> None:
+    """
+    Resolve the author of a changed comment once, then hand it to the connections of its location.
+
+    :param location: The location of the comment.
+    :param comment: The comment as stored.
+    :param event: "created", "edited" or "deleted".
+    """
+    if location not in SUBSCRIBERS:
+        return
+
+    comment = (await db_handler.resolve_authors([comment]))[0]
+
+    start = perf_counter()
+    publish(location, {"type": event, "comment": comment})
+    metrics.observe("comment_hub_fanout_duration_seconds", (), perf_counter() - start)
+
+
+def record_lag(change: dict) -> None:
+    """
+    Record how long a change stream event took to reach this process, from the time it was written.
+
+    :param change: The change stream event.
+    """
+    metrics.increment("comment_hub_events_total")
+
+    if change.get("wallTime"):  # MongoDB 6.0+, millisecond precision
+        written = change["wallTime"].replace(tzinfo=timezone.utc).timestamp()
+    elif change.get("clusterTime"):  # Second precision
+        written = change["clusterTime"].time
+    else:
+        return
+
+    metrics.set_gauge("comment_hub_lag_seconds", (), max(time() - written, 0.0))
+
+
+def count_connections() -> dict[tuple[tuple[str, str], ...], float]:
+    """
+    Count the WebSocket connections of every location, read when the metrics are scraped.
+
+    :return: The number of connections per location.
+    """
+    return {(("location", location),): len(queues) for location, queues in SUBSCRIBERS.items()}
+
+
+metrics.register_gauge("websocket_connections", count_connections)
+
+
+def subscribe(location: str) -> Queue:
+    """
+    Register a connection for the comment events of a location.
+
+    :param location: The location to listen to.
+    :return: The queue the events of the location are put in.
+    """
+    queue = Queue(WS_QUEUE_SIZE + 1)  # One more for RESYNC
+    SUBSCRIBERS.setdefault(location, set()).add(queue)
+    return queue
+
+
+def unsubscribe(location: str, queue: Queue) -> None:
+    """
+    Remove a connection from the registry.
+
+    :param location: The location the connection listened to.
+    :param queue: The queue returned by subscribe.
+    """
+    queues = SUBSCRIBERS.get(location)
+    if queues is None:
+        return
+
+    queues.discard(queue)
+    if not queues:
+        del SUBSCRIBERS[location]
+
+
+def publish(location: str, event: dict) -> None:
+    """
+    Hand a comment event to every connection of its location, only locations with connections cost anything.
+    Never waits for a connection: one whose queue is full has its events replaced by RESYNC and is unsubscribed,
+    so a slow client holds at most WS_QUEUE_SIZE events.
+
+    :param location: The location of the comment.
+    :param event: {"type": "created" | "edited" | "deleted", "comment": the comment}.
+    """
+    lagging = []
+    for queue in SUBSCRIBERS.get(location, ()):
+        if queue.qsize() < WS_QUEUE_SIZE:
+            queue.put_nowait(event)
+        else:
+            lagging.append(queue)
+
+    for queue in lagging:
+        unsubscribe(location, queue)
+        try:
+            while True:
+                queue.get_nowait()
+        except QueueEmpty:
+            queue.put_nowait(RESYNC)
+
+
+# === WEBSOCKET ===
+async def get_latest_comments_ws(location: str, websocket: WebSocket, last_id: int | None = None,
+                                 render_html: bool = False) -> None:
+    """
+    Get the latest comments for a location and send it to the WebSocket. (for real-time updates)
+    When the client reconnects with the last comment ID it saw, the comments posted since are sent first. Edits and
+    deletes made while it was away are not replayed, the client reads its pages again to get them.
+    Returns when the client disconnects, falls behind or goes idle.
+
+    Messages sent to the client:
+
+    - {"type": "created" | "edited" | "deleted", "comments": [...]}: Comments that were posted, edited or deleted,
+      in the order it happened. Every comment is sent whole, so the client can patch the one it shows by its ID.
+      Consecutive events of the same type that queued up while the client was busy are sent in one message.
+    - {"type": "ping"}: The client should answer with {"type": "pong"}.
+    - {"type": "resync"}: The client fell behind and is disconnected, it should reconnect with last_id.
+
+    :param location: The location to get the comments from.
+    :param websocket: The WebSocket to send the comments to.
+    :param last_id: The highest comment ID the client already has, None for a fresh connection.
+    :param render_html: True to include the rendered HTML of every comment.
+    """
+    # Subscribe before replaying, so comments posted during the replay are queued instead of lost
+    queue = subscribe(location)
+    last_received = monotonic()
+
+    async def send_comments() -> None:
+        replayed = set() if last_id is None else await replay_comments(location, websocket, last_id, render_html)
+        next_ping = monotonic() + WS_PING_INTERVAL_SECONDS
+
+        while True:
+            if not queue.empty():
+                event = queue.get_nowait()
+            else:
+                try:
+                    event = await wait_for(queue.get(), max(next_ping - monotonic(), 0.001))
+                except TimeoutError:
+                    event = None
+
+            if monotonic() >= next_ping:
+                if monotonic() - last_received > WS_IDLE_TIMEOUT_SECONDS:
+                    await close(websocket, "idle", 1001)
+                    return
+                await send_message(websocket, {"type": "ping"})
+                next_ping = monotonic() + WS_PING_INTERVAL_SECONDS
+
+            if event is None:
+                continue
+
+            # Everything that queued up while the last frame was sent goes out together
+            batch = [event]
+            while len(batch) < WS_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            if any(event is RESYNC for event in batch):
+                await send_message(websocket, RESYNC)
+                await close(websocket, "resync", 1013)
+                return
+
+            messages = []
+            for event in batch:
+                comment = event["comment"]
+                # Comments posted during the replay arrive twice, once from the database and once live
+                if event["type"] == "created" and comment["id"] in replayed:
+                    replayed.discard(comment["id"])
+                    continue
+
+                if not messages or messages[-1]["type"] != event["type"]:
+                    messages.append({"type": event["type"], "comments": []})
+                messages[-1]["comments"].append(comment_renderer.present_comment(comment, render_html))
+
+            for message in messages:
+                await send_message(websocket, message)
+
+    async def receive_messages() -> None:
+        # Any message counts as a sign of life, the pong is only there for clients with nothing else to say
+        nonlocal last_received
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            last_received = monotonic()
+
+    tasks = [create_task(send_comments()), create_task(receive_messages())]
+    try:
+        done, _ = await wait(tasks, return_when=FIRST_COMPLETED)
+        for task in done:
+            task.result()  # Raise the error of a failed send
+    except TimeoutError:
+        await close(websocket, "send_timeout", 1008)
+    finally:
+        for task in tasks:
+            task.cancel()
+        unsubscribe(location, queue)
+
+
+async def send_message(websocket: WebSocket, message: dict) -> None:
+    """
+    Send a message to a client, a client that does not take it within WS_SEND_TIMEOUT_SECONDS is given up on.
+
+    :param websocket: The WebSocket to send the message to.
+    :param message: The message.
+    :raises TimeoutError: If the client did not take the message in time.
+    """
+    await wait_for(websocket.send_text(dumps(message).decode("utf-8")), WS_SEND_TIMEOUT_SECONDS)
+
+
+async def close(websocket: WebSocket, reason: str, code: int) -> None:
+    """
+    Close a connection the server gives up on and count it.
+
+    :param websocket: The WebSocket to close.
+    :param reason: Why it is closed, resync, idle or send_timeout.
+    :param code: The WebSocket close code.
+    """
+    metrics.increment("websocket_closed_total", (("reason", reason),))
+    try:
+        await wait_for(websocket.close(code, reason), WS_SEND_TIMEOUT_SECONDS)
+    except Exception:
+        pass  # The connection is dropped by the server when the handler returns either way
+
+
+async def replay_comments(location: str, websocket: WebSocket, last_id: int, render_html: bool) -> set[int]:
+    """
+    Send the comments posted after last_id, oldest first and one frame per page, using index range reads on
+    (location, id). Comments up to last_id are not sent again, even if they were edited or deleted since.
+
+    :param location: The location to get the comments from.
+    :param websocket: The WebSocket to send the comments to.
+    :param last_id: The highest comment ID the client already has.
+    :param render_html: True to include the rendered HTML of every comment.
+    :return: The IDs of the replayed comments.
+    """
+    replayed = set()
+    after_id = last_id
+
+    while after_id is not None:
+        comments, after_id = await db_handler.get_comments(location, REPLAY_PAGE_SIZE, 1, False, after_id=after_id,
+                                                           render_html=render_html)
+        if comments:
+            await send_message(websocket, {"type": "created", "comments": comments})
+        replayed.update(comment["id"] for comment in comments)
+
+    return replayed
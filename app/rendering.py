@@ -0,0 +1,42 @@
+from markdown_it import MarkdownIt
+
+# Same preset as the markdown-it build the embed used to load in the browser: raw HTML is escaped and unsafe link
+# schemes (javascript:, vbscript:, file:, data:) are dropped, so the output can be inserted as is
+MARKDOWN = MarkdownIt("js-default")
+
+
+# === RENDERING ===
+def render_comment(comment: str) -> str:
+    """
+    Render the markdown of a comment to sanitized HTML, the same way the embed rendered it in the browser.
+
+    :param comment: The comment text.
+    :return: The HTML of the comment.
+    """
+    return MARKDOWN.render(comment).replace("\n", "<br>")
+
+
+def render_comments(comments: list[str]) -> list[str]:
+    """
+    Render a batch of comments, used by the backfill in worker processes.
+
+    :param comments: The comment texts.
+    :return: The HTML of every comment, in the same order.
+    """
+    return [render_comment(comment) for comment in comments]
+
+
+def present_comment(comment: dict, render_html: bool) -> dict:
+    """
+    Shape a stored comment for a client that did or did not ask for the rendered HTML.
+    Comments written before the HTML was stored are rendered on the fly.
+
+    :param comment: The comment, with only its public fields.
+    :param render_html: True if the client wants the "html" field.
+    :return: The comment with or without its "html" field.
+    """
+    if not render_html:
+        return {key: value for key, value in comment.items() if key != "html"} if "html" in comment else comment
+    if "html" not in comment:
+        return {**comment, "html": render_comment(comment["comment"])}
+    return comment
@@ -0,0 +1,226 @@
+from collections import Counter, OrderedDict
+from math import log
+from os import getenv
+from re import findall
+
+import app.database as db_handler
+import app.metrics as metrics
+import app.rendering as comment_renderer
+
+SEARCH_MAX_QUERY_LENGTH: int = 200  # Longer queries are rejected
+SEARCH_INDEX_MAX_LOCATIONS: int = 100  # Locations indexed in memory at once, the least recently searched are dropped
+
+# In-process inverted indexes for databases without text indexes (the in-memory stand-in), least recently used first,
+# location -> {
+#   "postings": word -> {comment ID -> occurrences},
+#   "documents": comment ID -> its words and their occurrences, None while the index is being built,
+#   "pending": comments changed while the index is being built }
+SEARCH_INDEXES: OrderedDict[str, dict] = OrderedDict()
+
+
+# === CONFIGURATION ===
+def configure_search() -> None:
+    """
+    Set up the search using the environment variables, and keep the in-process indexes up to date when the database
+    has no text index.
+
+    variables:
+
+    - SEARCH_INDEX_MAX_LOCATIONS: (optional) How many locations the in-process index keeps, default is 100.
+    """
+    global SEARCH_INDEX_MAX_LOCATIONS
+
+    SEARCH_INDEX_MAX_LOCATIONS = int(getenv("SEARCH_INDEX_MAX_LOCATIONS", SEARCH_INDEX_MAX_LOCATIONS))
+
+    if db_handler.MONGODB_BACKEND == "memory":
+        db_handler.COMMENT_LISTENERS.append(index_comment)
+
+
+# === SEARCH ===
+async def search_comments(location: str, query: str, limit: int, order: str, cursor: str | None,
+                          render_html: bool = False) -> tuple[list[dict], str | None]:
+    """
+    Search the comments of a location, with the text index of the database or the in-process index.
+
+    :param location: The location to search in.
+    :param query: The words to search for, a comment matches if it contains any of them.
+    :param limit: The number of comments per page.
+    :param order: "relevance" for the best matches first, "recent" for the newest first.
+    :param cursor: The next_cursor of the previous page, None for the first page.
+    :param render_html: True to include the rendered HTML of every comment.
+    :return: A tuple of the comments and the cursor for the next page (None if there are no more results).
+    """
+    query = query.strip()
+    if not query or len(query) > SEARCH_MAX_QUERY_LENGTH:
+        raise ValueError(f"The search query must be 1 to {SEARCH_MAX_QUERY_LENGTH} characters")
+    if order not in ("relevance", "recent"):
+        raise ValueError("Order must be relevance or recent")
+
+    after_score, after_id = parse_cursor(cursor, order)
+
+    if db_handler.MONGODB_BACKEND == "memory":
+        comments, last_score = await search_index(location, query, limit, order, after_score, after_id, render_html)
+    else:
+        comments, last_score = await db_handler.search_comments(location, query, limit, order, after_score,
+                                                                after_id, render_html)
+
+    if len(comments) < limit:
+        return comments, None
+    if order == "relevance":
+        return comments, f"{last_score!r}:{comments[-1]['id']}"
+    return comments, str(comments[-1]["id"])
+
+
+def parse_cursor(cursor: str | None, order: str) -> tuple[float | None, int | None]:
+    """
+    Read a search cursor, "<score>:<id>" for results by relevance and "<id>" for results by recency.
+
+    :param cursor: The cursor, None for the first page.
+    :param order: "relevance" or "recent".
+    :return: A tuple of the score and ID of the last result of the previous page, (None, None) for the first page.
+    """
+    if not cursor:
+        return None, None
+
+    try:
+        if order == "relevance":
+            score, _, comment_id = cursor.partition(":")
+            return float(score), int(comment_id)
+        return None, int(cursor)
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+
+# === IN-PROCESS INDEX ===
+@metrics.timed
+async def search_index(location: str, query: str, limit: int, order: str, after_score: float | None,
+                       after_id: int | None, render_html: bool) -> tuple[list[dict], float | None]:
+    """
+    Search a location with its in-process index, built on its first search.
+    Scored like a text index: every query word counts its occurrences in a comment, weighted by how rare it is.
+
+    :param location: The location to search in.
+    :param query: The words to search for.
+    :param limit: The number of comments per page.
+    :param order: "relevance" or "recent".
+    :param after_score: The score of the last result of the previous page, only with order "relevance".
+    :param after_id: The ID of the last result of the previous page, None for the first page.
+    :param render_html: True to include the rendered HTML of every comment.
+    :return: The same tuple as database.search_comments.
+    """
+    index = SEARCH_INDEXES.get(location)
+    if index is None or index["documents"] is None:
+        index = await build_index(location)
+    SEARCH_INDEXES.move_to_end(location)
+
+    scores = Counter()
+    documents = len(index["documents"]) or 1
+    for word in set(tokenize(query)):
+        postings = index["postings"].get(word, {})
+        weight = log(1 + documents / len(postings)) if postings else 0
+        for comment_id, occurrences in postings.items():
+            scores[comment_id] += occurrences * weight
+
+    # Rounded, so the score in the cursor compares equal to the one computed for the next page
+    results = [(round(score, 6), comment_id) for comment_id, score in scores.items()]
+    if order == "relevance":
+        if after_id is not None:
+            results = [result for result in results if result < (after_score, after_id)]
+        results.sort(reverse=True)
+    else:
+        if after_id is not None:
+            results = [result for result in results if result[1] < after_id]
+        results.sort(key=lambda result: result[1], reverse=True)
+    results = results[:limit]
+
+    ids = [comment_id for _, comment_id in results]
+    found = await db_handler.DB.comment_items.find(
+        {"location": location, "id": {"$in": ids}},
+        db_handler.COMMENT_PROJECTION if render_html else db_handler.COMMENT_TEXT_PROJECTION
+    ).to_list(length=None)
+    by_id = {comment["id"]: comment for comment in found}
+
+    comments = await db_handler.resolve_authors([by_id[comment_id] for comment_id in ids if comment_id in by_id])
+    if render_html:
+        comments = [comment_renderer.present_comment(comment, True) for comment in comments]
+    return comments, results[-1][0] if results and order == "relevance" else None
+
+
+async def build_index(location: str) -> dict:
+    """
+    Index every comment of a location. Comments changed while it is read are indexed once it is done.
+
+    :param location: The location to index.
+    :return: The index.
+    """
+    index = {"postings": {}, "documents": None, "pending": []}
+    SEARCH_INDEXES[location] = index
+    while len(SEARCH_INDEXES) > SEARCH_INDEX_MAX_LOCATIONS:
+        SEARCH_INDEXES.popitem(last=False)
+
+    try:
+        comments = await db_handler.DB.comment_items.find({"location": location},
+                                                          {"_id": 0, "id": 1, "comment": 1}).to_list(length=None)
+    except Exception:
+        if SEARCH_INDEXES.get(location) is index:
+            del SEARCH_INDEXES[location]
+        raise
+
+    index["documents"] = {}
+    for comment in comments + index.pop("pending"):
+        update_index(index, comment)
+    return index
+
+
+def index_comment(location: str, event: str, comment: dict) -> None:
+    """
+    Keep the index of a location up to date with a created, edited or deleted comment, if the location is indexed.
+
+    :param location: The location of the comment.
+    :param event: "created", "edited" or "deleted".
+    :param comment: The comment.
+    """
+    index = SEARCH_INDEXES.get(location)
+    if index is None:
+        return
+    if index["documents"] is None:
+        index["pending"].append(comment)
+        return
+
+    update_index(index, comment)
+
+
+def update_index(index: dict, comment: dict) -> None:
+    """
+    Replace the words of a comment in an index, a deleted comment is removed from it.
+
+    :param index: The index of the location of the comment.
+    :param comment: The comment.
+    """
+    comment_id = comment["id"]
+    for word in index["documents"].pop(comment_id, {}):
+        postings = index["postings"][word]
+        del postings[comment_id]
+        if not postings:
+            del index["postings"][word]
+
+    if comment.get("deleted"):
+        return
+
+    words = Counter(tokenize(comment["comment"]))
+    if not words:
+        return
+
+    index["documents"][comment_id] = words
+    for word, occurrences in words.items():
+        index["postings"].setdefault(word, {})[comment_id] = occurrences
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Split a text into lower case words, the way the text index of the database does without a language.
+
+    :param text: The text.
+    :return: The words, in order and with repeats.
+    """
+    return findall(r"\w+", text.lower())
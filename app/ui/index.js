@@ -16,10 +16,9 @@ let user = {
     color: '#1d3557'
 }
 let verificationEmail = '';
-let currentPagination = 1;
+let pageCursor = null; // next_cursor of the last loaded page, "load more" gets the comments older than it
 let ws = null;
-let loadedRealTimeComments = 0;
-let doneFirstLoad = false;
+let lastCommentId = null; // Highest comment id seen, sent on reconnect to replay missed comments
 
 // HTML
 const commentWindow = document.getElementById('comment-window');
@@ -338,20 +337,42 @@ function escapeHTML(str) {
         .replaceAll(/'/g, '&#039;');
 }
 
+/**
+ * Gets the HTML shown for a comment, a placeholder for a deleted one.
+ * @param comment - The comment from the API.
+ * @returns {string} - The comment, rendered from markdown and sanitized by the server.
+ */
+function commentBody(comment) {
+    return comment.deleted ? '<p><em>This comment was deleted.</em></p>' : comment.html;
+}
+
+/**
+ * Shows the new version of an edited or deleted comment, if it is on screen.
+ * @param comment - The comment from the API.
+ */
+function patchComment(comment) {
+    const commentText = commentWindow.querySelector(`[data-comment-id="${comment.id}"] .comment-text`);
+    if (commentText) {
+        commentText.innerHTML = commentBody(comment);
+    }
+}
+
 /**
  * Generates and appends a comment element to the comment window.
+ * @param {number} commentId - The comment id, used to find the comment when it is edited or deleted.
  * @param {string} initial - The user's initial.
  * @param {string} initialColor - The background color for the initial.
  * @param {string} username
  * @param {string} email
  * @param {string} date
  * @param {string} time
- * @param {string} commentText
+ * @param {string} commentHtml - The comment, rendered from markdown and sanitized by the server.
  * @param {boolean} [latest=false] - If true, the comment is added at the top with animation.
  */
-function addComment(initial, initialColor, username, email, date, time, commentText, latest = false) {
+function addComment(commentId, initial, initialColor, username, email, date, time, commentHtml, latest = false) {
     // Create comment container
     const commentBox = document.createElement('div');
+    commentBox.dataset.commentId = commentId;
     setStyles(commentBox, {
         position: 'relative',
         backgroundColor: '#f0f0f0',
@@ -448,9 +469,10 @@ function addComment(initial, initialColor, username, email, date, time, commentT
 
     // Comment text element
     const commentTextElement = document.createElement('div');
+    commentTextElement.className = 'comment-text';
     commentTextElement.style.marginTop = '5px';
-    // Escape HTML and render markdown
-    commentTextElement.innerHTML = window.markdownit().render(commentText).replace(/\n/g, '<br>');
+    // The server renders the markdown and escapes HTML
+    commentTextElement.innerHTML = commentHtml;
     commentBox.appendChild(commentTextElement);
 
     // Insert comment into DOM for height measurement
@@ -582,28 +604,29 @@ function showSignInOrOut() {
 }
 
 /**
- * Gets the comments for the given page.
- * @param page - The page number.
- * @returns {*[]} - The comments.
+ * Gets a page of comments, the newest one or the one older than a cursor.
+ * Pages read by cursor do not shift when new comments are posted, so no comment is shown twice or skipped.
+ * IDs can have gaps, so a page may hold fewer comments than asked for, only a null cursor means there are no more.
+ * @param beforeId - The next_cursor of the previous page, null for the newest page.
+ * @returns {{comments: *[], nextCursor: (number|null)}} - The comments and the cursor of the next page.
  */
-async function getComments(page) {
+async function getComments(beforeId) {
     let comments = [];
+    let nextCursor = null;
 
-    const path = 'comment/' + commentLocation + '?comment_per_page=' + commentAmountPerPage + '&page=' + page;
+    const path = 'comment/' + commentLocation + '?comment_per_page=' + commentAmountPerPage + (beforeId === null ? '' : '&before_id=' + beforeId) + '&format=json&render_html=true';
     await sendToApi('GET', path, accessToken)
         .then(response => {
             if (response.statusCode === 200) {
-                comments = JSON.parse(response.jsonResponse.comments
-                    .replaceAll(/'/g, '"')
-                    .replaceAll(/True/g, 'true')
-                    .replaceAll(/False/g, 'false'));
+                comments = response.jsonResponse.comments;
+                nextCursor = response.jsonResponse.next_cursor;
             } else {
                 // Show error message
                 console.error(response.jsonResponse.message);
             }
         });
 
-    return comments;
+    return {comments, nextCursor};
 }
 
 /**
@@ -613,7 +636,8 @@ async function initComment() {
     // Show loading spinner
     toggleSpinner(commentWindow, true, 'comments-spinner');
 
-    const comments = await getComments(1);
+    const {comments, nextCursor} = await getComments(null);
+    pageCursor = nextCursor;
 
     // Hide loading spinner
     toggleSpinner(commentWindow, false, 'comments-spinner');
@@ -624,7 +648,9 @@ async function initComment() {
             emptyComment.style.display = 'none';
         }
 
-        if (comments.length < commentAmountPerPage) {
+        lastCommentId = Math.max(lastCommentId ?? -1, comments[0].id);
+
+        if (nextCursor === null) {
             noMoreComment.style.display = 'block';
         } else {
             loadMoreContainer.style.display = 'block';
@@ -633,13 +659,14 @@ async function initComment() {
         // Add comments to the UI
         comments.forEach(comment => {
             addComment(
+                comment.id,
                 comment.initial,
                 comment.color,
                 comment.username,
                 comment.email,
                 comment.date,
                 comment.time,
-                comment.comment
+                commentBody(comment)
             );
         });
     }
@@ -654,28 +681,55 @@ function connectWebSocket() {
     }
 
     try {
-        ws = new WebSocket(wsUrl);
+        ws = new WebSocket(wsUrl + '?render_html=true' + (lastCommentId === null ? '' : '&last_id=' + lastCommentId));
 
         ws.onopen = function () {
             console.log('WebSocket connection established');
         };
 
         ws.onmessage = function (event) {
-            const comment = JSON.parse(event.data);
-            // Add new comment at the top with animation
-            addComment(
-                comment.initial,
-                comment.color,
-                comment.username,
-                comment.email,
-                comment.date,
-                comment.time,
-                comment.comment,
-                true
-            );
+            const message = JSON.parse(event.data);
+
+            if (message.type === 'ping') {
+                // Tell the server this comment section is still open
+                ws.send(JSON.stringify({type: 'pong'}));
+                return;
+            }
+
+            if (message.type === 'resync') {
+                // The server is closing the connection, the missed comments are replayed when it reconnects
+                console.log('WebSocket fell behind, resyncing');
+                return;
+            }
+
+            if (message.type === 'edited' || message.type === 'deleted') {
+                message.comments.forEach(patchComment);
+                return;
+            }
+
+            if (message.type !== 'created') {
+                return;
+            }
+
+            // Comments arrive oldest first, so the newest one ends up at the top
+            message.comments.forEach(comment => {
+                lastCommentId = Math.max(lastCommentId ?? -1, comment.id);
+                // Add new comment at the top with animation
+                addComment(
+                    comment.id,
+                    comment.initial,
+                    comment.color,
+                    comment.username,
+                    comment.email,
+                    comment.date,
+                    comment.time,
+                    commentBody(comment),
+                    true
+                );
+            });
 
             // Hide empty comment message if it's showing
-            if (emptyComment) {
+            if (emptyComment && message.comments.length > 0) {
                 emptyComment.style.display = 'none';
                 noMoreComment.style.display = 'block';
             }
@@ -886,32 +940,27 @@ loadMoreContainer.addEventListener('click', async () => {
     // Make icon spin continuously while loading
     loadMoreIcon.style.animation = 'spin 1s linear infinite';
 
-    currentPagination += 1;
-    let comments = await getComments(currentPagination);
-
-    if (loadedRealTimeComments > 0 && !doneFirstLoad) {
-        // omit the comments that are already loaded
-        comments = comments.slice(loadedRealTimeComments, comments.length)
-        doneFirstLoad = true;
-    }
+    const {comments, nextCursor} = await getComments(pageCursor);
+    pageCursor = nextCursor;
 
     // Stop spinning animation when comments are loaded
     loadMoreIcon.style.animation = '';
 
-    if (comments && comments.length > 0) {
+    if (nextCursor !== null || (comments && comments.length > 0)) {
         comments.forEach(comment => {
             addComment(
+                comment.id,
                 comment.initial,
                 comment.color,
                 comment.username,
                 comment.email,
                 comment.date,
                 comment.time,
-                comment.comment
+                commentBody(comment)
             );
         });
 
-        if (comments.length < commentAmountPerPage) {
+        if (nextCursor === null) {
             noMoreComment.style.display = 'block';
             loadMoreContainer.style.display = 'none';
         }
@@ -947,7 +996,6 @@ commentButton.addEventListener('click', async () => {
 
                 // Scroll to top
                 commentWindow.scrollTop = 0;
-                loadedRealTimeComments += 1;
             } else {
                 // Show error message
                 console.error(response.jsonResponse.message);
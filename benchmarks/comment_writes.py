@@ -0,0 +1,72 @@
+"""
+Throughput benchmark for the comment write path, one write per comment vs the group-commit coalescer.
+
+Posts bursts of concurrent comments to a single location and reports the comments written per second.
+Needs the same environment variables as the app (refer to README.md), the benchmark location is deleted afterwards.
+With COMMENT_ID_BLOCK_SIZE above 1 the benchmark takes the comment ID lease, while an app worker holds it the
+benchmark takes its IDs one at a time instead.
+
+Usage:
+```bash
+python -m benchmarks.comment_writes
+```
+"""
+from asyncio import gather, run
+from time import perf_counter
+
+import app.database as db_handler
+
+LOCATION = "benchmark-comment-writes"
+COMMENTS = 2000
+CONCURRENCY = (1, 50, 200)
+BATCH_WINDOWS_MS = (0, 2, 10)
+
+
+async def post_burst(concurrency: int) -> float:
+    """
+    Post COMMENTS comments, concurrency of them at a time.
+
+    :param concurrency: How many comments are in flight at once.
+    :return: The comments written per second.
+    """
+    async def post(index: int) -> None:
+        await db_handler.post_comment("john.doe@example.com", "John Doe", "#1d3557", "JD", LOCATION,
+                                      f"Benchmark comment {index}")
+
+    start = perf_counter()
+    for offset in range(0, COMMENTS, concurrency):
+        await gather(*(post(index) for index in range(offset, min(offset + concurrency, COMMENTS))))
+    return COMMENTS / (perf_counter() - start)
+
+
+async def clear_location() -> None:
+    await db_handler.DB.comments.delete_many({"location": LOCATION})
+    await db_handler.DB.comment_items.delete_many({"location": LOCATION})
+    # The rest of a reserved block would continue the deleted thread, the next run starts from a new counter
+    db_handler.COMMENT_ID_BLOCKS.pop(LOCATION, None)
+
+
+async def main() -> None:
+    await db_handler.get_database()
+    await db_handler.ensure_indexes()
+    await db_handler.hold_comment_id_lease()
+
+    print(f"{COMMENTS} comments to one location, comments per second")
+    print(f"  {'window':<10}" + "".join(f"{f'{concurrency} at once':>16}" for concurrency in CONCURRENCY))
+    try:
+        for window in BATCH_WINDOWS_MS:
+            db_handler.COMMENT_BATCH_WINDOW_MS = window
+            results = []
+            for concurrency in CONCURRENCY:
+                await clear_location()
+                results.append(await post_burst(concurrency))
+
+            label = f"{window} ms" if window else "off"
+            print(f"  {label:<10}" + "".join(f"{result:>16.0f}" for result in results))
+    finally:
+        await clear_location()
+        await db_handler.release_comment_id_lease()
+
+
+if __name__ == "__main__":
+    run(main())
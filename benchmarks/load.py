@@ -0,0 +1,328 @@
+"""
+Load benchmark for the app, reported as JSON so results can be compared between commits.
+
+Starts the app (benchmarks.server) against a throwaway local mongod or the in-memory stand-in and runs:
+
+- post_burst: concurrent comment posts to a single location.
+- deep_pagination_page / deep_pagination_cursor: random deep pages of a large thread, by page number and by cursor.
+- token_reads: GET /user with an access token.
+- websocket_fanout: comments posted while N WebSocket clients listen, latency from the post to every delivery.
+
+Every scenario reports the number of requests, errors, throughput and p50/p95/p99 latency in milliseconds.
+
+Usage:
+```bash
+python -m benchmarks.load --backend memory
+python -m benchmarks.load --backend mongod --output results.json  # Needs mongod on the PATH
+```
+
+The in-memory stand-in scans every document on every query, so its default thread is small and its numbers only show
+relative changes in the app code. Use mongod to measure the database work.
+"""
+from argparse import ArgumentParser
+from asyncio import create_subprocess_exec, gather, run, sleep, wait_for, Semaphore, get_running_loop, Event
+from asyncio.subprocess import PIPE
+from datetime import datetime, timezone
+from json import dumps, loads
+from os import environ
+from pathlib import Path
+from platform import python_version
+from random import Random
+from shutil import which
+from subprocess import DEVNULL, Popen, run as run_process
+from sys import executable, stderr
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep as block
+
+from httpx import AsyncClient, Limits
+from pymongo import MongoClient
+from websockets.asyncio.client import connect
+
+PROJECT_DIRECTORY = Path(__file__).resolve().parent.parent
+DEEP_LOCATION = "benchmark/deep-thread"
+BURST_LOCATION = "benchmark/burst"
+FANOUT_LOCATION = "benchmark/fanout"
+PAGE_SIZE = 30
+
+# Default size of every scenario per backend
+DEFAULTS: dict[str, dict[str, int]] = {
+    "mongod": {"thread_size": 100000, "posts": 2000, "pages": 500, "reads": 5000, "subscribers": 100,
+               "fanout_posts": 50},
+    "memory": {"thread_size": 2000, "posts": 500, "pages": 100, "reads": 5000, "subscribers": 100,
+               "fanout_posts": 20},
+}
+
+
+# === MEASURING ===
+def summarize(latencies: list[float], errors: int, duration: float, extra: dict | None = None) -> dict:
+    """
+    Summarize the latencies of a scenario.
+
+    :param latencies: The latency of every successful request in seconds.
+    :param errors: The number of failed requests.
+    :param duration: The wall time of the scenario in seconds.
+    :param extra: More fields to report.
+    :return: The scenario report.
+    """
+    latencies = sorted(latencies)
+
+    def percentile(fraction: float) -> float | None:
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 3)
+
+    return {
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "duration_seconds": round(duration, 3),
+        "throughput_per_second": round(len(latencies) / duration, 1) if duration else None,
+        "latency_ms": {"p50": percentile(0.50), "p95": percentile(0.95), "p99": percentile(0.99),
+                       "max": percentile(1.0)},
+        **(extra or {}),
+    }
+
+
+async def drive(requests: list, concurrency: int) -> tuple[list[float], int, float]:
+    """
+    Run requests with a bounded number in flight and time each of them.
+
+    :param requests: Functions that start one request and return a response with a status code.
+    :param concurrency: How many requests are in flight at once.
+    :return: A tuple of (latencies of the successful requests, errors, wall time).
+    """
+    semaphore = Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def timed(request) -> None:
+        nonlocal errors
+        async with semaphore:
+            start = perf_counter()
+            try:
+                response = await request()
+                if response.status_code >= 400:
+                    errors += 1
+                    return
+            except Exception:
+                errors += 1
+                return
+            latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    await gather(*(timed(request) for request in requests))
+    return latencies, errors, perf_counter() - start
+
+
+# === SCENARIOS ===
+async def post_burst(client: AsyncClient, posts: int, concurrency: int) -> dict:
+    requests = [lambda index=index: client.post(f"/comment/{BURST_LOCATION}", json={"comment": f"Burst {index}"})
+                for index in range(posts)]
+    latencies, errors, duration = await drive(requests, concurrency)
+    return summarize(latencies, errors, duration, {"concurrency": concurrency})
+
+
+async def deep_pagination_page(client: AsyncClient, thread_size: int, pages: int, concurrency: int) -> dict:
+    random = Random(0)
+    last_page = max(1, thread_size // PAGE_SIZE)
+    requests = [lambda page=random.randint(1, last_page): client.get(
+        f"/comment/{DEEP_LOCATION}", params={"comment_per_page": PAGE_SIZE, "page": page, "format": "json"})
+        for _ in range(pages)]
+    latencies, errors, duration = await drive(requests, concurrency)
+    return summarize(latencies, errors, duration, {"thread_size": thread_size, "concurrency": concurrency})
+
+
+async def deep_pagination_cursor(client: AsyncClient, thread_size: int, pages: int, concurrency: int) -> dict:
+    random = Random(1)
+    requests = [lambda before_id=random.randint(PAGE_SIZE, thread_size): client.get(
+        f"/comment/{DEEP_LOCATION}", params={"comment_per_page": PAGE_SIZE, "before_id": before_id, "format": "json"})
+        for _ in range(pages)]
+    latencies, errors, duration = await drive(requests, concurrency)
+    return summarize(latencies, errors, duration, {"thread_size": thread_size, "concurrency": concurrency})
+
+
+async def token_reads(client: AsyncClient, access_token: str, reads: int, concurrency: int) -> dict:
+    requests = [lambda: client.get("/user", headers={"Bearer": access_token}) for _ in range(reads)]
+    latencies, errors, duration = await drive(requests, concurrency)
+    return summarize(latencies, errors, duration, {
+        "concurrency": concurrency, "token": "signed" if access_token.startswith("v2.") else "legacy"})
+
+
+async def websocket_fanout(client: AsyncClient, ws_url: str, subscribers: int, posts: int) -> dict:
+    """
+    Connect the subscribers, post comments one by one and time every delivery from the moment its post was sent.
+    """
+    sent_at = {}
+    latencies = []
+    expected = subscribers * posts
+    done = Event()
+
+    async def listen(websocket) -> None:
+        async for message in websocket:
+            received = perf_counter()
+            message = loads(message)
+            if message.get("type") == "ping":
+                await websocket.send('{"type": "pong"}')
+            if message.get("type") != "created":
+                continue
+            for comment in message["comments"]:
+                text = comment.get("comment", "")
+                if text in sent_at:
+                    latencies.append(received - sent_at[text])
+                    if len(latencies) >= expected:
+                        done.set()
+
+    websockets = [await connect(f"{ws_url}/comment/{FANOUT_LOCATION}") for _ in range(subscribers)]
+    listeners = [get_running_loop().create_task(listen(websocket)) for websocket in websockets]
+    await sleep(0.5)  # Let every connection subscribe
+
+    errors = 0
+    start = perf_counter()
+    for index in range(posts):
+        text = f"Fanout {index}"
+        sent_at[text] = perf_counter()
+        response = await client.post(f"/comment/{FANOUT_LOCATION}", json={"comment": text})
+        if response.status_code >= 400:
+            errors += subscribers
+
+    try:
+        await wait_for(done.wait(), 30)
+    except TimeoutError:
+        pass
+    duration = perf_counter() - start
+
+    for listener in listeners:
+        listener.cancel()
+    await gather(*(websocket.close() for websocket in websockets), return_exceptions=True)
+
+    missing = expected - len(latencies) - errors
+    return summarize(latencies, errors + max(missing, 0), duration,
+                     {"subscribers": subscribers, "posts": posts, "deliveries": len(latencies)})
+
+
+# === BACKENDS ===
+def start_mongod(directory: str, port: int) -> tuple[Popen, dict[str, str]]:
+    """
+    Start a throwaway single node replica set (change streams need one) with a user for the app.
+
+    :param directory: The data directory.
+    :param port: The port to listen on.
+    :return: The mongod process and the environment variables for the app.
+    """
+    process = Popen([which("mongod"), "--dbpath", directory, "--port", str(port), "--bind_ip", "127.0.0.1",
+                     "--replSet", "benchmark"], stdout=DEVNULL, stderr=DEVNULL)
+
+    client = MongoClient("127.0.0.1", port, directConnection=True, serverSelectionTimeoutMS=30000)
+    client.admin.command("replSetInitiate", {"_id": "benchmark", "members": [{"_id": 0, "host": f"127.0.0.1:{port}"}]})
+    while not client.admin.command("hello").get("isWritablePrimary"):
+        block(0.2)
+    client.benchmark.command("createUser", "benchmark", pwd="benchmark", roles=["readWrite"])
+    client.close()
+
+    return process, {"MONGODB_USERNAME": "benchmark", "MONGODB_PASSWORD": "benchmark", "MONGODB_DATABASE": "benchmark",
+                     "MONGODB_HOST": "127.0.0.1", "MONGODB_PORT": str(port)}
+
+
+async def start_app(environment: dict[str, str], port: int, thread_size: int):
+    """
+    Start benchmarks.server and wait until it accepts requests.
+
+    :return: The app process and the access token of the benchmark user.
+    """
+    process = await create_subprocess_exec(executable, "-m", "benchmarks.server", "--port", str(port),
+                                           "--thread-size", str(thread_size), cwd=PROJECT_DIRECTORY,
+                                           env=environment, stdout=PIPE)
+
+    async def wait_until_ready() -> str:
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                raise RuntimeError("The app stopped before it was ready")
+            if line.startswith(b"READY "):
+                return line.decode("utf-8").split(" ", 1)[1].strip()
+
+    return process, await wait_for(wait_until_ready(), 600)
+
+
+def get_commit() -> str | None:
+    result = run_process(["git", "rev-parse", "--short", "HEAD"], cwd=PROJECT_DIRECTORY, capture_output=True,
+                         text=True)
+    return result.stdout.strip() or None
+
+
+async def main() -> None:
+    parser = ArgumentParser(description="Load benchmark for the comment section")
+    parser.add_argument("--backend", choices=DEFAULTS.keys(), default="memory")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--mongod-port", type=int, default=27117)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    for name, value in DEFAULTS["mongod"].items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, help=f"default {value} with mongod")
+    args = parser.parse_args()
+
+    sizes = {name: getattr(args, name) or value for name, value in DEFAULTS[args.backend].items()}
+
+    # Rate limits would throttle the load itself, and the app should not write to the real database or mail relay
+    environment = {**environ, "MONGODB_BACKEND": args.backend if args.backend == "memory" else "mongodb",
+                   "EMAIL_SERVICE_URL": "http://127.0.0.1:9/email"}
+    environment.update({f"RATE_LIMIT_{name}": "0" for name in ("TOKEN_PER_IP", "TOKEN_PER_EMAIL", "VERIFY_PER_IP",
+                                                             "VERIFY_PER_EMAIL", "COMMENT_PER_IP",
+                                                             "COMMENT_PER_LOCATION")})
+    if args.backend == "memory" and not environment.get("ACCESS_TOKEN_SIGNING_KEYS"):
+        # The stand-in can not run the positional projection that looks up legacy access tokens
+        environment["ACCESS_TOKEN_SIGNING_KEYS"] = "benchmark:benchmark-signing-key"
+    for name, value in (("ACCESS_TOKEN_EXPIRATION_DAYS", "30"), ("VERIFICATION_CODE_EXPIRATION_MINUTES", "10"),
+                        ("CLEANUP_INTERVAL_SECONDS", "86400")):
+        environment.setdefault(name, value)
+
+    with TemporaryDirectory() as directory:
+        mongod = None
+        if args.backend == "mongod":
+            if not which("mongod"):
+                raise SystemExit("mongod was not found on the PATH, use --backend memory")
+            mongod, mongodb_environment = start_mongod(directory, args.mongod_port)
+            environment.update(mongodb_environment)
+
+        app, access_token = await start_app(environment, args.port, sizes["thread_size"])
+        try:
+            base_url = f"http://127.0.0.1:{args.port}"
+            limits = Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+            async with AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+                scenarios = {}
+                print("post_burst", file=stderr)
+                scenarios["post_burst"] = await post_burst(client, sizes["posts"], args.concurrency)
+                print("deep_pagination", file=stderr)
+                scenarios["deep_pagination_page"] = await deep_pagination_page(
+                    client, sizes["thread_size"], sizes["pages"], min(args.concurrency, 10))
+                scenarios["deep_pagination_cursor"] = await deep_pagination_cursor(
+                    client, sizes["thread_size"], sizes["pages"], min(args.concurrency, 10))
+                print("token_reads", file=stderr)
+                scenarios["token_reads"] = await token_reads(client, access_token, sizes["reads"], args.concurrency)
+                print("websocket_fanout", file=stderr)
+                scenarios["websocket_fanout"] = await websocket_fanout(
+                    client, base_url.replace("http://", "ws://"), sizes["subscribers"], sizes["fanout_posts"])
+        finally:
+            app.terminate()
+            await app.wait()
+            if mongod:
+                mongod.terminate()
+                mongod.wait()
+
+    report = {
+        "commit": get_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "backend": args.backend,
+        "python": python_version(),
+        "sizes": sizes,
+        "scenarios": scenarios,
+    }
+
+    output = dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n", encoding="utf-8")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    run(main())
@@ -0,0 +1,64 @@
+"""
+Micro-benchmark for the GET /comment payload serialization.
+
+Compares the legacy str() representation with the JSON serializers for a page of 30 and 500 comments.
+
+Usage:
+```bash
+python -m benchmarks.serialization
+```
+"""
+from json import dumps
+from timeit import repeat
+
+from orjson import dumps as orjson_dumps
+from pydantic import TypeAdapter
+
+from app.main import CommentData
+
+PAGE_SIZES = (30, 500)
+REPEAT = 5
+
+
+def make_comments(amount: int) -> list[dict]:
+    """
+    Build a page of comments shaped like the documents returned by the database.
+
+    :param amount: The number of comments in the page.
+    :return: A list of comments.
+    """
+    return [{
+        "id": i,
+        "email": "john.doe@example.com",
+        "username": "John Doe",
+        "color": "#1d3557",
+        "initial": "JD",
+        "comment": "This is a comment with some **markdown** in it. " * 4,
+        "date": "1980-01-31",
+        "time": "01:23:45"
+    } for i in range(amount)]
+
+
+def main() -> None:
+    comments_adapter = TypeAdapter(list[CommentData])
+
+    serializers = {
+        "str (legacy)": lambda comments: str(comments).encode("utf-8"),
+        "json": lambda comments: dumps(comments).encode("utf-8"),
+        "pydantic": lambda comments: comments_adapter.dump_json(comments_adapter.validate_python(comments)),
+        "orjson": orjson_dumps,
+    }
+
+    for page_size in PAGE_SIZES:
+        comments = make_comments(page_size)
+        number = max(1, 30000 // page_size)
+
+        print(f"{page_size} comments per page ({number} runs, best of {REPEAT})")
+        for name, serializer in serializers.items():
+            best = min(repeat(lambda: serializer(comments), number=number, repeat=REPEAT)) / number
+            size = len(serializer(comments))
+            print(f"  {name:<14} {best * 1e6:>10.1f} us {size:>10} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Start the app for the load benchmark, with a seeded comment thread and a signed in user.
+
+Started by benchmarks.load, which passes the database through the same environment variables as the app.
+Prints "READY <access token>" once the app accepts requests.
+
+Usage:
+```bash
+python -m benchmarks.server --port 8765 --thread-size 100000
+```
+"""
+from argparse import ArgumentParser
+from asyncio import run
+from datetime import datetime
+
+from uvicorn import Config, Server
+
+import app.database as db_handler
+import app.rendering as comment_renderer
+from app.main import app
+
+DEEP_LOCATION = "benchmark/deep-thread"
+USER_EMAIL = "benchmark@example.com"
+SEED_BATCH_SIZE = 10000
+
+
+async def seed_thread(size: int) -> None:
+    """
+    Write a thread of comments to DEEP_LOCATION in the current layout, unless it is already there.
+
+    :param size: The number of comments in the thread.
+    """
+    location_data = await db_handler.DB.comments.find_one({"location": DEEP_LOCATION})
+    if location_data and location_data.get("max_comment_id") == size - 1:
+        return
+
+    await db_handler.DB.comments.delete_many({"location": DEEP_LOCATION})
+    await db_handler.DB.comment_items.delete_many({"location": DEEP_LOCATION})
+
+    text = "A comment with some **markdown** in it, long enough to look like a real one. " * 2
+    comment = {"author": USER_EMAIL, "comment": text, "html": comment_renderer.render_comment(text),
+               "date": "1980-01-31", "time": "01:23:45"}
+
+    for start in range(0, size, SEED_BATCH_SIZE):
+        await db_handler.DB.comment_items.insert_many([
+            {**comment, "id": comment_id, "location": DEEP_LOCATION}
+            for comment_id in range(start, min(start + SEED_BATCH_SIZE, size))
+        ])
+
+    await db_handler.DB.comments.insert_one({"location": DEEP_LOCATION, "max_comment_id": size - 1,
+                                             "next_comment_id": size, "comment_count": size,
+                                             "layout": db_handler.COMMENT_LAYOUT_VERSION})
+
+
+async def seed_user() -> str:
+    """
+    Create the benchmark user and sign it in.
+
+    :return: An access token of the user.
+    """
+    await db_handler.DB.users.delete_many({"email": USER_EMAIL})
+
+    if db_handler.ACCESS_TOKEN_SIGNING_KEY_ID:
+        access_token = db_handler.generate_signed_access_token(USER_EMAIL)
+        access_tokens = []
+    else:
+        access_token = db_handler.generate_access_token(USER_EMAIL)
+        access_tokens = [{"accessToken": access_token, "timestamp": datetime.now()}]
+
+    await db_handler.DB.users.insert_one({"email": USER_EMAIL, "username": "Benchmark", "color": "#1d3557",
+                                          "initial": "BM", "access_tokens": access_tokens})
+    return access_token
+
+
+async def main() -> None:
+    parser = ArgumentParser(description="Start the app for the load benchmark")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--thread-size", type=int, default=100000)
+    args = parser.parse_args()
+
+    await db_handler.get_database()
+    await db_handler.ensure_indexes()
+    await seed_thread(args.thread_size)
+    access_token = await seed_user()
+
+    server = Server(Config(app, host="127.0.0.1", port=args.port, log_level="warning"))
+    original_startup = server.startup
+
+    async def startup(*startup_args, **startup_kwargs) -> None:
+        await original_startup(*startup_args, **startup_kwargs)
+        print(f"READY {access_token}", flush=True)
+
+    server.startup = startup
+    await server.serve()
+
+
+if __name__ == "__main__":
+    run(main())
@@ -0,0 +1,102 @@
+"""
+Signed access tokens: only a token signed with a listed key, not expired and not revoked may be accepted.
+
+Runs on the in-memory stand-in, so it needs mongomock-motor but no MongoDB.
+
+Usage:
+```bash
+pip install pytest mongomock-motor
+python -m pytest tests
+```
+"""
+from asyncio import run
+from time import time
+
+import pytest
+
+pytest.importorskip("mongomock_motor")
+
+import app.database as db_handler
+
+EMAIL = "reader@example.com"
+
+
+@pytest.fixture(autouse=True)
+def memory_database(monkeypatch):
+    """
+    Give every test its own in-memory database, signing keys and denylist, the settings are restored afterward.
+    """
+    monkeypatch.setenv("MONGODB_BACKEND", "memory")
+    monkeypatch.setenv("ACCESS_TOKEN_SIGNING_KEYS", "current:first-secret,previous:second-secret")
+    monkeypatch.setattr(db_handler, "DB", None, raising=False)
+    for name, value in (("MEMORY_DATABASE", None), ("REVOKED_ACCESS_TOKENS", {}),
+                        ("ACCESS_TOKEN_SIGNING_KEYS", {}), ("ACCESS_TOKEN_SIGNING_KEY_ID", None),
+                        ("ACCESS_TOKEN_EXPIRATION_DAYS", 30)):
+        monkeypatch.setattr(db_handler, name, value)
+    run(db_handler.get_database())
+
+
+def test_token_verifies_with_its_key():
+    token = db_handler.generate_signed_access_token(EMAIL)
+
+    assert token.startswith(f"{db_handler.SIGNED_ACCESS_TOKEN_PREFIX}current.")
+    assert db_handler.verify_signed_access_token(token)["email"] == EMAIL
+
+
+def test_tampered_signature_is_rejected():
+    token = db_handler.generate_signed_access_token(EMAIL)
+    tampered = token[:-1] + ("A" if token[-1] != "A" else "B")
+
+    with pytest.raises(ValueError):
+        db_handler.verify_signed_access_token(tampered)
+
+
+def test_unknown_key_id_is_rejected():
+    _, _, payload, signature = db_handler.generate_signed_access_token(EMAIL).split(".")
+
+    with pytest.raises(ValueError):
+        db_handler.verify_signed_access_token(f"{db_handler.SIGNED_ACCESS_TOKEN_PREFIX}unknown.{payload}.{signature}")
+
+
+def test_expired_token_is_rejected(monkeypatch):
+    issued = time() - (db_handler.ACCESS_TOKEN_EXPIRATION_DAYS * 86400 + 60)
+    with monkeypatch.context() as patch:
+        patch.setattr(db_handler, "time", lambda: issued)
+        token = db_handler.generate_signed_access_token(EMAIL)
+
+    with pytest.raises(ValueError, match="expired"):
+        db_handler.verify_signed_access_token(token)
+
+
+def test_revoked_token_is_rejected():
+    token = db_handler.generate_signed_access_token(EMAIL)
+
+    run(db_handler.revoke_access_token(token))
+
+    with pytest.raises(ValueError, match="revoked"):
+        db_handler.verify_signed_access_token(token)
+
+
+def test_token_of_a_rotated_out_key_is_rejected(monkeypatch):
+    # Signed while the old key was still the first one
+    monkeypatch.setenv("ACCESS_TOKEN_SIGNING_KEYS", "previous:second-secret")
+    run(db_handler.get_database())
+    token = db_handler.generate_signed_access_token(EMAIL)
+
+    # Rotated: the old key is still listed for a while, then removed
+    monkeypatch.setenv("ACCESS_TOKEN_SIGNING_KEYS", "current:first-secret,previous:second-secret")
+    run(db_handler.get_database())
+    assert db_handler.verify_signed_access_token(token)["email"] == EMAIL
+
+    monkeypatch.setenv("ACCESS_TOKEN_SIGNING_KEYS", "current:first-secret")
+    run(db_handler.get_database())
+    with pytest.raises(ValueError):
+        db_handler.verify_signed_access_token(token)
+
+
+@pytest.mark.parametrize("signing_keys", ["first-secret", "current:", ":first-secret", "key.1:first-secret"])
+def test_malformed_signing_keys_are_refused(monkeypatch, signing_keys):
+    monkeypatch.setenv("ACCESS_TOKEN_SIGNING_KEYS", signing_keys)
+
+    with pytest.raises(ValueError, match="ACCESS_TOKEN_SIGNING_KEYS"):
+        run(db_handler.get_database())
@@ -0,0 +1,162 @@
+"""
+Comment cache: a page served from the buffer of a location must be tagged with the version the buffer holds, never
+with a newer version from the database, or clients would keep a stale page behind a 304.
+
+Runs on the in-memory stand-in, so it needs mongomock-motor but no MongoDB.
+
+Usage:
+```bash
+pip install pytest mongomock-motor
+python -m pytest tests
+```
+"""
+from asyncio import run
+from collections import OrderedDict
+
+import pytest
+
+pytest.importorskip("mongomock_motor")
+
+from httpx import ASGITransport, AsyncClient
+
+import app.cache as comment_cache
+import app.database as db_handler
+import app.main as main_app
+
+LOCATION = "test-comment-cache"
+EMAIL = "author@example.com"
+
+
+@pytest.fixture(autouse=True)
+def memory_database(monkeypatch):
+    """
+    Give every test its own in-memory database and an empty comment cache, the settings are restored afterward.
+    """
+    monkeypatch.setenv("MONGODB_BACKEND", "memory")
+    monkeypatch.setenv("COMMENT_BATCH_WINDOW_MS", "0")
+    monkeypatch.setattr(db_handler, "DB", None, raising=False)
+    for name, value in (("MEMORY_DATABASE", None), ("COMMENT_ID_BLOCKS", {}), ("COMMENT_ID_LOCKS", {}),
+                        ("COMMENT_BATCHES", {}), ("COMMENT_LISTENERS", []), ("VERSION_LISTENERS", []),
+                        ("TOKEN_CACHE", OrderedDict()), ("PROFILE_CACHE", OrderedDict()),
+                        ("COMMENT_ID_BLOCK_SIZE", db_handler.COMMENT_ID_BLOCK_SIZE),
+                        ("COMMENT_BATCH_WINDOW_MS", db_handler.COMMENT_BATCH_WINDOW_MS)):
+        monkeypatch.setattr(db_handler, name, value)
+    for name, value in (("BUFFERS", OrderedDict()), ("REVISIONS", OrderedDict()), ("REVISIONS_FROM_HUB", False),
+                        ("TOTAL_BYTES", 0), ("STATS", {"hits": 0, "misses": 0, "evictions": 0})):
+        monkeypatch.setattr(comment_cache, name, value)
+
+
+async def read_page(client: AsyncClient, etag: str | None = None, field: str = "comment",
+                    **params) -> tuple[int, str, list[str]]:
+    """
+    Read a page of LOCATION, the newest one by default.
+
+    :param client: The client of the app.
+    :param etag: The ETag to revalidate, None for a plain read.
+    :param field: The field of the comments to return.
+    :param params: More query parameters of the page.
+    :return: A tuple of the status code, the ETag and the field of every comment.
+    """
+    headers = {"If-None-Match": etag} if etag else {}
+    response = await client.get(f"/comment/{LOCATION}", params={"format": "json", **params}, headers=headers)
+    comments = response.json()["comments"] if response.status_code == 200 else []
+    return response.status_code, response.headers["ETag"], [comment[field] for comment in comments]
+
+
+def client() -> AsyncClient:
+    """
+    Make a client that calls the app directly, without running its lifespan.
+
+    :return: The client.
+    """
+    return AsyncClient(transport=ASGITransport(app=main_app.app), base_url="http://test")
+
+
+def test_buffer_lagging_the_database_keeps_its_own_tag():
+    async def main() -> None:
+        await db_handler.get_database()
+        await db_handler.post_comment(db_handler.ANONYMOUS_EMAIL, "Anonymous", "#1d3557", "/", LOCATION, "First")
+
+        async with client() as http:
+            _, etag, comments = await read_page(http)  # Fills the buffer
+            assert comments == ["First"]
+
+            # Another worker posts, the change stream has not brought it to this worker yet
+            await db_handler.DB.comment_items.insert_one({"location": LOCATION, "id": 1, "comment": "Second",
+                                                          "username": "Anonymous", "color": "#1d3557",
+                                                          "initial": "/", "date": "", "time": ""})
+            await db_handler.DB.comments.update_one({"location": LOCATION},
+                                                    {"$set": {"max_comment_id": 1}, "$inc": {"revision": 1}})
+
+            status_code, lagging_etag, comments = await read_page(http)
+            assert (status_code, lagging_etag, comments) == (200, etag, ["First"])
+            assert comment_cache.STATS["hits"] == 1
+
+            # The change stream delivers the comment, then the version it bumped
+            comment = await db_handler.DB.comment_items.find_one({"location": LOCATION, "id": 1},
+                                                                 db_handler.COMMENT_PROJECTION)
+            comment_cache.add(LOCATION, comment)
+            comment_cache.set_version(LOCATION, 1, 2)
+
+            status_code, new_etag, comments = await read_page(http, etag)
+            assert (status_code, comments) == (200, ["Second", "First"])
+            assert new_etag != etag
+
+    run(main())
+
+
+def test_edit_bumps_the_revision_of_the_buffer():
+    async def main() -> None:
+        await db_handler.get_database()
+        db_handler.VERSION_LISTENERS.append(comment_cache.set_version)
+        await db_handler.DB.users.insert_one({"email": EMAIL, "username": "author", "color": "#1d3557",
+                                              "initial": "AU"})
+        await db_handler.post_comment(EMAIL, "author", "#1d3557", "AU", LOCATION, "First")
+
+        async with client() as http:
+            _, etag, _ = await read_page(http)  # Fills the buffer
+            assert (await read_page(http, etag))[0] == 304
+
+            await db_handler.edit_comment(EMAIL, LOCATION, 0, "Edited")
+
+            status_code, new_etag, comments = await read_page(http, etag)
+            assert (status_code, comments) == (200, ["Edited"])
+            assert new_etag != etag
+            assert comment_cache.get_version(LOCATION) == await db_handler.get_location_version(LOCATION)
+
+    run(main())
+
+
+def test_rename_on_another_worker_is_not_tagged_before_this_worker_sees_it():
+    async def main() -> None:
+        await db_handler.get_database()
+        comment_cache.REVISIONS_FROM_HUB = True  # As on MongoDB, where the change stream delivers the revisions
+        await db_handler.DB.users.insert_one({"email": EMAIL, "username": "author", "color": "#1d3557",
+                                              "initial": "AU"})
+        await db_handler.post_comment(EMAIL, "author", "#1d3557", "AU", LOCATION, "First")
+
+        async with client() as http:
+            _, etag, usernames = await read_page(http, field="username")  # Fills the buffer
+            assert usernames == ["author"]
+
+            # Another worker renames the author, the change stream has brought neither the update nor the revision
+            await db_handler.DB.users.update_one({"email": EMAIL}, {"$set": {"username": "renamed"}})
+            await db_handler.DB.comments.update_one({"location": LOCATION}, {"$inc": {"revision": 1}})
+            assert db_handler.get_cached_profile(EMAIL)["username"] == "author"
+
+            # A page read from the database is tagged with the new revision, so it reads the new username
+            status_code, _, usernames = await read_page(http, field="username", latest_first="false")
+            assert (status_code, usernames) == (200, ["renamed"])
+
+            # The buffer keeps its revision until the stream catches up, its tag may lag its body but never leads it
+            assert await read_page(http, field="username") == (200, etag, ["renamed"])
+
+            # The change stream delivers the update, then the revision it bumped
+            db_handler.invalidate_cached_user(EMAIL)
+            comment_cache.set_version(LOCATION, None, (await db_handler.get_location_version(LOCATION))[1])
+
+            status_code, new_etag, usernames = await read_page(http, etag, field="username")
+            assert (status_code, usernames) == (200, ["renamed"])
+            assert new_etag != etag
+
+    run(main())
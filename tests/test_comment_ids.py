@@ -0,0 +1,127 @@
+"""
+Comment ID allocation: thousands of concurrent posts to one location must get dense and unique IDs.
+
+Runs on the in-memory stand-in, so it needs mongomock-motor but no MongoDB.
+
+Usage:
+```bash
+pip install pytest mongomock-motor
+python -m pytest tests
+```
+"""
+from asyncio import gather, run
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("mongomock_motor")
+
+import app.database as db_handler
+
+LOCATION = "test-comment-ids"
+COMMENTS = 2000
+
+
+@pytest.fixture(autouse=True)
+def memory_database(monkeypatch):
+    """
+    Give every test its own in-memory database and fresh ID allocation state, the settings are restored afterward.
+    """
+    monkeypatch.setenv("MONGODB_BACKEND", "memory")
+    monkeypatch.setattr(db_handler, "DB", None, raising=False)
+    for name, value in (("MEMORY_DATABASE", None), ("COMMENT_ID_BLOCKS", {}), ("COMMENT_ID_LOCKS", {}),
+                        ("COMMENT_ID_LEASE_EXPIRES", 0.0), ("COMMENT_BATCHES", {}),
+                        ("COMMENT_ID_BLOCK_SIZE", db_handler.COMMENT_ID_BLOCK_SIZE),
+                        ("COMMENT_ID_LEASE_SECONDS", db_handler.COMMENT_ID_LEASE_SECONDS),
+                        ("COMMENT_BATCH_WINDOW_MS", db_handler.COMMENT_BATCH_WINDOW_MS),
+                        ("WORKER_ID", db_handler.WORKER_ID)):
+        monkeypatch.setattr(db_handler, name, value)
+
+
+async def post_concurrently(count: int) -> list[int]:
+    """
+    Post comments to LOCATION all at once.
+
+    :param count: How many comments to post.
+    :return: The IDs of every comment of LOCATION.
+    """
+    await gather(*(db_handler.post_comment(db_handler.ANONYMOUS_EMAIL, "Anonymous", "#1d3557", "/", LOCATION,
+                                           f"Comment {index}") for index in range(count)))
+
+    comments = await db_handler.DB.comment_items.find({"location": LOCATION}, {"id": 1}).to_list(length=None)
+    return [comment["id"] for comment in comments]
+
+
+@pytest.mark.parametrize("block_size, batch_window_ms", [(1, 0), (50, 0), (1, 5), (50, 5)])
+def test_concurrent_posts_get_dense_unique_ids(monkeypatch, block_size, batch_window_ms):
+    monkeypatch.setenv("COMMENT_ID_BLOCK_SIZE", str(block_size))
+    monkeypatch.setenv("COMMENT_BATCH_WINDOW_MS", str(batch_window_ms))
+
+    async def main() -> list[int]:
+        await db_handler.get_database()
+        await db_handler.hold_comment_id_lease()
+        return await post_concurrently(COMMENTS)
+
+    ids = run(main())
+
+    assert len(ids) == COMMENTS
+    assert sorted(ids) == list(range(COMMENTS))
+
+
+def test_counter_continues_after_existing_comments(monkeypatch):
+    monkeypatch.setenv("COMMENT_ID_BLOCK_SIZE", "1")
+    monkeypatch.setenv("COMMENT_BATCH_WINDOW_MS", "0")
+
+    async def main() -> list[int]:
+        await db_handler.get_database()
+        # A location written before the counter existed, every first post races to seed the counter
+        await db_handler.DB.comments.insert_one({"location": LOCATION, "max_comment_id": 41,
+                                                 "layout": db_handler.COMMENT_LAYOUT_VERSION})
+        return await post_concurrently(COMMENTS)
+
+    assert sorted(run(main())) == list(range(42, 42 + COMMENTS))
+
+
+def test_blocks_fall_back_to_single_ids_without_the_lease(monkeypatch):
+    monkeypatch.setenv("COMMENT_ID_BLOCK_SIZE", "50")
+    monkeypatch.setenv("COMMENT_ID_LEASE_SECONDS", "1")
+    monkeypatch.setenv("COMMENT_BATCH_WINDOW_MS", "0")
+
+    async def main() -> None:
+        await db_handler.get_database()
+
+        # Another worker on the same database already hands out blocks
+        await db_handler.DB.leases.insert_one({"_id": "comment_ids", "owner": "other-worker",
+                                               "expires_at": datetime.now(timezone.utc) + timedelta(minutes=1)})
+        # This worker still starts and posts, taking its IDs one at a time from the counter
+        await db_handler.hold_comment_id_lease()
+        assert await db_handler.next_comment_ids(LOCATION, 1) == [0]
+        assert await db_handler.next_comment_ids(LOCATION, 1) == [1]
+        assert LOCATION not in db_handler.COMMENT_ID_BLOCKS
+
+        # Once it released the lease, this worker can take over and use blocks
+        await db_handler.DB.leases.delete_one({"_id": "comment_ids"})
+        assert await db_handler.renew_comment_id_lease()
+        assert await db_handler.next_comment_ids(LOCATION, 3) == [2, 3, 4]
+        assert db_handler.COMMENT_ID_BLOCKS[LOCATION] == [5, 52]
+
+    run(main())
+
+
+def test_written_comments_succeed_when_the_location_update_fails(monkeypatch):
+    monkeypatch.setenv("COMMENT_ID_BLOCK_SIZE", "1")
+    monkeypatch.setenv("COMMENT_BATCH_WINDOW_MS", "5")
+    attempts = []
+
+    async def fail_location_update(location: str, update: dict) -> None:
+        attempts.append(location)
+        raise RuntimeError("Location update failed")
+
+    async def main() -> list[int]:
+        await db_handler.get_database()
+        monkeypatch.setattr(db_handler, "update_location_version", fail_location_update)
+        # The comments are stored, so their callers must not be told to post them again
+        return await post_concurrently(10)
+
+    assert sorted(run(main())) == list(range(10))
+    assert len(attempts) == db_handler.LOCATION_UPDATE_ATTEMPTS
@@ -0,0 +1,72 @@
+"""
+Verification codes: a code request that can not be sent must not take away the code the user already got.
+
+Runs on the in-memory stand-in, so it needs mongomock-motor but no MongoDB.
+
+Usage:
+```bash
+pip install pytest mongomock-motor
+python -m pytest tests
+```
+"""
+from asyncio import QueueFull, run
+
+import pytest
+
+pytest.importorskip("mongomock_motor")
+
+import app.database as db_handler
+import app.mailer as mailer
+
+EMAIL = "reader@example.com"
+
+
+@pytest.fixture(autouse=True)
+def memory_database(monkeypatch):
+    """
+    Give every test its own in-memory database and collect the queued emails instead of sending them.
+    """
+    monkeypatch.setenv("MONGODB_BACKEND", "memory")
+    monkeypatch.setattr(db_handler, "DB", None, raising=False)
+    monkeypatch.setattr(db_handler, "MEMORY_DATABASE", None)
+    run(db_handler.get_database())
+
+
+def test_full_email_queue_keeps_the_previous_code(monkeypatch):
+    sent = []
+    monkeypatch.setattr(mailer, "enqueue_email", sent.append)
+
+    async def main() -> None:
+        await db_handler.email_verification_queue(EMAIL)
+        previous = await db_handler.DB.verification_queue.find_one({"email": EMAIL})
+
+        def queue_full(message: dict) -> None:
+            raise QueueFull("Too many pending emails, please try again later")
+
+        monkeypatch.setattr(mailer, "enqueue_email", queue_full)
+        with pytest.raises(QueueFull):
+            await db_handler.email_verification_queue(EMAIL)
+
+        assert await db_handler.DB.verification_queue.find_one({"email": EMAIL}) == previous
+
+    run(main())
+    assert len(sent) == 1
+
+
+def test_full_email_queue_leaves_no_code_behind(monkeypatch):
+    def queue_full(message: dict) -> None:
+        raise QueueFull("Too many pending emails, please try again later")
+
+    monkeypatch.setattr(mailer, "enqueue_email", queue_full)
+
+    async def main() -> None:
+        with pytest.raises(QueueFull):
+            await db_handler.email_verification_queue(EMAIL)
+
+        assert await db_handler.DB.verification_queue.find_one({"email": EMAIL}) is None
+
+    run(main())
+
+
+def test_dead_letter_address_is_masked():
+    assert mailer.mask_email("reader@example.com") == "r***@example.com"